@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Benchmarks of the marcompile compiler on synthetic sequences, for
+# both the GPA-FHDO and OCRA1 gradient boards. Results are stored as
+# JSON, so that runs on different commits can be compared.
+#
+# Usage examples:
+# python bench_marcompile.py # all generators and targets, 1e3 to 1e7 events
+# python bench_marcompile.py --sizes 1e3 1e4 --targets dict2bin
+# python bench_marcompile.py --compare bench_results/old.json bench_results/new.json
+
+import argparse, hashlib, json, os, platform, socket, subprocess, sys, tempfile, time, warnings
+import numpy as np
+
+import marcompile as mc
+import maremu
+import experiment as ex # needs local_config.py
+
+import pdb
+st = pdb.set_trace
+
+## Synthetic sequence generators: each returns a floating-point
+## dictionary in the format used by Experiment.add_flodict(), with
+## roughly n events in total (counting the I and Q parts of complex
+## TX separately)
+
+def dense_tx(n, rng):
+    """ Continuous random TX waveform on tx0, updated every 50 ns """
+    k = max(n // 2, 1)
+    t = 10 + np.arange(k) * 0.05
+    tx = (rng.uniform(-0.9, 0.9, k) + 1j * rng.uniform(-0.9, 0.9, k))
+    return {'tx0': (t, tx)}
+
+def grad_trapezoids(n, rng, ramp_pts=10, ramp_t=50, plateau_t=200, tr=500):
+    """ Train of trapezoids on three gradient channels, similar to
+    examples.trapezoid(); channels are offset in time by a few us so
+    that the updates never coincide """
+    trap_pts = 2 * ramp_pts - 1
+    traps = max(n // (3 * trap_pts), 1)
+    ramp = np.linspace(0, 1, ramp_pts)
+    t1 = np.hstack([ramp * ramp_t, ramp[1:] * ramp_t + ramp_t + plateau_t])
+    a1 = np.hstack([ramp, 1 - ramp[1:]])
+    amps = rng.uniform(-0.9, 0.9, traps)
+    t = (10 + np.arange(traps)[:, np.newaxis] * tr + t1).ravel()
+    a = (amps[:, np.newaxis] * a1).ravel()
+    return {'grad_vx': (t, a), 'grad_vy': (t + 2.5, -a), 'grad_vz': (t + 5, a / 2)}
+
+def long_tr_loop(n, rng, tr=1e6, rf_length=200, rx_pad=20):
+    """ Sparse RF pulses and RX windows at long intervals, similar to test_long_sequence.long_loopback() """
+    trs = max(n // 6, 1)
+    rf_t = 100 + np.arange(trs)[:, np.newaxis] * tr + np.array([0, rf_length])
+    rx_t = rf_t + np.array([-rx_pad, rx_pad])
+    return {'tx1': (rf_t.ravel(), np.tile([0.4, 0], trs)),
+            'rx1_en': (rx_t.ravel(), np.tile([1, 0], trs))}
+
+def many_channels(n, rng, step=2):
+    """ Simultaneous events on all the TX, RX and digital channels """
+    k = max(n // 10, 1)
+    t = 10 + np.arange(k) * step
+    sd = {'tx0': (t, rng.uniform(-0.9, 0.9, k) + 1j * rng.uniform(-0.9, 0.9, k)),
+          'tx1': (t, rng.uniform(-0.9, 0.9, k) + 1j * rng.uniform(-0.9, 0.9, k)),
+          'leds': (t, np.arange(k) % 256)}
+    for key in ['rx0_en', 'rx1_en', 'tx_gate', 'rx_gate', 'trig_out']:
+        sd[key] = (t, np.arange(k) % 2)
+    return sd
+
+generators = {'dense_tx': dense_tx, 'grad_trapezoids': grad_trapezoids,
+              'long_tr_loop': long_tr_loop, 'many_channels': many_channels}
+
+def experiment(board):
+    """ Experiment for a gradient board, with an unconnected socket; close its _s when done """
+    gb_orig = ex.grad_board
+    ex.grad_board = board
+    try:
+        return ex.Experiment(prev_socket=socket.socket(), print_infos=False)
+    finally:
+        ex.grad_board = gb_orig
+
+def int_dict(flodict, board):
+    """Convert a floating-point dictionary to the integer format used
+    by marcompile.dict2bin(), the same way as Experiment; returns it
+    with the board's initial buffer values and latencies"""
+    expt = experiment(board)
+    try:
+        return expt.flo2int(flodict), expt.gradb.bin_config
+    finally:
+        expt._s.close()
+
+def write_csv(path, sd, cfg):
+    """ Write the simulator-format CSV file of an integer dictionary for csv2bin(), by emulating its compiled program """
+    prog = mc.dict2bin(sd, cfg['initial_bufs'], cfg['latencies'])
+    maremu.write_csv(path, maremu.emulate_csv(prog, latencies=cfg['latencies']))
+
+def events(sd):
+    return sum(np.size(t) for t, v in sd.values())
+
+## Benchmark targets: each compiles a floating-point dictionary and
+## returns (seconds, machine code)
+
+def bench_dict2bin(flodict, board, repeats):
+    sd, cfg = int_dict(flodict, board)
+    return best_of(repeats, lambda: mc.dict2bin(sd, cfg['initial_bufs'], cfg['latencies'])), events(sd)
+
+class Skip(Exception):
+    pass
+
+def bench_csv2bin(flodict, board, repeats):
+    sd, cfg = int_dict(flodict, board)
+    if max(t[-1] for t, v in sd.values()) >= 2**32:
+        raise Skip("csv2bin only handles 32-bit times")
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "bench.csv")
+        write_csv(path, sd, cfg)
+        return best_of(repeats, lambda: mc.csv2bin(path, initial_bufs=cfg['initial_bufs'], latencies=cfg['latencies'])), events(sd)
+
+def bench_compile(flodict, board, repeats):
+    expt = experiment(board)
+    try:
+        expt.add_flodict(flodict)
+        n = events(expt._seq)
+
+        def compile():
+            expt._seq_compiled = False
+            expt.compile()
+            return expt._machine_code
+
+        return best_of(repeats, compile), n
+    finally:
+        expt._s.close()
+
+targets = {'dict2bin': bench_dict2bin, 'csv2bin': bench_csv2bin, 'compile': bench_compile}
+
+def best_of(repeats, f):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        res = f()
+        times.append(time.perf_counter() - t0)
+    return min(times), res
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(sizes, gens, tgts, boards, repeats, max_csv_events, seed=0):
+    results = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore") # removed-instruction warnings etc
+        gb_orig = mc.grad_board
+        try:
+            for board in boards:
+                mc.grad_board = board
+                for gen in gens:
+                    for size in sizes:
+                        flodict = generators[gen](size, np.random.default_rng(seed))
+                        for tgt in tgts:
+                            if tgt == 'csv2bin' and size > max_csv_events:
+                                continue
+                            reps = repeats if size < 1e6 else 1
+                            try:
+                                (secs, words), n = targets[tgt](flodict, board, reps)
+                            except Skip as e:
+                                print("Skipping {:s}: {:s}".format(tgt, str(e)))
+                                continue
+                            res = {'board': board, 'generator': gen, 'target': tgt, 'size': size, 'events': int(n),
+                                   'seconds': secs, 'words': int(words.size),
+                                   'md5': hashlib.md5(np.asarray(words, dtype=np.uint32).tobytes()).hexdigest()}
+                            results.append(res)
+                            print("{:9s} {:16s} {:9s} {:9d} events: {:9.4f} s, {:9d} words".format(
+                                board, gen, tgt, res['events'], secs, res['words']))
+        finally:
+            mc.grad_board = gb_orig
+    return results
+
+def compare(old_path, new_path):
+    """ Print the speedup of each benchmark between two result files, and flag changed machine code """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    key = lambda r: (r['board'], r['generator'], r['target'], r['size'])
+    old_res = { key(r): r for r in old['results'] }
+    print("{:s} -> {:s}".format(old['commit'], new['commit']))
+    for r in new['results']:
+        o = old_res.get(key(r))
+        if o is None:
+            continue
+        flag = "" if o['md5'] == r['md5'] else "  MACHINE CODE CHANGED"
+        print("{:9s} {:16s} {:9s} {:9d}: {:9.4f} s -> {:9.4f} s, {:6.2f}x{:s}".format(
+            *key(r), o['seconds'], r['seconds'], o['seconds'] / r['seconds'], flag))
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark the marcompile compiler on synthetic sequences")
+    p.add_argument('--sizes', nargs='+', type=float, default=[1e3, 1e4, 1e5, 1e6, 1e7], help="approximate numbers of events")
+    p.add_argument('--generators', nargs='+', choices=list(generators), default=list(generators))
+    p.add_argument('--targets', nargs='+', choices=list(targets), default=list(targets))
+    p.add_argument('--boards', nargs='+', choices=['gpa-fhdo', 'ocra1'], default=['gpa-fhdo', 'ocra1'])
+    p.add_argument('--repeats', type=int, default=3, help="best-of repeats, for sizes below 1e6")
+    p.add_argument('--max-csv-events', type=float, default=1e6, help="largest size for csv2bin, since the CSV files get very large")
+    p.add_argument('--output', default=None, help="results file; bench_results/<commit>.json by default")
+    p.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two results files instead of running")
+    args = p.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    commit = git_commit()
+    results = run([int(s) for s in args.sizes], args.generators, args.targets, args.boards,
+                  args.repeats, args.max_csv_events)
+
+    output = args.output
+    if output is None:
+        output = os.path.join("bench_results", commit + ".json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                   'python': sys.version.split()[0], 'numpy': np.__version__, 'machine': platform.platform(),
+                   'results': results}, f, indent=1)
+    print("Results written to " + output)
+
+if __name__ == "__main__":
+    main()
@@ -107,9 +107,11 @@ def grad_echo(trs=21, plot_rx=False, init_gpa=False, plot_sequence=False,
     # 0.1 for a safety margin)
 
     tr_t = 0 # start the first TR at 20us
+    trs = []
     for pamp in phase_amps:
-        expt.add_flodict( grad_echo_tr( tr_t, pamp) )
+        trs.append( grad_echo_tr( tr_t, pamp) )
         tr_t += tr_total_time
+    expt.add_flodicts(trs)
 
     if plot_sequence:
         expt.plot_sequence()
@@ -315,33 +317,24 @@ def radial(trs=36, plot_rx=False, init_gpa=False, plot_sequence=False):
     tx_gate_pre = 2 # us, time to start the TX gate before the RF pulse begins
     tx_gate_post = 1 # us, time to keep the TX gate on after the RF pulse ends
 
-    def radial_tr(tstart, th):
-        dbg_sc=0.01
-        gx = G * np.cos(th)
-        gy = G * np.sin(th)
-
-        value_dict = {
-            # second tx0 pulse and tx1 pulse purely for loopback debugging
-            'tx0': ( np.array([rf_tstart, rf_tend,    rx_tstart + 15, rx_tend - 15]),
-                     np.array([rf_amp, 0,    dbg_sc * (gx+gy*1j), 0]) ),
-            'tx1': ( np.array([rx_tstart + 15, rx_tend - 15]), np.array([dbg_sc * (gx+gy*1j), 0]) ),
-            'grad_vz': ( np.array([gradz_tstart]),
-                         np.array([gx]) ),
-            'grad_vy': ( np.array([grady_tstart]),
-                         np.array([gy]) ),
-            'rx0_en' : ( np.array([rx_tstart, rx_tend]),
-                            np.array([1, 0]) ),
-            'rx_gate' : ( np.array([rx_tstart, rx_tend]),
-                            np.array([1, 0]) ),
-            'tx_gate' : ( np.array([rf_tstart - tx_gate_pre, rf_tend + tx_gate_post]),
-                          np.array([1, 0]) )
-            }
-
-        for k, v in value_dict.items():
-            # v for read, value_dict[k] for write
-            value_dict[k] = (v[0] + tstart, v[1])
-
-        return value_dict
+    # events of a single TR; the gradients and the debugging TX pulses are scaled by the angle of each TR
+    dbg_sc = 0.01
+    radial_tr = ex.TRTemplate({
+        # second tx0 pulse and tx1 pulse purely for loopback debugging
+        'tx0': ( np.array([rf_tstart, rf_tend,    rx_tstart + 15, rx_tend - 15]),
+                 np.array([rf_amp, 0,    dbg_sc, 0]) ),
+        'tx1': ( np.array([rx_tstart + 15, rx_tend - 15]), np.array([dbg_sc, 0]) ),
+        'grad_vz': ( np.array([gradz_tstart]),
+                     np.array([1.0]) ),
+        'grad_vy': ( np.array([grady_tstart]),
+                     np.array([1.0]) ),
+        'rx0_en' : ( np.array([rx_tstart, rx_tend]),
+                     np.array([1, 0]) ),
+        'rx_gate' : ( np.array([rx_tstart, rx_tend]),
+                      np.array([1, 0]) ),
+        'tx_gate' : ( np.array([rf_tstart - tx_gate_pre, rf_tend + tx_gate_post]),
+                      np.array([1, 0]) )
+        }, {'g': [('tx0', 2), ('tx1', 0)], 'gx': ('grad_vz', 0), 'gy': ('grad_vy', 0)})
 
     expt = ex.Experiment(lo_freq=lo_freq, rx_t=rx_period, init_gpa=init_gpa, gpa_fhdo_offset_time=(1 / 0.2 / 3.1))
     # gpa_fhdo_offset_time in microseconds; offset between channels to
@@ -349,10 +342,8 @@ def radial(trs=36, plot_rx=False, init_gpa=False, plot_sequence=False):
     # 1/0.2 = 5us, 5 / 3.1 gives the offset between channels; extra
     # 0.1 for a safety margin))
 
-    tr_t = 0 # start the first TR at 0us
-    for th in angles:
-        expt.add_flodict( radial_tr( tr_t, th ) )
-        tr_t += tr_total_time
+    gx, gy = G * np.cos(angles), G * np.sin(angles)
+    expt.add_trs(radial_tr, np.arange(trs) * tr_total_time, g=gx + gy*1j, gx=gx, gy=gy) # start the first TR at 0us
 
     if plot_sequence:
         expt.plot_sequence()
@@ -2,7 +2,7 @@
 #
 # Basic toolbox for server operations; wraps up a lot of stuff to avoid the need for hardcoding on the user's side.
 
-import socket, time, warnings
+import socket, time, warnings, threading, queue, weakref, concurrent.futures
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -10,12 +10,24 @@ from local_config import ip_address, port, fpga_clk_freq_MHz, grad_board
 import grad_board as gb
 import server_comms as sc
 import marcompile as fc
+import maremu
+import marseq
 
 import pdb
 st = pdb.set_trace
 
 ######## TODO: configure the final buffers as well, whether in marcompile or elsewhere
 
+run_executors = weakref.WeakKeyDictionary() # one single-thread executor per server socket, for Experiment.run_async()
+run_executors_lock = threading.Lock()
+
+def run_executor(s):
+    """ Executor that runs sequences over the server socket s one at a time """
+    with run_executors_lock:
+        if s not in run_executors:
+            run_executors[s] = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return run_executors[s]
+
 class Experiment:
     """Wrapper class for managing an entire experimental sequence
 
@@ -76,6 +88,17 @@ class Experiment:
                  allow_user_init_cfg=False, # allow user-defined alteration of marga configuration set by init, namely RX rate, LO properties etc; see the compile() method for details
                  halt_and_reset=False, # upon connecting to the server, halt any existing sequences that may be running
                  flush_old_rx=False, # when debugging or developing new code, you may accidentally fill up the RX FIFOs - they will not automatically be cleared in case there is important data inside. Setting this true will always read them out and clear them before running a sequence. More advanced manual code can read RX from existing sequences.
+                 compile_cache=None, # marcache.CompileCache object, to reuse machine code compiled earlier for identical sequences; disabled by default
+                 compile_processes=None, # compile long sequences in parallel segments, using this many processes (0 for one per core)
+                 profile_compile=False, # record the time taken by each compilation stage; see get_compile_profile()
+                 incremental_compile=False, # when events are appended after the last compile(), only compile the new ones if they are all later than the existing sequence; requires auto_leds=False, since the LED scan spans the whole sequence
+                 compile_opt_level=0, # 1 to reduce the number of instructions in the machine code, without changing the outputs; see marcompile.optimise()
+                 patch_compile=False, # when only the values of the sequence have changed since the last compile(), such as between the points of a parameter sweep, write them into the previous machine code instead of compiling it again; see marcompile.dict2bin_patch()
+                 check_seq=False, # analyse the machine code before running it, and refuse to run sequences that exceed the limits below or update the gradients faster than the SPI interface allows; see analyse_seq()
+                 max_seq_words=fc.MARGA_MEM_WORDS, # the most instructions a sequence may have with check_seq, or each of its parts with split_seq; the sequencer memory size by default
+                 max_seq_duration=None, # us; with check_seq, the longest a sequence may run for
+                 split_seq=None, # us; split sequences with more than max_seq_words instructions at idle times of at least this long with the RX off (such as between TRs), and run the parts back-to-back, concatenating their RX data; see marcompile.split_program()
+                 seq_file=None, # binary sequence file saved by save_seq(), instead of seq_dict or seq_csv; see load_seq()
                  ):
 
         # create socket early so that destructor works
@@ -114,6 +137,9 @@ class Experiment:
             self._initial_wait = 1 + 1/grad_max_update_rate
 
         self._auto_leds = auto_leds
+        assert not (incremental_compile and auto_leds), "Incremental compilation requires auto_leds=False"
+        self._incremental_compile = incremental_compile
+        self._compile_state = None
 
         assert (seq_csv is None) or (seq_dict is None), "Cannot supply both a sequence dictionary and a CSV file."
         self._csv = None
@@ -137,6 +163,21 @@ class Experiment:
         self._set_cic_shift = set_cic_shift
         self._flush_old_rx = flush_old_rx
         self._allow_user_init_cfg = allow_user_init_cfg
+        self._compile_cache = compile_cache
+        self._compile_processes = compile_processes
+        self._compile_opt_level = compile_opt_level
+        self._patch_compile = patch_compile
+        self._patch_template = None
+        self._profile_compile = profile_compile
+        self._compile_profile = None
+        self._check_seq = check_seq
+        self._max_seq_words = max_seq_words
+        self._max_seq_duration = max_seq_duration
+        self._split_seq = split_seq
+
+        if seq_file is not None:
+            assert seq_dict is None and seq_csv is None, "Cannot supply a sequence file as well as a sequence dictionary or CSV file."
+            self.load_seq(seq_file)
 
     def __del__(self):
         if self._close_socket:
@@ -148,6 +189,57 @@ class Experiment:
     def get_rx_ts(self):
         return self._rx_ts
 
+    def get_compile_profile(self):
+        """ marcompile.CompileProfile of the last compilation, if profile_compile was set """
+        return self._compile_profile
+
+    def analyse_seq(self):
+        """ Static analysis of the compiled machine code, compiling it first if necessary; see maremu.analyse() """
+        if not self._seq_compiled:
+            self.compile()
+        return maremu.analyse(self._machine_code, fpga_clk_freq_MHz)
+
+    def seq_settings(self):
+        """ Settings that the machine code depends on, apart from the sequence and the gradient board configuration """
+        return {'dds_phase_steps': self._dds_phase_steps.tolist(), 'rx_divs': self._rx_divs.tolist(), 'rx_lo': list(self._rx_lo),
+                'fix_cic_scale': self._fix_cic_scale, 'set_cic_shift': self._set_cic_shift, 'auto_leds': self._auto_leds,
+                'allow_user_init_cfg': self._allow_user_init_cfg, 'compile_opt_level': self._compile_opt_level,
+                'fpga_clk_freq_MHz': fpga_clk_freq_MHz}
+
+    def save_seq(self, path, machine_code=True):
+        """ Save the integer sequence to a binary sequence file (see marseq.py), with its machine code if machine_code is set, compiling it first if necessary """
+        if machine_code and not self._seq_compiled:
+            self.compile()
+        marseq.save(path, self._seq, self._machine_code if machine_code else None,
+                    self.gradb.bin_config['initial_bufs'], self.gradb.bin_config['latencies'], grad_board, self.seq_settings())
+
+    def load_seq(self, path):
+        """Replace the sequence with one from a file saved by
+        save_seq(). Its arrays are memory-mapped rather than copied, and
+        its machine code is used without recompiling if it was compiled
+        with the same settings and gradient board configuration."""
+        f = marseq.load(path)
+        self._csv = None
+        self._seq = dict(f['seq'])
+        self._seq_compiled = False
+        self._compile_state = None
+
+        if f['machine_code'] is not None and f['grad_board'] == grad_board and f['settings'] == self.seq_settings() \
+           and np.array_equal(f['initial_bufs'], self.gradb.bin_config['initial_bufs']) \
+           and np.array_equal(f['latencies'], self.gradb.bin_config['latencies']):
+            self._cic_words() # set the RX scale factors, as compile() would
+            self._machine_code = f['machine_code']
+            self._seq_compiled = True
+
+    def _cic_words(self):
+        """ CIC configuration words for each RX channel; also sets the RX scale corrections """
+        rx0_words, self._rx0_cic_factor = fc.cic_words(self._rx_divs[0], self._set_cic_shift)
+        rx1_words, self._rx1_cic_factor = fc.cic_words(self._rx_divs[1], self._set_cic_shift)
+        if not self._fix_cic_scale: # clear the correction factor
+            self._rx0_cic_factor = 1
+            self._rx1_cic_factor = 1
+        return rx0_words, rx1_words
+
     def set_lo_freq(self, lo_freq):
         # lo_freq: either a single floating-point value, or an iterable of up to three values for each marga NCO
 
@@ -160,11 +252,41 @@ class Experiment:
         self._dds_phase_steps = np.round(2**31 / fpga_clk_freq_MHz * np.array(lo_freq)).astype(np.uint32)
         self._lo_freqs = self._dds_phase_steps * fpga_clk_freq_MHz / (2 ** 31) # real LO freqs -- TODO: print for debugging
 
-        self._seq_compiled = False # force recompilation
-
-    def flo2int(self, seq_dict):
+        self._compile_state = None # LO configuration is at the start of the sequence
+        if not (self.__dict__.get('_seq_compiled') and self._retune_lo()):
+            self._seq_compiled = False # force recompilation
+
+    def _retune_lo(self):
+        """Write the LO frequencies into the compiled machine code, if
+        they were set there by compile() and nothing else changes the
+        LOs; returns False if the sequence needs to be recompiled.
+
+        This is also the case when the lower or upper 16 bits of a new
+        phase step are the same as the initial buffer value, since
+        compile() then leaves out the write; for instance for LO
+        frequencies that are multiples of 3.75 kHz, whose lower 16 bits
+        are 0 (see marcompile.patch_cols())."""
+        keys = [ 'lo{:d}_freq'.format(k) for k in range(3) ]
+        if self._allow_user_init_cfg or self._seq is None or any( len(self._seq.get(k, ((),))[0]) != 1 for k in keys ):
+            return False
+        machine_code = fc.patch_cols(self._machine_code, dict(zip(keys, self._dds_phase_steps)),
+                                     self.gradb.bin_config['initial_bufs'])
+        if machine_code is None:
+            return False
+
+        self._machine_code = machine_code
+        for k, step in zip(keys, self._dds_phase_steps):
+            self._seq[k] = (self._seq[k][0], np.array([step]))
+        return True
+
+    def flo2int(self, seq_dict, tr_firsts=None):
         """Convert a floating-point sequence dictionary to an integer binary
-        dictionary"""
+        dictionary
+
+        tr_firsts: optional dictionary of boolean arrays marking the
+        first event of each TR for some of the keys; repeated complex TX
+        values are then only removed within TRs, as if each TR had been
+        converted separately"""
 
         intdict = {}
 
@@ -177,12 +299,13 @@ class Experiment:
             """ farr: float array, [-1, 1] """
             return np.round(32767 * farr).astype(np.uint16)
 
-        def tx_complex(times, farr, tolerance=2e-6):
+        def tx_complex(times, farr, tolerance=2e-6, firsts=None):
             """times: float time array, farr: complex float array, [-1-1j, 1+1j]
             tolerance: minimum difference two values need to be considered binary-unique (2e-6 corresponds to ~19 bits)
+            firsts: elements that are always kept
             -- returns a tuple with repeated elements removed"""
             idata, qdata = farr.real, farr.imag
-            unique = lambda k: np.concatenate([[True], np.abs(np.diff(k)) > tolerance])
+            unique = lambda k: np.concatenate([[True], np.abs(np.diff(k)) > tolerance]) | (False if firsts is None else firsts)
             # DEBUGGING: use the below lambda instead to avoid stripping repeated values
             # unique = lambda k: np.ones_like(k, dtype=bool)
             idata_u, qdata_u = unique(idata), unique(qdata)
@@ -197,7 +320,7 @@ class Experiment:
                 valbin = tx_real(vals),
                 keybin = key,
             elif key in ['tx0', 'tx1']:
-                tbin, valbin = tx_complex(times, vals)
+                tbin, valbin = tx_complex(times, vals, firsts=None if tr_firsts is None else tr_firsts.get(key))
                 keybin = key + '_i', key + '_q'
             elif key in ['grad_vx', 'grad_vy', 'grad_vz', 'grad_vz2',
                          'fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2',
@@ -234,24 +357,85 @@ class Experiment:
 
         return intdict
 
+    @property
+    def _seq(self):
+        """ Integer sequence dictionary, with the events appended since it was last used joined on """
+        if self._seq_chunks:
+            for name, (ts, vs) in self._seq_chunks.items():
+                self._seq_dict[name] = ( np.concatenate([np.ravel(t) for t in ts]), np.concatenate([np.ravel(v) for v in vs]) )
+            self._seq_chunks = {}
+        return self._seq_dict
+
+    @_seq.setter
+    def _seq(self, seq):
+        self._seq_dict = seq
+        self._seq_chunks = {}
+
     def add_intdict(self, seq_intdict, append=True):
-        """ Add an integer-format dictionary to the sequence, or replace the old (time, value) tuples with new ones """
-        if self._seq is None:
+        """Add an integer-format dictionary to the sequence, or replace
+        the old (time, value) tuples with new ones. Appended events are
+        kept in lists of chunks until the sequence is next used, so
+        that adding many TRs one at a time takes linear time."""
+        if self._seq_dict is None:
             self._seq = {}
 
         for name, sb in seq_intdict.items():
-            if name in self._seq.keys() and append:
-                a, b = self._seq[name]
-                self._seq[name] = ( np.append(a, sb[0]), np.append(b, sb[1]) )
+            if name in self._seq_chunks and append:
+                self._seq_chunks[name][0].append(sb[0])
+                self._seq_chunks[name][1].append(sb[1])
+            elif name in self._seq_dict and append:
+                a, b = self._seq_dict[name]
+                self._seq_chunks[name] = ( [a, sb[0]], [b, sb[1]] )
             else:
-                self._seq[name] = sb
+                if name in self._seq_dict:
+                    self._compile_state = None # events already compiled have been replaced
+                self._seq_chunks.pop(name, None)
+                self._seq_dict[name] = sb
 
-    def add_flodict(self, flodict, append=True):
-        """ Add a floating-point dictionary to the sequence """
+    def add_flodict(self, flodict, append=True, tr_firsts=None):
+        """ Add a floating-point dictionary to the sequence; see flo2int() for tr_firsts """
         assert self._csv is None, "Cannot replace the dictionary for an Experiment class created from a CSV"
-        self.add_intdict(self.flo2int(flodict), append)
+        self.add_intdict(self.flo2int(flodict, tr_firsts), append)
         self._seq_compiled = False
 
+    def add_flodicts(self, trs, tr_starts=None, append=True):
+        """Add many TRs to the sequence at once, converting each key
+        with a single flo2int() pass; the result is the same as adding
+        the TRs one by one with add_flodict().
+
+        trs: either a list of floating-point dictionaries, one per TR,
+        or if tr_starts is given, a single dictionary of stacked
+        (n_TR, n_events) times and values (either can also be a single
+        row shared by all the TRs), with times relative to tr_starts
+
+        tr_starts: array of TR start times (us)"""
+        if tr_starts is None:
+            keys = {}
+            for d in trs:
+                for key, (times, vals) in d.items():
+                    keys.setdefault(key, []).append( (np.ravel(times), np.ravel(vals)) )
+        else:
+            tr_starts = np.asarray(tr_starts)[:, np.newaxis]
+            keys = {}
+            for key, (times, vals) in trs.items():
+                times, vals = np.broadcast_arrays(tr_starts + np.asarray(times), np.asarray(vals))
+                keys[key] = list(zip(times, vals))
+
+        flodict, firsts = {}, {}
+        for key, rows in keys.items():
+            flodict[key] = ( np.concatenate([t for t, v in rows]), np.concatenate([v for t, v in rows]) )
+            f = np.zeros(flodict[key][0].size, dtype=bool)
+            starts = np.cumsum([0] + [t.size for t, v in rows[:-1]])
+            f[starts[starts < f.size]] = True
+            firsts[key] = f
+
+        self.add_flodict(flodict, append, tr_firsts=firsts)
+
+    def add_trs(self, template, tr_starts, append=True, **params):
+        """Add a TR for each start time (us) from a TRTemplate, with the
+        parameters given as arrays (or scalars) of one value per TR; see add_flodicts()"""
+        self.add_flodicts(template.stacked(len(tr_starts), **params), tr_starts, append)
+
     def compile(self):
         """Convert either dictionary or CSV file into machine code, with
         extra machine code at the start to ensure the system is initialised to
@@ -259,8 +443,36 @@ class Experiment:
 
         Initially, configure the RX rates and set the LEDs.
         Remainder of the sequence will be as programmed.
+
+        With incremental_compile, only the events added since the last
+        compilation are compiled, if possible.
+
+        With patch_compile, if only the values of the sequence have
+        changed since the last full compilation, they are written into
+        its machine code, if possible.
         """
 
+        profile = None
+        if self._profile_compile:
+            profile = fc.CompileProfile()
+            self._compile_profile = profile
+
+        if self._compile_state is not None:
+            new_seq = {}
+            for k, (t, v) in self._seq.items():
+                n = self._compiled_lens.get(k, 0)
+                if len(t) > n:
+                    new_seq[k] = (t[n:], v[n:])
+            machine_code = fc.dict2bin_append(self._compile_state, new_seq, self.gradb.bin_config['latencies'], profile=profile)
+            if machine_code is not None:
+                self._machine_code = machine_code
+                self._compiled_lens = { k: len(t) for k, (t, v) in self._seq.items() }
+                self._seq_compiled = True
+                return
+
+        if profile is not None:
+            profile.start()
+
         # RX and LO configuration
         tstart = 50 # cycles before doing anything
         rx_wait = 50 # cycles to run RX before setting rate, then later resetting again
@@ -277,11 +489,7 @@ class Experiment:
                        }
 
         # Set CIC decimation rate and internal shift, if necessary, and calculate CIC scale correction
-        rx0_words, self._rx0_cic_factor = fc.cic_words(self._rx_divs[0], self._set_cic_shift)
-        rx1_words, self._rx1_cic_factor = fc.cic_words(self._rx_divs[1], self._set_cic_shift)
-        if not self._fix_cic_scale: # clear the correction factor
-            self._rx0_cic_factor = 1
-            self._rx1_cic_factor = 1
+        rx0_words, rx1_words = self._cic_words()
         rx0r_st = tstart + rx_wait
         wds = len(rx0_words)
         ar0 = np.arange(wds, dtype=int)
@@ -309,6 +517,8 @@ class Experiment:
             # find max time used in system
             ultimate_time = 0
             for k in self._seq:
+                if k == 'leds' and not self._allow_user_init_cfg:
+                    continue # scan from an earlier compile(), which is about to be replaced
                 loc_last_time = self._seq[k][0][-1]
                 if loc_last_time > ultimate_time:
                     ultimate_time = loc_last_time
@@ -322,10 +532,32 @@ class Experiment:
         # do not clear relevant dictionary values if user-defined configuration of init parameters at runtime is allowed
         self.add_intdict(initial_cfg, append=self._allow_user_init_cfg)
 
-        self._machine_code = np.array( fc.dict2bin(self._seq,
+        if profile is not None:
+            profile.lap('initial_cfg')
+        if self._patch_template is not None:
+            machine_code = fc.dict2bin_patch(self._patch_template, self._seq,
                                              self.gradb.bin_config['initial_bufs'],
-                                             self.gradb.bin_config['latencies'], # TODO: can add extra manipulation here, e.g. add to another array etc
-                                             ), dtype=np.uint32 )
+                                             self.gradb.bin_config['latencies'], profile=profile)
+            if machine_code is not None:
+                self._machine_code = machine_code
+                self._compile_state = None # holds the unpatched program, so the next compile() starts from scratch
+                self._seq_compiled = True
+                return
+
+        if self._incremental_compile:
+            self._compile_state = fc.CompileState()
+            self._compiled_lens = { k: len(t) for k, (t, v) in self._seq.items() }
+
+        self._machine_code = fc.dict2bin(self._seq,
+                                         self.gradb.bin_config['initial_bufs'],
+                                         self.gradb.bin_config['latencies'], # TODO: can add extra manipulation here, e.g. add to another array etc
+                                         cache=self._compile_cache, state=self._compile_state,
+                                         processes=self._compile_processes, profile=profile,
+                                         opt_level=self._compile_opt_level)
+        if self._patch_compile:
+            self._patch_template = fc.PatchTemplate(self._seq, self._machine_code,
+                                                    self.gradb.bin_config['initial_bufs'],
+                                                    self.gradb.bin_config['latencies'])
 
         self._seq_compiled = True
 
@@ -436,42 +668,232 @@ class Experiment:
     def run(self):
         """ compile the TX and grad data, send everything over.
         Returns the resultant data """
-
+        return self.run_async().result() # in turn with any other runs started on the same connection
+
+    def run_async(self):
+        """Same as run(), but returns a concurrent.futures.Future of its
+        result as soon as the sequence is compiled (and checked, with
+        check_seq). The sequence is run and its RX data is converted in
+        a background thread, so that meanwhile the caller can compile
+        the next sequence or process earlier results; use
+        asyncio.wrap_future() to await it in a coroutine.
+
+        Runs on the same server connection are done one at a time, in
+        the order they were started; wait for them to finish before
+        sending other commands to the server over the connection."""
+        return run_executor(self._s).submit(self._run_programs, *self._prepare_run())
+
+    def _prepare_run(self):
+        """ Compile the sequence if needed, and return the programs to run and the RX scaling factors """
         if not self._seq_compiled:
             self.compile()
 
-        if self._flush_old_rx:
-            rx_data_old, _ = sc.command({'read_rx': 0}, self._s)
-            # TODO: do something with RX data previously collected by the server
-
-        rx_data, msgs = sc.command({'run_seq': self._machine_code.tobytes()}, self._s)
-
-        rxd = rx_data[4]['run_seq']
-        rxd_iq = {}
+        programs = [self._machine_code]
+        if self._split_seq is not None:
+            programs = fc.split_program(self._machine_code, self._max_seq_words,
+                                        int(np.round(self._split_seq * fpga_clk_freq_MHz)))
+
+        if self._check_seq:
+            sas = [ maremu.analyse(p, fpga_clk_freq_MHz) for p in programs ]
+            words = max(sa['words'] for sa in sas)
+            assert words <= self._max_seq_words, \
+                "Sequence has {:d} instructions, more than the limit of {:d}".format(words, self._max_seq_words)
+            duration_us = sum(sa['duration_us'] for sa in sas)
+            assert self._max_seq_duration is None or duration_us <= self._max_seq_duration, \
+                "Sequence runs for {:.1f} us, longer than the limit of {:.1f} us".format(duration_us, self._max_seq_duration)
+            for sa in sas:
+                assert sa['grad_overruns'] == 0, \
+                    "{:d} gradient updates are too close together (up to {:.3f} MSPS); increase grad_max_update_rate".format(sa['grad_overruns'], sa['grad_max_rate'])
 
         # (1 << 24) just for the int->float conversion to be reasonable - exact value doesn't matter for now
         rx0_norm_factor = self._rx0_cic_factor / (1 << 24)
         rx1_norm_factor = self._rx0_cic_factor / (1 << 24)
+        return programs, rx0_norm_factor, rx1_norm_factor
 
-        try:
-            rxd_iq['rx0'] = rx0_norm_factor * ( np.array(rxd['rx0_i']).astype(np.int32).astype(float) + \
-                             1j * np.array(rxd['rx0_q']).astype(np.int32).astype(float) )
-        except (KeyError, TypeError):
-            pass
-
-        try:
-            rxd_iq['rx1'] = rx1_norm_factor * ( np.array(rxd['rx1_i']).astype(np.int32).astype(float) + \
-                             1j * np.array(rxd['rx1_q']).astype(np.int32).astype(float) )
-        except (KeyError, TypeError):
-            pass
+    def _run_programs(self, programs, rx0_norm_factor, rx1_norm_factor):
+        """ Run the programs one after another, and return their RX data and server messages """
+        if self._flush_old_rx:
+            rx_data_old, _ = sc.command({'read_rx': 0}, self._s)
+            # TODO: do something with RX data previously collected by the server
 
-        return rxd_iq, msgs
+        # run the parts of a split sequence one after another
+        replies = [ sc.command({'run_seq': prog.tobytes()}, self._s) for prog in programs ]
+        return rx_iq(*join_run_replies(replies), rx0_norm_factor, rx1_norm_factor)
 
     def close_server(self, only_if_sim=False):
         ## Either always close server, or only close server if it's a simulation
         if not only_if_sim or sc.command({'are_you_real':0}, self._s)[0][4]['are_you_real'] == "simulation":
             sc.send_packet(sc.construct_packet({}, 0, command=sc.close_server_pkt), self._s)
 
+def join_run_replies(replies):
+    """ RX data and server messages of the parts of a split sequence, from the replies to their run_seq commands """
+    rx_data, msgs = replies[0]
+    rxd = rx_data[4]['run_seq']
+
+    # append the RX data and server messages of the rest of the parts
+    for rx_data, part_msgs in replies[1:]:
+        for k, v in rx_data[4]['run_seq'].items():
+            rxd[k] = list(rxd.get(k, [])) + list(v)
+        for k, v in part_msgs.items():
+            msgs[k] = msgs.get(k, []) + v
+    return rxd, msgs
+
+def rx_iq(rxd, msgs, rx0_norm_factor, rx1_norm_factor):
+    """ Convert the RX data returned by the server into scaled complex arrays """
+    rxd_iq = {}
+
+    try:
+        rxd_iq['rx0'] = rx0_norm_factor * ( np.array(rxd['rx0_i']).astype(np.int32).astype(float) + \
+                         1j * np.array(rxd['rx0_q']).astype(np.int32).astype(float) )
+    except (KeyError, TypeError):
+        pass
+
+    try:
+        rxd_iq['rx1'] = rx1_norm_factor * ( np.array(rxd['rx1_i']).astype(np.int32).astype(float) + \
+                         1j * np.array(rxd['rx1_q']).astype(np.int32).astype(float) )
+    except (KeyError, TypeError):
+        pass
+
+    return rxd_iq, msgs
+
+class RunQueue:
+    """Runs Experiments, or programs (uint32 machine code arrays), back
+    to back over one server connection. A background thread compiles
+    the next sequences and sends their commands while the current one
+    is running, so that the server can start each sequence as soon as
+    the previous one finishes, without waiting for the client.
+
+    prev_socket: previously-opened socket, such as that of an
+    Experiment; a new connection is opened if None
+
+    depth: the most sequences whose results haven't been read back yet
+
+    Don't send other commands over the connection while run() is in use.
+    """
+
+    def __init__(self, prev_socket=None, depth=2):
+        self._close_socket = True
+        if prev_socket is None:
+            self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._s.connect( (ip_address, port) )
+        else:
+            self._s = prev_socket
+            self._close_socket = False # do not close previous socket
+        self._depth = depth
+
+    def __del__(self):
+        if self._close_socket:
+            self._s.close()
+
+    def run(self, items):
+        """Run each of items in order; a generator of their results as
+        they finish, the same as from Experiment.run(), or for programs
+        the raw RX data and server messages. Experiments are compiled
+        if needed."""
+
+        pipe = sc.Pipeline(self._s)
+        jobs = queue.Queue() # number of replies to read for each item, and how to convert its RX data
+        slots = threading.Semaphore(self._depth)
+        stop = threading.Event()
+
+        def send():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        return
+                    if isinstance(item, Experiment):
+                        programs, *norm = item._prepare_run()
+                        flush = [{'read_rx': 0}] if item._flush_old_rx else []
+                    else:
+                        programs, norm, flush = [np.asarray(item, dtype=np.uint32)], None, []
+                    cmds = flush + [ {'run_seq': prog.tobytes()} for prog in programs ]
+                    slots.acquire()
+                    if stop.is_set():
+                        return
+                    jobs.put( (len(flush), len(cmds), norm) )
+                    for c in cmds:
+                        pipe.send(c)
+                jobs.put(None)
+            except BaseException as e:
+                jobs.put(e)
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                if isinstance(job, BaseException):
+                    raise job
+                skip, n, norm = job
+                replies = [ pipe.reply() for k in range(n) ][skip:]
+                slots.release()
+                rxd, msgs = join_run_replies(replies)
+                yield (rx_iq(rxd, msgs, *norm) if norm else (rxd, msgs))
+        except GeneratorExit:
+            # stopped early: read the replies to the commands already sent, so that the connection can still be used
+            stop.set()
+            slots.release()
+            sender.join()
+            while not jobs.empty():
+                job = jobs.get()
+                if isinstance(job, tuple):
+                    for k in range(job[1]):
+                        pipe.reply()
+            raise
+
+class TRTemplate:
+    """Floating-point dictionary of the events of a single TR (times
+    relative to its start), with named parameters that scale some of
+    its values, for adding many TRs to an Experiment at once with
+    add_trs(). For example, a phase-encoding gradient trapezoid
+    scaled by a different amplitude in each TR:
+
+    tpl = TRTemplate({'grad_vy': (t, np.array([0, 0.5, 1, 1, 0.5, 0]))}, {'pamp': ('grad_vy', slice(None))})
+    expt.add_trs(tpl, tr_starts, pamp=np.linspace(-0.3, 0.3, 64))
+
+    params: dictionary of {name: (key, event indices)}, or lists of
+    these for parameters that scale several keys; complex parameters
+    can set the phase of TX values
+    """
+
+    def __init__(self, flodict, params=None):
+        params = {} if params is None else params
+        self.flodict = { k: (np.asarray(t), np.asarray(v)) for k, (t, v) in flodict.items() }
+        self.params = {}
+        for name, bindings in params.items():
+            if isinstance(bindings, tuple):
+                bindings = [bindings]
+            for key, idces in bindings:
+                assert key in self.flodict, "Parameter {:s} is bound to an unknown key {:s}".format(name, key)
+                n = self.flodict[key][1].size
+                if not isinstance(idces, slice):
+                    ia = np.asarray(idces)
+                    if ia.dtype == bool:
+                        assert ia.shape == (n,), "Parameter {:s} has a mask of {:d} events for key {:s}, which has {:d}".format(name, ia.size, key, n)
+                    else:
+                        bad = ia[(ia < -n) | (ia >= n)]
+                        assert bad.size == 0, "Parameter {:s} has index {:d} out of range for key {:s}, which has {:d} events".format(name, int(bad.flat[0]), key, n)
+            self.params[name] = bindings
+
+    def stacked(self, n, **params):
+        """ Stacked (n, n_events) values for n TRs, scaled by the parameter arrays; keys without parameters keep a single row """
+        assert set(params) == set(self.params), "Parameters needed: " + ", ".join(self.params)
+        sd = dict(self.flodict)
+        for name, bindings in self.params.items():
+            p = np.broadcast_to(params[name], (n,))
+            for key, idces in bindings:
+                t, v = sd[key]
+                if v.ndim == 1: # first parameter of this key
+                    v = np.repeat(v[np.newaxis, :].astype(np.result_type(v, p)), n, axis=0)
+                elif v.dtype != np.result_type(v, p):
+                    v = v.astype(np.result_type(v, p))
+                sel = v[:, idces]
+                v[:, idces] = sel * p.reshape((n,) + (1,) * (sel.ndim - 1))
+                sd[key] = (t, v)
+        return sd
+
 def test_rx_scaling(lo_freq=0.5, rf_amp=0.5, rf_steps=True, rx_time=50, rx_periods=[600], rx_padding=20, plot_rx=False):
 
     expt = Experiment(lo_freq=lo_freq, rx_t=rx_periods[0] / fpga_clk_freq_MHz,
@@ -0,0 +1,5 @@
+ip_address = "localhost"
+port = 11111
+fpga_clk_freq_MHz = 122.88
+grad_board = "gpa-fhdo"
+gpa_fhdo_current_per_volt = 2.5
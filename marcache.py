@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# Persistent on-disk cache of compiled marga programs, shared between
+# processes. Entries are keyed by a hash of everything that determines
+# the machine code, so the same sequence is only compiled once.
+
+import os, time, json, hashlib, tempfile
+import numpy as np
+
+import marcompile as mc
+
+default_cache_path = os.path.join(os.path.expanduser("~"), ".cache", "marcos_client")
+
+class CompileCache:
+    """On-disk cache of machine code produced by marcompile.dict2bin().
+
+    path: directory to store the cache entries in; created if needed.
+
+    max_bytes: maximum total size of the cache entries; when it is
+    exceeded, the least-recently used entries are removed.
+
+    The key of each entry is a hash of the integer sequence dictionary
+    (in its key order, since that can affect the machine code),
+    initial_bufs, latencies, the gradient board, the optimisation level
+    and the compiler version. Cached programs do not repeat any warnings that were
+    raised when they were first compiled.
+
+    hits, misses and evictions count the cache events of this object.
+    """
+
+    def __init__(self, path=default_cache_path, max_bytes=256 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def key(self, sd, initial_bufs, latencies, board=None, opt_level=0):
+        """ Hash of the compiler inputs, as a hex string """
+        if board is None:
+            board = mc.grad_board
+
+        h = hashlib.sha256()
+        h.update(json.dumps([mc.compiler_version, board, mc.COUNTER_MAX, opt_level]).encode())
+        h.update(np.ascontiguousarray(initial_bufs, dtype=np.int64).tobytes())
+        h.update(np.ascontiguousarray(latencies, dtype=np.int64).tobytes())
+        for name, (times, vals) in sd.items():
+            times = np.ascontiguousarray(times, dtype=np.int64)
+            h.update(json.dumps([name, times.size]).encode())
+            h.update(times.tobytes())
+            h.update(np.ascontiguousarray(vals, dtype=np.int64).tobytes())
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def lookup(self, key):
+        """ Returns (machine code, metadata dict) if key is in the cache, otherwise None """
+        ep = self._entry_path(key)
+        try:
+            with np.load(ep) as npz:
+                machine_code = npz['machine_code']
+                meta = json.loads(str(npz['meta']))
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            # missing, or removed/being replaced by another process
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(ep) # mark as recently used
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return machine_code, meta
+
+    def store(self, key, machine_code, meta={}):
+        """ Store machine code and a metadata dict under key, then evict old entries if necessary """
+        meta = dict(meta, compiler_version=mc.compiler_version, words=int(machine_code.size), created=time.time())
+
+        # write to a temporary file first, so that other processes never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, machine_code=np.asarray(machine_code, dtype=np.uint32), meta=np.array(json.dumps(meta)))
+            os.replace(tmp_path, self._entry_path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """ Remove least-recently used entries until the cache fits into max_bytes """
+        entries = []
+        for de in os.scandir(self.path):
+            if de.name.endswith(".npz"):
+                try:
+                    st = de.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append( (st.st_mtime, st.st_size, de.path) )
+
+        total = sum(e[1] for e in entries)
+        for _, size, ep in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(ep)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for de in os.scandir(self.path):
+            if de.name.endswith(".npz"):
+                os.remove(de.path)
+
+    def dict2bin(self, sd, initial_bufs=np.zeros(mc.MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(mc.MARGA_BUFS, dtype=np.int32), processes=None, profile=None, opt_level=0):
+        """ Same as marcompile.dict2bin(), but reuses cached machine code where possible """
+        if profile is not None:
+            profile.start()
+        board = mc.grad_board
+        key = self.key(sd, initial_bufs, latencies, board, opt_level)
+        entry = self.lookup(key)
+        if profile is not None:
+            profile.lap('cache', cache_hits=entry is not None)
+        if entry is not None:
+            return entry[0]
+
+        t0 = time.perf_counter()
+        machine_code = mc.dict2bin(sd, initial_bufs, latencies, processes=processes, profile=profile, opt_level=opt_level)
+        self.store(key, machine_code, {'grad_board': board, 'compile_time': time.perf_counter() - t0})
+        return machine_code
@@ -2,8 +2,9 @@
 # Basic CSV -> machine code compiler for marga
 
 import numpy as np
-import warnings
+import warnings, copy, time, concurrent.futures
 from marmachine import *
+import marcsv
 try:
     from local_config import grad_board
 except ModuleNotFoundError:
@@ -13,127 +14,258 @@ grad_data_bufs = (1, 2)
 
 max_removed_instructions = 1000
 
+# Maximum number of earlier writes to a buffer that may still be
+# waiting to be output when optimise() issues a write to it;
+# unoptimised programs already queue up to 3 in some of the test CSVs
+opt_queue_depth = 2
+
+# Increment whenever the machine code generated for a given input
+# changes, to invalidate compiled programs cached by marcache.py
+compiler_version = 1
+
+# Changelist entry: output time (latency-corrected), buffer index, value and value mask
+change_dtype = np.dtype([('time', np.int64), ('buf', np.uint8), ('val', np.uint16), ('mask', np.uint16)])
+
 def debug_print(*args, **kwargs):
     # print(*args, **kwargs)
     pass
 
-def col2buf(col_idx, value):
+# CSV/dictionary columns, in order
+col_arr = ['clock cycles', 'tx0_i', 'tx0_q', 'tx1_i', 'tx1_q', 'fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2',
+           'ocra1_vx', 'ocra1_vy', 'ocra1_vz', 'ocra1_vz2', 'rx0_rate', 'rx1_rate',
+           'rx0_rate_valid', 'rx1_rate_valid', 'rx0_rst_n', 'rx1_rst_n', 'rx0_en', 'rx1_en',
+           'tx_gate', 'rx_gate', 'trig_out', 'leds',
+           'lo0_freq', 'lo1_freq', 'lo2_freq', 'lo0_rst', 'lo1_rst', 'lo2_rst',
+           'rx0_lo', 'rx1_lo', ] # TODO: these two rows aren't yet in the CSV and thus aren't tested by test_marga_model.py
+
+# Column encoding kinds
+COL_NONE = 0 # not an output column
+COL_WORD = 1 # value shifted into a bit field of a single buffer
+COL_SPLIT = 2 # 32-bit value split across an LSB and an MSB buffer (LO frequencies)
+COL_GRAD = 3 # gradient DAC word for the selected grad board, split across GRAD_MSB and GRAD_LSB
+COL_GRAD_OTHER = 4 # gradient column of a board that isn't selected
+
+# Column descriptor: encoding kind, number of buffer words written,
+# and for each word its buffer and value mask. Each word is computed as
+# ( ( (value << pre_shift) | base ) >> word_shift ) << shift, truncated to 16 bits
+col_desc_dtype = np.dtype([('kind', np.uint8), ('words', np.uint8), ('buf', np.uint8, 2),
+                           ('pre_shift', np.uint8), ('base', np.uint32),
+                           ('word_shift', np.uint8, 2), ('shift', np.uint8, 2), ('mask', np.uint16, 2)])
+
+col_tables = {} # cache of column descriptor tables for each grad board
+
+def col_table(board):
+    """Column descriptor table (one entry per column in col_arr) for a
+    gradient board; tables are only built once per board."""
+    try:
+        return col_tables[board]
+    except KeyError:
+        pass
+
+    ct = np.zeros(len(col_arr), dtype=col_desc_dtype)
+
+    def word(col_idx, buf, shift=0, mask=0xffff):
+        ct[col_idx] = COL_WORD, 1, (buf, 0), 0, 0, (0, 0), (shift, 0), (mask, 0)
+
+    for k in range(4): # TX
+        word(1 + k, TX0_I + k)
+
+    # Grad: only encode value and channel into words here. Precise
+    # timing and broadcast logic will be handled at the next stage
+    for k in range(4):
+        fhdo_col, ocra1_col = 5 + k, 9 + k
+        ct[fhdo_col]['kind'] = COL_GRAD_OTHER
+        ct[ocra1_col]['kind'] = COL_GRAD_OTHER
+        if board == "gpa-fhdo":
+            ct[fhdo_col] = COL_GRAD, 2, (GRAD_MSB, GRAD_LSB), 0, 0x80000 | (k << 16) | (k << 25), (16, 0), (0, 0), (0xffff, 0xffff)
+        elif board == "ocra1":
+            # always broadcast by default
+            ct[ocra1_col] = COL_GRAD, 2, (GRAD_MSB, GRAD_LSB), 2, 0x00100000 | (k << 25) | 0x01000000, (16, 0), (0, 0), (0xffff, 0xffff)
+
+    for k in range(2):
+        word(13 + k, RX0_RATE + k) # RX rate
+        word(15 + k, RX_CTRL, 4 + k, 0x1 << (4 + k)) # RX rate valid
+        word(17 + k, RX_CTRL, 6 + k, 0x1 << (6 + k)) # RX resets, active low
+        word(19 + k, RX_CTRL, 8 + k, 0x1 << (8 + k)) # RX enables
+        word(31 + k, RX_CTRL, 2 * k, 0x3 << (2 * k)) # LO source for RX demodulation
+
+    for k in range(3):
+        word(21 + k, GATES_LEDS, k, 0x1 << k) # TX/RX gates, external trig
+        lo_lsb_buf = DDS0_PHASE_LSB + 2 * k
+        # LO freqs: DDS[0,1,2]_PHASE_LSB, DDS[0,1,2]_PHASE_MSB
+        ct[25 + k] = COL_SPLIT, 2, (lo_lsb_buf, lo_lsb_buf + 1), 0, 0, (0, 16), (0, 0), (0xffff, 0x7fff)
+        word(28 + k, lo_lsb_buf + 1, 15, 0x8000) # LO phase reset
+
+    word(24, GATES_LEDS, 8, 0xff00) # LEDs
+
+    col_tables[board] = ct
+    return ct
+
+def col_encode(col_idces, values, board=None):
+    """Encode values for the given column indices (arrays of the same
+    shape, or scalars) into buffer words, using the column descriptor
+    table of the gradient board (by default the selected grad_board).
+
+    Returns (words, bufs, vals, masks): the number of buffer words each
+    value is written to (1 or 2), then the buffer indices, 16-bit values
+    and value masks of each word, each with an extra leading axis of
+    length 2 (only the first entry is relevant for single-word columns)."""
+    if board is None:
+        board = grad_board
+    col_idces, values = np.broadcast_arrays(col_idces, np.asarray(values, dtype=np.int64))
+    d = col_table(board)[col_idces]
+
+    kind = d['kind']
+    if np.any(kind == COL_NONE):
+        raise ValueError("Unknown column")
+    if np.any(kind == COL_GRAD_OTHER):
+        if board == "gpa-fhdo":
+            raise RuntimeError("GPA-FHDO is selected, but you are trying to control OCRA1")
+        elif board == "ocra1":
+            raise RuntimeError("OCRA1 is selected, but you are trying to control GPA-FHDO")
+        else:
+            raise ValueError("Unknown grad board")
+
+    full = (values << d['pre_shift']) | d['base']
+    word_axis = lambda a: np.moveaxis(a, -1, 0)
+    vals = ( (full >> word_axis(d['word_shift'])) << word_axis(d['shift']) ).astype(np.uint16)
+    return d['words'], word_axis(d['buf']), vals, word_axis(d['mask'])
+
+def col2buf(col_idx, value, board=None):
     """ Returns a tuple of (buffer indices), (values), (value masks)
     Value masks specify which bits are actually relevant on the output.
     Can accept arrays of values."""
-    if col_idx in (1, 2, 3, 4): # TX
-        buf_idx = col_idx + 4, # TX0_I, TX0_Q, TX1_I, TX1_Q
-        val = value,
-        mask = 0xffff,
-    elif col_idx in (5, 6, 7, 8, 9, 10, 11, 12): # grad
-        # Only encode value and channel into words here.  Precise
-        # timing and broadcast logic will be handled at the next stage
-        if grad_board == "gpa-fhdo":
-            if col_idx in (9, 10, 11, 12):
-                raise RuntimeError("GPA-FHDO is selected, but you are trying to control OCRA1")
-            grad_chan = col_idx - 5
-            val_full = value | 0x80000 | ( grad_chan << 16 ) | (grad_chan << 25)
-        elif grad_board == "ocra1":
-            if col_idx in (5, 6, 7, 8):
-                raise RuntimeError("OCRA1 is selected, but you are trying to control GPA-FHDO")
-            grad_chan = col_idx - 9
-            val_full = value << 2 | 0x00100000 | (grad_chan << 25) | 0x01000000 # always broadcast by default
-        else:
-            raise ValueError("Unknown grad board")
+    if board is None:
+        board = grad_board
+    _, _, vals, _ = col_encode(col_idx, value, board)
+    desc = col_table(board)[col_idx]
+    n = desc['words']
+    return np.uint16(desc['buf'][:n]), vals[:n], np.uint16(desc['mask'][:n])
+
+def cl_array(changes):
+    """Convert a list of (time, buffer, value, mask) tuples, or a list
+    of changelist arrays, into a single changelist array."""
+    if isinstance(changes, np.ndarray):
+        return changes.astype(change_dtype, copy=False)
+    if len(changes) == 0:
+        return np.zeros(0, dtype=change_dtype)
+    if isinstance(changes[0], np.ndarray):
+        return np.concatenate(changes).astype(change_dtype, copy=False)
+    return np.array([tuple(c) for c in changes], dtype=change_dtype)
+
+def csv_changes(data, prev_row=None, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """ Changelist of the output changes in a block of CSV rows (as uint32), each row compared with the one before it.
+    prev_row: last row of the previous block; if None, the first row is the initial state and produces no changes
+    """
+    if prev_row is not None:
+        data = np.vstack([prev_row, data])
 
-        buf_idx = 2, 1 # GRAD_MSB, GRAD_LSB
-        val = val_full >> 16, val_full & 0xffff
-        mask = 0xffff, 0xffff
-    elif col_idx in (13, 14): # RX rate
-        buf_idx = col_idx - 10, # RX0_RATE, RX1_RATE
-        val = value,
-        mask = 0xffff,
-    elif col_idx in (15, 16): # RX rate valid
-        buf_idx = 16, # RX_CTRL
-        bit_idx = col_idx - 15
-        val = value << (4 + bit_idx),
-        mask = 0x1 << (4 + bit_idx),
-    elif col_idx in (17, 18): # RX resets, active low
-        buf_idx = 16, # RX_CTRL
-        bit_idx = col_idx - 17
-        val = value << (6 + bit_idx),
-        mask = 0x1 << (6 + bit_idx),
-    elif col_idx in (19, 20): # RX resets, active low
-        buf_idx = 16, # RX_CTRL
-        bit_idx = col_idx - 19
-        val = value << (8 + bit_idx),
-        mask = 0x1 << (8 + bit_idx),
-    elif col_idx in (21, 22, 23): # TX/RX gates, external trig
-        buf_idx = 15, # GATES_LEDS
-        bit_idx = col_idx - 21
-        val = value << bit_idx,
-        mask = 0x1 << bit_idx,
-    elif col_idx == 24: # LEDs
-        buf_idx = 15, # GATES_LEDS
-        val = value << 8,
-        mask = 0xff00,
-    elif col_idx in (25, 26, 27): # LO freqs
-        lo_lsb_buf = 9 + 2*(col_idx - 25) # 9, 11 or 13
-        buf_idx = lo_lsb_buf, lo_lsb_buf + 1 # DDS[0,1,2]_PHASE_LSB, DDS[0,1,2]_PHASE_MSB
-        val = value & 0xffff, value >> 16
-        mask = 0xffff, 0x7fff
-    elif col_idx in (28, 29, 30): # LO phase reset
-        lo_msb_buf = 10 + 2*(col_idx - 28) # DDS[0,1,2]_PHASE_MSB
-        buf_idx = lo_msb_buf,
-        val = value << 15,
-        mask = 0x8000,
-    elif col_idx in (31, 32): # LO source for RX demodulation
-        buf_idx = 16, # RX_CTRL
-        bit_idx = (col_idx - 31) * 2
-        val = value << bit_idx,
-        mask = 0x0003 << bit_idx,
-
-    return np.uint16(buf_idx), np.uint16(val), np.uint16(mask)
-
-def csv2bin(path, quick_start=False, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies = np.zeros(MARGA_BUFS, dtype=np.int32)):
+    # Find every (row, column) change in one pass, comparing data offset by one row in time
+    rows, col_idces = np.nonzero(data[:-1,1:] != data[1:,1:])
+    rows += 1
+    col_idces += 1
+
+    words, bufs, vals, masks = col_encode(col_idces, data[rows, col_idces])
+
+    # lay out the buffer words of all the changes in row-major order,
+    # and for two-word columns MSB/LSB in the order given by the table
+    two_words = words == 2
+    addr = np.arange(words.size) + np.cumsum(two_words) - two_words
+    changes = np.empty(words.size + np.count_nonzero(two_words), dtype=change_dtype)
+    for w, sel, a in ( (0, slice(None), addr), (1, two_words, addr[two_words] + 1) ):
+        changes['time'][a] = data[rows[sel], 0].astype(np.int64) - latencies[bufs[w][sel]]
+        changes['buf'][a] = bufs[w][sel]
+        changes['val'][a] = vals[w][sel]
+        changes['mask'][a] = masks[w][sel]
+    return changes
+
+def csv2bin(path, quick_start=False, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies = np.zeros(MARGA_BUFS, dtype=np.int32),
+            chunk_rows=None):
     """ initial_bufs: starting state of output buffers, to track with instructions
     quick_start: strip out the initial RAM-writing dead time if the CSV was generated by the simulator or similar
     latencies: inherent buffer latencies to take into
     account. Latencies are primarily relevant to the gradients, but
     can be adjusted to suit various other external hardware effects
     like slow RF amps, very long cables etc
+    chunk_rows: if set, stream the file in blocks of this many rows
+    instead of loading it whole, so that memory use depends on the
+    number of output changes rather than on the length of the file
     """
 
     # Input: CSV column, starting from 0 for tx0 i and ending with 21 for leds
     # Output: corresponding buffer index or indices to change
 
-    data = np.loadtxt(path, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
-    with open(path, 'r') as csvf:
-        cols = csvf.readline().strip().split(',')[1:]
+    if chunk_rows is None:
+        data = marcsv.load(path).astype(np.uint32) # uses the columnar copy of the CSV file if there is one
+
+        if quick_start:
+            # remove dead time in the beginning taken up by simulated memory writes, if the input CSV is generated from the simulator
+            # data[1:, 0] = data[1:, 0] - data[1, 0] + latencies.max()
+            data[1:, 0] = data[1:, 0] - data[1, 0] + 10
+
+        changes = csv_changes(data, latencies=latencies)
+    else:
+        _, chunks = marcsv.iter_chunks(path, chunk_rows)
+        cls, prev_row, row, t1 = [], None, 0, None
+        for data in chunks:
+            data = data.astype(np.uint32)
+            if quick_start:
+                # same time shift as above, starting from the second row of the file
+                if t1 is None and row + data.shape[0] > 1:
+                    t1 = data[1 - row, 0]
+                if t1 is not None:
+                    data[max(1 - row, 0):, 0] = data[max(1 - row, 0):, 0] - t1 + 10
+            cls.append( csv_changes(data, prev_row, latencies) )
+            prev_row, row = data[-1], row + data.shape[0]
+        changes = np.concatenate(cls) if cls else np.zeros(0, dtype=change_dtype)
+
+    grad = np.isin(changes['buf'], grad_data_bufs)
+    return cl2bin(changes[~grad], changes[grad], initial_bufs)
 
-    assert cols[-1] == ' csv_version_0.2', "Wrong CSV format"
+def dict2cl(sd, latencies=np.zeros(MARGA_BUFS, dtype=np.int32), sources=False):
+    """Convert a sequence dictionary (see dict2bin()) into the
+    changelist and the grad changelist for cl2bin().
 
-    if quick_start:
-        # remove dead time in the beginning taken up by simulated memory writes, if the input CSV is generated from the simulator
-        # data[1:, 0] = data[1:, 0] - data[1, 0] + latencies.max()
-        data[1:, 0] = data[1:, 0] - data[1, 0] + 10
+    sources: also return the index of each change of the changelist
+    followed by the grad changelist in the buffer words of the values
+    of sd, taken key by key and word by word (see dict2bin_patch())"""
 
-    # Boolean: compare data offset by one row in time
-    data_diff = data[:-1,1:] != data[1:,1:]
+    board = grad_board
+    ct = col_table(board)
 
     changelist = []
     changelist_grad = []
+    src, src_grad, word_idx = [np.zeros(0, dtype=np.intp)], [], 0
 
-    for k, dd in enumerate(data_diff):
-        clocktime = data[k + 1, 0]
-        dw = np.where(dd)[0] # indices where data changed
-        for col_idx, value in zip(dw + 1, data[k + 1][dw + 1]):
-            buf_idces, vals, masks = col2buf(col_idx, value)
-            for bi, v, m in zip(buf_idces, vals, masks):
-                change = clocktime - latencies[bi], bi, v, m
-                if bi in grad_data_bufs:
-                    changelist_grad.append(change)
-                else:
-                    changelist.append(change)
-
-    return cl2bin(changelist, changelist_grad, initial_bufs)
-
-def dict2bin(sd, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies = np.zeros(MARGA_BUFS, dtype=np.int32)):
+    for k, vals in sd.items(): # iterate over dictionary keys
+        col_idx = col_arr.index(k)
+        desc = ct[col_idx]
+        _, buf_idces, values, masks = col_encode(col_idx, vals[1], board) # single element or array of values
+        t_corr = vals[0] - latencies[desc['buf'][0]]
+        changes, srcs = [], []
+        for bi, vv, m in zip(desc['buf'][:desc['words']], values, desc['mask']):
+            cl = np.empty(t_corr.size, dtype=change_dtype)
+            cl['time'], cl['buf'], cl['val'], cl['mask'] = t_corr, bi, vv, m
+            changes.append(cl)
+            srcs.append(word_idx + np.arange(t_corr.size))
+            word_idx += t_corr.size
+
+        if desc['kind'] == COL_GRAD:
+            # needed to keep coupled LSB/MSB pairs together in case
+            # multiple events occur on different channels simultaneously
+            cl = np.concatenate(changes)
+            order = np.argsort(cl['time'], kind='stable')
+            changelist_grad.append( cl[order] )
+            src_grad.append( np.concatenate(srcs)[order] )
+        else:
+            changelist += changes
+            src += srcs
+
+    if sources:
+        return cl_array(changelist), cl_array(changelist_grad), np.concatenate(src + src_grad)
+    return cl_array(changelist), cl_array(changelist_grad)
+
+def dict2bin(sd, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies = np.zeros(MARGA_BUFS, dtype=np.int32), cache=None, state=None, processes=None, profile=None, opt_level=0):
     """sd: sequence dictionary, consisting of something in the form of:
 
      {'tx0_i': ( np.array([100, 102, 304, 506]), np.array([1, 200, 65535, 20000]) ),
@@ -146,258 +278,1034 @@ def dict2bin(sd, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies =
     account. Latencies are primarily relevant to the gradients, but
     can be adjusted to suit various other external hardware effects
     like slow RF amps, very long cables etc
+
+    cache: optional marcache.CompileCache, to reuse machine code
+    compiled earlier (including by other processes) for the same inputs
+
+    state: optional CompileState to fill in, for appending later
+    events with dict2bin_append(); the cache is not used if it is supplied
+
+    processes: if not None, compile long sequences in segments in
+    parallel, using a pool of this many processes (0 for one per core);
+    see cl2bin_parallel()
+
+    profile: optional CompileProfile to record the time taken and
+    items processed by each stage
+
+    opt_level: 0 for the plain compiler output, 1 to reduce the number
+    of instructions with optimise(); the profile counts the words saved as opt_saved
     """
 
-    col_arr = ['clock cycles', 'tx0_i', 'tx0_q', 'tx1_i', 'tx1_q', 'fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2',
-               'ocra1_vx', 'ocra1_vy', 'ocra1_vz', 'ocra1_vz2', 'rx0_rate', 'rx1_rate',
-               'rx0_rate_valid', 'rx1_rate_valid', 'rx0_rst_n', 'rx1_rst_n', 'rx0_en', 'rx1_en',
-               'tx_gate', 'rx_gate', 'trig_out', 'leds',
-               'lo0_freq', 'lo1_freq', 'lo2_freq', 'lo0_rst', 'lo1_rst', 'lo2_rst',
-               'rx0_lo', 'rx1_lo', ] # TODO: these two rows aren't yet in the CSV and thus aren't tested by test_marga_model.py
+    if cache is not None and state is None:
+        return cache.dict2bin(sd, initial_bufs, latencies, processes=processes, profile=profile, opt_level=opt_level)
 
-    changelist = []
-    changelist_grad = []
+    if profile is not None:
+        profile.start()
+    changelists = dict2cl(sd, latencies)
+    if profile is not None:
+        profile.lap('dict2cl', keys=len(sd))
 
-    for k, vals in sd.items(): # iterate over dictionary keys
-        col_idx = col_arr.index(k)
-        changelist_grad_local = []
-        buf_idces, values, masks = col2buf(col_idx, vals[1]) # single element or array of values
-        t_corr = vals[0] - latencies[buf_idces[0]]
-        for bi, vv, m in zip(buf_idces, values, masks):
-            for t, v in zip(t_corr, vv):
-                change = t, bi, v, m
-                if bi in grad_data_bufs:
-                    changelist_grad_local.append(change)
-                else:
-                    changelist.append(change)
-
-        # needed to keep coupled LSB/MSB pairs together in case
-        # multiple events occur on different channels simultaneously
-        if len(changelist_grad_local) != 0:
-            changelist_grad_local.sort(key=lambda change: change[0])
-            changelist_grad += changelist_grad_local
-
-    return cl2bin(changelist, changelist_grad, initial_bufs)
+    if processes is not None:
+        return cl2bin_parallel(*changelists, initial_bufs, state=state, processes=processes or None, profile=profile, opt_level=opt_level)
+    return cl2bin(*changelists, initial_bufs, state=state, profile=profile, opt_level=opt_level)
 
-def cl2bin(changelist, changelist_grad,
-           initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16)):
+def dict2bin_append(state, sd, latencies=np.zeros(MARGA_BUFS, dtype=np.int32), profile=None):
+    """Append a sequence dictionary of later events to the program in a
+    CompileState filled in by dict2bin(); see cl2bin_append(). Returns
+    the machine code for the whole sequence, or None if it needs to be
+    recompiled from the start."""
+    if profile is not None:
+        profile.start()
+    changelists = dict2cl(sd, latencies)
+    if profile is not None:
+        profile.lap('dict2cl', keys=len(sd))
+    return cl2bin_append(state, *changelists, profile=profile)
 
-    """Central compilation function; accept in two changelists,
-    changelist for all the direct-buffer outputs (TX, most configurable
-    parameters, etc) and the other, changelist_grad, for the outputs used
-    to control hardware with non-trivial internal timing behaviour
-    (currently only the gradient boards). Also accepts non-default initial
-    values to program the buffers to."""
+class PatchTemplate:
+    """Compiled program of a sequence dictionary, recording which
+    instruction word holds the value of each buffer write and which of
+    the dictionary's values make it up, so that sequences with the same
+    event times and other values can be compiled by dict2bin_patch()
+    writing the new values into a copy of the program; for instance the
+    points of a parameter sweep.
+
+    The buffer values are tracked in slots, one for each buffer and
+    time at which it is changed: every slot's value is made up of
+    constant bits (from initial_bufs) and masked parts of the sequence
+    values (contrib_*). Slots whose values differ from those of the
+    previous slots of their buffers are written in the program.
+
+    keys, key_times: keys and event times of the sequence
+    slot_buf, slot_const, changed: buffer, constant bits and whether
+    each slot is written
+    contrib_slot, contrib_src, contrib_mask: for each part of a slot
+    value, the slot, the index of its value among the buffer words of
+    the sequence values (see dict2cl()) and its mask
+    check_a, check_b, check_mask: pairs of values that change the same
+    bits of a buffer at the same time, and must agree on them
+    write_addrs, write_slots: address and slot of each write in machine_code
+    """
+
+    def __init__(self, sd, machine_code, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16),
+                 latencies=np.zeros(MARGA_BUFS, dtype=np.int32), head_words=MARGA_BUFS):
+        self.machine_code = np.array(machine_code, dtype=np.uint32)
+        self.initial_bufs = np.array(initial_bufs, dtype=np.uint16)
+        self.latencies = np.array(latencies)
+        self.grad_board = grad_board
+        self.keys = list(sd)
+        self.key_times = [ np.array(sd[k][0]) for k in self.keys ]
+
+        changelist, changelist_grad, words = dict2cl(sd, self.latencies, sources=True)
+        st = CompileState(self.initial_bufs)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", MarGradWarning) # already issued when the program was compiled
+            cl, _, order = merge_changelists(st, changelist, changelist_grad, order=True)
+            # bits of the values kept by the grad board processing, found by processing all-ones values
+            changelist['val'], changelist_grad['val'] = 0xffff, 0xffff
+            val_masks = merge_changelists(st, changelist, changelist_grad)[0]['val']
+        src = words[order]
+
+        # group the changes by buffer and then time into slots, like cl2ol()
+        n = cl.size
+        pos = np.arange(n)
+        bo = np.argsort(cl['buf'], kind='stable')
+        t, buf, mask = cl['time'][bo], cl['buf'][bo].astype(np.intp), cl['mask'][bo]
+        buf_start = np.concatenate([[True], buf[1:] != buf[:-1]])
+        slot_start = buf_start | np.concatenate([[True], t[1:] != t[:-1]])
+        buf_first = np.maximum.accumulate(np.where(buf_start, pos, 0))
+        slot = np.cumsum(slot_start) - 1
+        slot_end = np.nonzero(np.concatenate([slot_start[1:], [True]]))[0]
+        self.slot_buf = buf[slot_end]
+        slot_time = t[slot_end]
+        self.slot_first = buf_start[slot_start] # first slot of its buffer
+
+        # each bit of a slot is set by the last change covering it up to the end of the slot, or keeps its initial value
+        self.slot_const = self.initial_bufs[self.slot_buf]
+        cs, ce, cm, ca, cb, cam = [], [], [], [], [], []
+        for bit in range(16):
+            bm = np.uint16(1 << bit)
+            covers = (mask & bm) != 0
+            if not covers.any():
+                continue
+            last = np.maximum.accumulate(np.where(covers, pos, -1))[slot_end]
+            from_change = last >= buf_first[slot_end]
+            self.slot_const[from_change] &= ~bm
+            cs.append(np.nonzero(from_change)[0])
+            ce.append(last[from_change])
+            cm.append(np.full(cs[-1].size, bm))
+            # other changes to the same bit in the same slot
+            other = np.nonzero(covers & (last[slot] != pos))[0]
+            ca.append(other)
+            cb.append(last[slot[other]])
+            cam.append(np.full(other.size, bm))
+
+        cat = lambda l, dt: np.concatenate(l) if l else np.zeros(0, dtype=dt)
+        cs, ce, cm = cat(cs, np.intp), cat(ce, np.intp), cat(cm, np.uint16)
+        so = np.lexsort((ce, cs))
+        cs, ce, cm = cs[so], ce[so], cm[so]
+        part_start = np.nonzero(np.concatenate([[True], (cs[1:] != cs[:-1]) | (ce[1:] != ce[:-1])]))[0] if cs.size else pos[:0]
+        self.contrib_slot = cs[part_start]
+        self.contrib_src = src[bo[ce[part_start]]]
+        self.contrib_mask = np.bitwise_or.reduceat(cm, part_start) & val_masks[bo[ce[part_start]]] if cs.size else cm
+        ca, cb, cam = cat(ca, np.intp), cat(cb, np.intp), cat(cam, np.uint16)
+        self.check_a, self.check_b = src[bo[ca]], src[bo[cb]]
+        self.check_mask = cam & val_masks[bo[ca]] & val_masks[bo[cb]]
+
+        slot_vals = self.slot_values(self.values(sd)[1])
+        self.changed = slot_vals != self.prev_values(slot_vals)
+
+        # writes are in timestep and then buffer order, which they keep in the program at every opt_level
+        ws = np.nonzero(self.changed)[0]
+        self.write_slots = ws[np.lexsort((self.slot_buf[ws], slot_time[ws]))]
+        instrs = disassemble(self.machine_code[head_words:-1])
+        self.write_addrs = np.nonzero(instrs['op'] == IDATA)[0] + head_words
+        assert self.write_addrs.size == self.write_slots.size \
+            and np.all(instrs['tgt'][self.write_addrs - head_words] == self.slot_buf[self.write_slots]), \
+            "Machine code wasn't compiled from this sequence"
+
+    def values(self, sd):
+        """ Buffer words of the values of a sequence dictionary in the order of dict2cl(); (False, None) if its keys or times differ """
+        if len(sd) != len(self.keys):
+            return False, None
+        board = self.grad_board
+        ct = col_table(board)
+        words = [np.zeros(0, dtype=np.uint16)]
+        for k, t in zip(self.keys, self.key_times):
+            if k not in sd or not np.array_equal(sd[k][0], t):
+                return False, None
+            col_idx = col_arr.index(k)
+            _, _, values, _ = col_encode(col_idx, sd[k][1], board)
+            words += [ np.broadcast_to(values[w], t.shape).ravel() for w in range(ct[col_idx]['words']) ]
+        return True, np.concatenate(words)
+
+    def slot_values(self, words):
+        parts = (words[self.contrib_src] & self.contrib_mask).astype(np.float64) # disjoint bits, so adding them is exact
+        return self.slot_const + np.bincount(self.contrib_slot, parts, minlength=self.slot_buf.size).astype(np.uint16)
+
+    def prev_values(self, slot_vals):
+        """ Value of each buffer before each of its slots """
+        return np.where(self.slot_first, self.initial_bufs[self.slot_buf], np.concatenate([[0], slot_vals[:-1]]).astype(np.uint16))
+
+def dict2bin_patch(template, sd, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16),
+                   latencies=np.zeros(MARGA_BUFS, dtype=np.int32), profile=None):
+    """Compile a sequence dictionary by writing its values into a copy
+    of the program in a PatchTemplate, without laying out the
+    instructions again. This works if the sequence has the same keys
+    and event times as the template, and each of its changes has an
+    effect exactly where it did in the template (a value equal to the
+    previous one on a channel is normally removed, changing the
+    program); the result is then the same as from dict2bin().
+
+    Returns None if the sequence needs to be compiled in full, or if
+    initial_bufs, latencies or grad_board aren't the same as for the
+    template. Removed-instruction warnings aren't repeated."""
+
+    if template.grad_board != grad_board or not np.array_equal(template.initial_bufs, initial_bufs) \
+       or not np.array_equal(template.latencies, latencies):
+        return None
+
+    if profile is not None:
+        profile.start()
+    same, words = template.values(sd)
+    if not same:
+        return None
+    if profile is not None:
+        profile.lap('dict2cl', keys=len(sd))
+
+    if np.any( (words[template.check_a] ^ words[template.check_b]) & template.check_mask ):
+        return None # needs cl2ol() to resolve, or is an error
+    slot_vals = template.slot_values(words)
+    if not np.array_equal(slot_vals != template.prev_values(slot_vals), template.changed):
+        return None
+
+    bdata = template.machine_code.copy()
+    bdata[template.write_addrs] = (bdata[template.write_addrs] & np.uint32(0xffff0000)) | slot_vals[template.write_slots]
+    if profile is not None:
+        profile.lap('patch', instructions=template.write_addrs.size)
+        profile.add_counts({'words': bdata.size})
+    return bdata
+
+def patch_cols(program, col_vals, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), head_words=MARGA_BUFS):
+    """Change the values of columns in a program, where each column is
+    set by a single event which is the first change to each of its
+    buffers, such as the LO frequencies (DDS phase steps) configured at
+    the start of a sequence; col_vals is a dictionary of {column name:
+    value}. The column's bits are rewritten in every write to its
+    buffers after the head words, without recompiling.
+
+    Returns the new program, or None if the writes to the buffers might
+    change, i.e. if the column's bits in the first write to one of its
+    buffers or in the new value are the same as in initial_bufs."""
+
+    program = np.array(program, dtype=np.uint32)
+    top = program[head_words:] >> 24
+    for col, value in col_vals.items():
+        words, bufs, vals, masks = col_encode(col_arr.index(col), value)
+        for b, v, m in zip(bufs[:words], vals[:words], masks[:words]):
+            addrs = np.nonzero(top == (IDATA | b))[0] + head_words
+            init = initial_bufs[b] & m
+            if addrs.size == 0 or program[addrs[0]] & m == init or v & m == init:
+                return None
+            program[addrs] = (program[addrs] & ~np.uint32(m)) | (v & m)
+    return program
+
+def grad_shift(changelist_grad, initial_bufs, t_last_init=(0, 0), order=False):
+    """Process the grad changelist, depending on what GPA is being used
+    etc. Changes are expected in (MSB, LSB) pairs for each gradient
+    event; returns a new changelist array with simultaneous events moved
+    into the past where needed.
+
+    t_last_init: times of the previous updates on the LSB and MSB
+    buffers, if the changelist continues an earlier one.
+
+    order: also return the index in changelist_grad of each change in the new changelist"""
 
-    # Process the grad changelist, depending on what GPA is being used etc
     # Sort in pairs of changes, because otherwise channels can get mixed up
-    changelist_grad_paired = [ [k, m] for k, m in zip(changelist_grad[::2], changelist_grad[1::2]) ]
-    sortfn = lambda change: change[0]
-    # changelist_grad.sort(key=sortfn) # sort by time
-    sortfn_paired = lambda change: change[0][0]
-    changelist_grad_paired.sort(key=sortfn_paired) # sort by time
-    changelist_grad = [k for sl in changelist_grad_paired for k in sl] # https://stackabuse.com/python-how-to-flatten-list-of-lists/
-
-    t_last = [0, 0] # no updates have previously happened; [LSB, MSB]
+    pairs = changelist_grad[:changelist_grad.size // 2 * 2].reshape(-1, 2)
+    pair_order = np.argsort(pairs[:, 0]['time'], kind='stable')
+    clg = pairs[pair_order].reshape(-1)
+    clg_order = (2 * pair_order[:, np.newaxis] + np.arange(2)).reshape(-1)
+
+    t = clg['time']
+    idx = clg['buf'].astype(np.intp) - 1 # 0 for LSB, 1 for MSB
+
+    # time of the previous update on the same buffer; by default no updates have previously happened at t = 0
+    t_last = np.zeros_like(t)
+    for k in (0, 1):
+        ki = np.where(idx == k)[0]
+        t_last[ki[:1]] = t_last_init[k]
+        t_last[ki[1:]] = t[ki[:-1]]
+
+    same = t == t_last
+    new = ~same
+
     spi_div = (initial_bufs[0] & 0xfc) >> 2
-    changelist_grad_shifted = []
-    num_chgs = [0, 0] # [LSB, MSB]
-    grad_vals = [initial_bufs[1], initial_bufs[2]] # [LSB, MSB] current output data
-    grad_vals_old = [0, 0] # [LSB, MSB] previous output data
-
-    for c in changelist_grad:
-        t = c[0]
-        debug_print("t: ", t, " t_last: ", t_last, "num_chgs: ", num_chgs, " c: ", c)
-        idx = c[1] - 1 # 0 for LSB, 1 for MSB
-        msb = idx == 1
-        data = c[2]
-        # if data == grad_vals[idx]: # no actual change to buffer output
-        #     continue # skip this change
-        # else:
-        #     grad_vals_old[idx] = grad_vals[idx]
-        #     grad_vals[idx] = data # update the last known buffer value
-
-        if t == t_last[idx]:
-            num_chgs[idx] += 1
-            # assume the changes in changelist_grad are paired with LSBs/MSBs matching each other's grad channels stored sequentially,
-            # and that for each event, the MSB update is first
-            if grad_board == "ocra1": # simultaneous with another grad update
-                if msb:
-                    if num_chgs[1]: # MSB buffer and not the first grad event on this timestep
-                        # turn broadcast off if this isn't the first grad event on this timestep
-                        data = data & ~np.uint16(0x0100)
-                        # return LSB back to old values, since this one is now done in the past
-                        grad_vals[:] = grad_vals_old # revert the last known buffer values
-                # else:
-                #     if data == grad_vals[idx]: # no actual change to buffer output compared to earlier LSB at this timestep
-                #         continue # skip this change
-
-                # move non-broadcast events back in time, so that synchronisation will be done in ocra1_iface core
-                changelist_grad_shifted.append( (c[0]-num_chgs[idx], c[1], data, c[3]) )
-                num_chgs[idx] += 1
-            elif grad_board == "gpa-fhdo":
-                # don't do anything; currently will cause an error
-                # later since multiple events can't happen at the same
-                # time for GPA-FHDO
-                changelist_grad_shifted.append(c)
-        else:
-            if t - t_last[idx] < 24 * (1 + spi_div) + 2: #
-                warnings.warn("Gradient updates are too frequent for selected SPI divider. Missed samples are likely!", MarGradWarning)
-
-            # if data == grad_vals[idx]: # no actual change to buffer output
-            #     continue # skip this change
-
-            t_last[idx] = t
-            grad_vals[idx] = data # update the last known buffer value
-            changelist_grad_shifted.append(c)
-            num_chgs = [0, 0]
-
-    changelist += changelist_grad_shifted
-    changelist.sort(key=sortfn) # sort by time
-
-    # Track removed instruction events, but only warn when the number exceeds a minimum
-    removed_instruction_warnings = []
-
-    # Process and combine the change list into discrete sets of operations at each time, i.e. an output list
-    def cl2ol(changelist):
-        current_bufs = initial_bufs.copy()
-        current_time = changelist[0][0]
-        unique_times = []
-        unique_changes = []
-        change_masks = np.zeros(MARGA_BUFS, dtype=np.uint16)
-        changed = np.zeros(MARGA_BUFS, dtype=bool)
-
-        def close_timestep(time):
-            ch_idces = np.where(changed)[0]
-            # buf_time_offsets = np.zeros(MARGA_BUFS, dtype=int32)
-            buf_time_offsets = 0
-            unique_changes.append( [time, ch_idces, current_bufs[ch_idces], buf_time_offsets] )
-            change_masks[:] = np.zeros(MARGA_BUFS, dtype=np.uint16)
-            changed[:] = np.zeros(MARGA_BUFS, dtype=bool)
-
-        for time, buf, val, mask in changelist:
-            if time != current_time:
-                close_timestep(current_time)
-                current_time = time
-            buf_diff = (current_bufs[buf] ^ val) & mask
-            assert buf_diff & change_masks[buf] == 0, "Tried to set a buffer to two values at once"
-            if buf_diff == 0:
-                if buf not in (1, 2):
-                    # gradient buffers will have unneeded instructions
-                    # all the time, so not worth warning the user for
-                    # those
-                    removed_instruction_warnings.append( "Instruction at tick {:d}, buffer {:d}, value 0x{:04x}, mask 0x{:04x} will have no effect. Skipping...".format(time, buf, val, mask) )
+    if np.any( t[new] - t_last[new] < 24 * (1 + spi_div) + 2 ):
+        warnings.warn("Gradient updates are too frequent for selected SPI divider. Missed samples are likely!", MarGradWarning)
+
+    if grad_board == "ocra1":
+        # number of simultaneous updates on the same buffer since the last new update on either buffer
+        pos = np.arange(t.size)
+        last_new = np.maximum.accumulate(np.where(new, pos, -1))
+        num_chgs = np.zeros(t.size, dtype=np.int64)
+        for k in (0, 1):
+            cs = np.concatenate([[0], np.cumsum(same & (idx == k))])
+            ki = idx == k
+            num_chgs[ki] = cs[pos[ki] + 1] - cs[last_new[ki] + 1]
+
+        # move non-broadcast events back in time, so that synchronisation will be done in ocra1_iface core
+        clg = clg.copy()
+        clg['time'][same] -= 2 * num_chgs[same] - 1
+        # turn broadcast off if this isn't the first grad event on this timestep
+        clg['val'][same & (idx == 1)] &= ~np.uint16(0x0100)
+    elif grad_board == "gpa-fhdo":
+        # don't do anything; currently will cause an error
+        # later since multiple events can't happen at the same
+        # time for GPA-FHDO
+        pass
+    else:
+        clg = clg[new]
+        clg_order = clg_order[new]
+
+    if order:
+        return clg, clg_order
+    return clg
+
+def cl2ol(changelist, initial_bufs):
+    """Process and combine a time-sorted changelist array into discrete sets
+    of operations at each time, i.e. an output list.
+
+    Returns (times, step_idces, bufs, vals, removed):
+    unique output times, and for every buffer write the index of its
+    timestep, the buffer and the value it will be set to, ordered by
+    timestep and then buffer index. removed is a boolean array
+    marking the entries of changelist that will have no effect."""
+
+    n = changelist.size
+    if n == 0:
+        e = np.zeros(0, dtype=np.intp)
+        return np.zeros(0, dtype=np.int64), e, e, np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=bool)
+
+    initial_bufs = np.asarray(initial_bufs, dtype=np.uint16)
+    pos = np.arange(n)
+
+    # group by buffer, keeping the time order within each buffer
+    order = np.argsort(changelist['buf'], kind='stable')
+    cl = changelist[order]
+    t, buf, val, mask = cl['time'], cl['buf'].astype(np.intp), cl['val'], cl['mask']
+
+    buf_start = np.concatenate([[True], buf[1:] != buf[:-1]])
+    step_start = buf_start | np.concatenate([[True], t[1:] != t[:-1]])
+    buf_first = np.maximum.accumulate(np.where(buf_start, pos, 0))
+    step_first = np.maximum.accumulate(np.where(step_start, pos, 0))
+    check_conflicts = not step_start.all()
+
+    # Track the buffer states bit by bit: each bit is set by the last
+    # earlier change on the same buffer whose mask covers it, or keeps its initial value
+    mask_bits = np.bitwise_or.reduce(mask) if n else np.uint16(0)
+    state = initial_bufs[buf] & ~mask_bits
+    for bit in range(16):
+        bm = np.uint16(1 << bit)
+        if not mask_bits & bm:
+            continue
+        covers = (mask & bm) != 0
+        last = np.maximum.accumulate(np.where(covers, pos, -1))
+        prev = np.concatenate([[-1], last[:-1]])
+        from_change = prev >= buf_first
+        state |= np.where(from_change, val[prev], initial_bufs[buf]) & bm
+
+    buf_diff = (state ^ val) & mask
+    effective = buf_diff != 0
+
+    if check_conflicts:
+        # a change may not alter bits already set by another change to the same buffer at the same time
+        for bit in range(16):
+            bm = np.uint16(1 << bit)
+            if not mask_bits & bm:
                 continue
-            val_masked = val & mask
-            old_val_unmasked = current_bufs[buf] & ~mask
-            new_val = old_val_unmasked | val_masked
-            change_masks[buf] |= mask
-            current_bufs[buf] = new_val
-            changed[buf] = True
+            eff_covers = effective & ((mask & bm) != 0)
+            cs = np.cumsum(eff_covers) - eff_covers # earlier changes only
+            earlier = cs - cs[step_first]
+            assert not np.any( (buf_diff & bm != 0) & (earlier > 0) ), "Tried to set a buffer to two values at once"
+
+    new_state = (state & ~mask) | (val & mask)
+
+    # final value of each changed buffer on each timestep
+    step_end = np.concatenate([step_start[1:], [True]])
+    eff_steps = np.cumsum(effective)
+    changed = step_end & ( eff_steps - eff_steps[step_first] + effective[step_first] > 0 )
+
+    times = np.unique(changelist['time'])
+    step_idces = np.searchsorted(times, t[changed])
+    bufs = buf[changed]
+    so = np.lexsort((bufs, step_idces))
+
+    removed = np.empty(n, dtype=bool)
+    removed[order] = ~effective
+
+    return times, step_idces[so], bufs[so], new_state[changed][so], removed
+
+class CompileProfile:
+    """Wall time (s) and item counts of each compilation stage, filled in
+    by dict2bin(), cl2bin() and related functions when passed in as
+    profile; repeated or parallel compilations accumulate. Stages are
+    key mapping (dict2cl), grad_shift, merge (sorting), cl2ol,
+    warnings (removed instructions), offsets (back-propagation), emit
+    and optimise (with opt_level 1)."""
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self._t = None
+
+    def start(self):
+        self._t = time.perf_counter()
 
-        close_timestep(current_time)
+    def lap(self, stage, **counts):
+        """ Record the time since the previous lap or start() for stage, and add the item counts """
+        t = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0) + t - self._t
+        self._t = t
+        self.add_counts(counts)
 
-        return unique_changes
+    def add_counts(self, counts):
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + int(v)
 
-    changes = cl2ol(changelist)
+    def add(self, other):
+        """ Accumulate another profile, e.g. from a worker process """
+        for k, v in other.times.items():
+            self.times[k] = self.times.get(k, 0) + v
+        self.add_counts(other.counts)
+
+    def total(self):
+        return sum(self.times.values())
+
+    def __str__(self):
+        lines = [ "{:>14s}: {:9.3f} ms".format(k, 1e3 * v) for k, v in self.times.items() ]
+        lines += [ "{:>14s}: {:d}".format(k, v) for k, v in self.counts.items() ]
+        return "\n".join(lines)
+
+class CompileState:
+    """Buffer state at the end of a compiled program: filled in by
+    cl2bin() or dict2bin() when passed in, and updated by
+    cl2bin_append() and dict2bin_append() to append later events to the
+    program without recompiling it from the start.
+
+    machine_code: the program compiled so far
+    current_bufs: buffer values at the end of the program
+    last_change: time of the last change on each buffer, which
+    determines how long the buffers stay busy (buf_time_left)
+    grad_t_last: times of the last updates on the grad LSB and MSB buffers
+    t_end, steps: time and number of the timesteps in the program
+    removed: table of all the changes that had no effect (including on
+    the grad buffers), as a change_dtype array of (time, buf, val, mask)
+    opt_level: optimisation level of the programs returned; machine_code
+    is always the unoptimised program, which later events are appended to
+    """
+
+    def __init__(self, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16)):
+        self.reset(initial_bufs)
+
+    def reset(self, initial_bufs):
+        self.initial_bufs = np.array(initial_bufs, dtype=np.uint16)
+        self.current_bufs = self.initial_bufs.copy()
+        self.last_change = np.zeros(MARGA_BUFS, dtype=np.int64)
+        self.grad_t_last = np.zeros(2, dtype=np.int64)
+        self.t_end = 0
+        self.steps = 0
+        self.grad_board = grad_board
+        self.removed = np.zeros(0, dtype=change_dtype)
+        self.machine_code = None
+        self.opt_level = 0
+
+def warnings_ignored(category):
+    """True if warnings of category raised in this module are certain
+    to be ignored by the current warnings filters"""
+    for action, msg, cat, mod, lineno in warnings.filters:
+        if not issubclass(category, cat) or (mod is not None and not mod.match(__name__)):
+            continue
+        if (msg is not None and msg.pattern) or lineno:
+            return False # depends on the message or line
+        return action == "ignore"
+    return False
+
+def warn_removed(changelist, removed):
+    """Returns the table of changes that have no effect, as a
+    change_dtype array, and warns about them if there are more than
+    max_removed_instructions; messages are only formatted when they are
+    actually issued"""
+
+    rm = changelist[removed]
+
+    # Only warn about removed instruction events when the number exceeds a minimum
+    # (gradient buffers will have unneeded instructions all the time, so not worth warning the user for those)
+    rm_warn = rm[~np.isin(rm['buf'], grad_data_bufs)]
 
     # warn about all the removed instructions if there are more than a maximum number
-    if len(removed_instruction_warnings) > max_removed_instructions:
-        for riw in removed_instruction_warnings:
-            warnings.warn(riw, MarRemovedInstructionWarning)
+    if rm_warn.size > max_removed_instructions and not warnings_ignored(MarRemovedInstructionWarning):
+        for time, buf, val, mask in zip(rm_warn['time'].tolist(), rm_warn['buf'].tolist(), rm_warn['val'].tolist(), rm_warn['mask'].tolist()):
+            warnings.warn("Instruction at tick {:d}, buffer {:d}, value 0x{:04x}, mask 0x{:04x} will have no effect. Skipping...".format(time, buf, val, mask),
+                          MarRemovedInstructionWarning)
         warnings.warn("NOTE: Fewer than {:d} removed-instruction warnings will not be printed -- keep this in mind when searching for the root cause.".format(max_removed_instructions))
 
-    # Process time offsets
-    for ch, ch_prev in zip( reversed(changes[1:]), reversed(changes[:-1]) ):
-        # does the current timestep need to output more data than can
-        # fit into the time gap since the previous timestep?
-        timestep = np.int32(ch[0] - ch_prev[0])
-        timediff = np.int32(ch[1].size - timestep)
-        # if timestep < ch[1].size: # not enough time
+    return rm
+
+def merge_changelists(state, changelist, changelist_grad, profile=None, order=False):
+    """Process the grad changelist following on from state, and merge
+    it with the changelist into a single time-sorted changelist array.
+    Returns the merged changelist and the times of the last LSB and MSB grad updates.
+
+    order: also return the index of each merged change in the changelist followed by the grad changelist"""
+
+    changelist = cl_array(changelist)
+    changelist_grad = cl_array(changelist_grad)
+    grad_t_last = state.grad_t_last.copy()
+    for k in (0, 1):
+        gt = changelist_grad['time'][changelist_grad['buf'] == grad_data_bufs[k]]
+        if gt.size:
+            grad_t_last[k] = gt.max()
 
-        if timediff > 0:
-            ch_prev[0] -= timediff # move prev. event into the past
-            ch_prev[3] = timediff # make prev. event's buffers output in its future
+    changelist_grad_shifted, grad_order = grad_shift(changelist_grad, state.initial_bufs, state.grad_t_last, order=True)
+    if profile is not None:
+        profile.lap('grad_shift', events=changelist.size + changelist_grad.size)
+
+    src = np.concatenate([np.arange(changelist.size), changelist.size + grad_order])
+    changelist = np.concatenate([changelist, changelist_grad_shifted])
+    time_order = np.argsort(changelist['time'], kind='stable') # sort by time
+    changelist = changelist[time_order]
+    if profile is not None:
+        profile.lap('merge')
+    if order:
+        return changelist, grad_t_last, src[time_order]
+    return changelist, grad_t_last
+
+def cl2words(state, changelist, changelist_grad, head_words, profile=None):
+    """Compile changelists into the instructions of their timesteps,
+    continuing from the buffer state at the end of an existing program.
+    Returns a uint32 array with head_words unset words at the start and
+    one at the end, for the caller to fill in, and the state at the end
+    of the new timesteps; the state passed in is left unchanged.
+
+    Returns None, None if the changes aren't all later than the
+    existing program, or would need some of its timesteps to be moved."""
+
+    changelist, grad_t_last = merge_changelists(state, changelist, changelist_grad, profile)
+    bdata, new_state, removed = steps2words(state, changelist, head_words, profile)
+    if bdata is None:
+        return None, None
+
+    new_state.removed = np.concatenate([state.removed, warn_removed(changelist, removed)])
+    if profile is not None:
+        profile.lap('warnings')
+    new_state.grad_t_last = grad_t_last
+    return bdata, new_state
+
+def steps2words(state, changelist, head_words, profile=None):
+    """Back end of cl2words(), for a merged and time-sorted changelist.
+    Returns the words, the new state (apart from grad_t_last) and the
+    removed-instruction array from cl2ol(); or None, None, None."""
+
+    if state.steps and changelist.size and changelist['time'][0] <= state.t_end:
+        return None, None, None
+
+    times, step_idces, bufs, vals, removed = cl2ol(changelist, state.current_bufs)
+    if profile is not None:
+        profile.lap('cl2ol', timesteps=times.size, removed=removed.sum())
+
+    # Process time offsets: if a timestep needs to output more data
+    # than can fit into the time gap since the previous timestep,
+    # move the previous timestep into the past and make its buffers
+    # output in its future. Equivalent to walking backwards through
+    # the timesteps with t_prev = min(t_prev, t - instructions).
+    b_instrs = np.bincount(step_idces, minlength=times.size)
+    instr_cumsum = np.cumsum(b_instrs)
+    slack = np.minimum.accumulate( (times - instr_cumsum)[::-1] )[::-1]
+    if state.steps and slack.size and slack[0] < state.t_end:
+        return None, None, None
+    times_eff = instr_cumsum + slack
+    time_offsets = times - times_eff
 
     # convert to differential timesteps
-    last_time = 0
-    for ch in changes:
-        ch0 = ch[0]
-        ch[0] = ch0 - last_time
-        last_time = ch0
-
-    # Interpretation of each element of changes list:
-    # [time when all instructions for this change will have completed,
-    #  buffers that need to be changed,
-    #  values to set the buffers to,
-    #  the delay until the buffers will output their values]
+    dtimes = np.diff(times_eff, prepend=state.t_end)
+    if profile is not None:
+        profile.lap('offsets')
 
     ### Write out instructions
 
+    # soak up any extra time which is in excess of what the
+    # instructions need to execute synchronously: delays of 3 or more
+    # cycles use waits of up to COUNTER_MAX + 3 cycles, final delays of 1 or 2 cycles use nops
+    wait_max = COUNTER_MAX + 3
+    excess_dtimes = np.maximum(dtimes - b_instrs, 0)
+    excess_rem = excess_dtimes % wait_max
+    wait_full = excess_dtimes // wait_max
+    waits = wait_full + (excess_rem > 2)
+    nops = np.where( (excess_rem == 1) | (excess_rem == 2), excess_dtimes, 0 )
+
+    # dtime_eff could be increased later with a more advanced
+    # compiler, to make the buffers bear more of the internal
+    # delays
+
+    step_words = waits + nops + b_instrs
+    step_addrs = head_words + np.cumsum(step_words) - step_words
+    bdata = np.empty(head_words + step_words.sum() + 1, dtype=np.uint32)
+
+    wait_steps, wait_k = step_ranges(waits)
+    wait_times = np.where(wait_k < wait_full[wait_steps], wait_max, excess_rem[wait_steps])
+    bdata[step_addrs[wait_steps] + wait_k] = insta_array(IWAIT, wait_times - 3)
+
+    nop_steps, nop_k = step_ranges(nops)
+    bdata[step_addrs[nop_steps] + waits[nop_steps] + nop_k] = insta_array(INOP, 0)
+
+    # Buffer writes: each buffer is busy outputting its previous value
+    # until the (original, uncorrected) time of its previous change,
+    # and the instructions of a timestep start issuing b_instrs cycles
+    # before the timestep's corrected time
+    m = np.arange(step_idces.size) - (instr_cumsum - b_instrs)[step_idces]
+    b = b_instrs[step_idces]
+    this_time_offset = time_offsets[step_idces]
+    bo = np.argsort(bufs, kind='stable')
+    prev_change = state.last_change[bufs]
+    prev_change[bo[1:]] = np.where(bufs[bo[1:]] == bufs[bo[:-1]], times[step_idces[bo[:-1]]], prev_change[bo[1:]])
+    buf_time_left = np.maximum(prev_change - (times_eff[step_idces] - b), 0)
+
+    execution_delay = b - m - 1
+    buf_empty = buf_time_left <= m # buffer empty for this instruction; need an appropriate delay only for sync
+    extra_delay = np.where(buf_empty, execution_delay + this_time_offset, this_time_offset - buf_time_left + b - 1)
+
+    bdata[step_addrs[step_idces] + waits[step_idces] + nops[step_idces] + m] = instb_array(bufs, extra_delay, vals)
+    if profile is not None:
+        profile.lap('emit', instructions=bufs.size, waits=waits.sum(), nops=nops.sum())
+
+    # State at the end of the new timesteps; writes are ordered by
+    # time, so the last one to each buffer takes effect
+    new_state = copy.copy(state)
+    new_state.current_bufs = state.current_bufs.copy()
+    new_state.current_bufs[bufs] = vals
+    new_state.last_change = state.last_change.copy()
+    new_state.last_change[bufs] = times[step_idces]
+    if times.size:
+        new_state.t_end = times[-1]
+    new_state.steps = state.steps + times.size
+
+    return bdata, new_state, removed
+
+def step_ranges(counts):
+    """ Timestep index and position within the timestep of each of a set of per-timestep words """
+    steps = np.repeat(np.arange(counts.size), counts)
+    return steps, np.arange(steps.size) - (np.cumsum(counts) - counts)[steps]
+
+def pad_counts(gaps):
+    """Number of waits and nops that pad_words() uses for each gap;
+    returns (waits, nops, full waits, remainders, split)"""
+    full, rem = np.divmod(gaps, COUNTER_MAX + 3)
+    short = (rem == 1) | (rem == 2)
+    split = short & (full > 0) # shorten the last full wait, so that the remainder is at least 3 cycles
+    return full + (rem > 2) + split, np.where(short & (full == 0), rem, 0), full, rem, split
+
+def pad_words(gaps):
+    """Instructions that soak up each of a set of idle gaps (in
+    cycles): waits of up to COUNTER_MAX + 3 cycles, the last of which is
+    at least 3 cycles, or 1 or 2 nops for short gaps. Returns the
+    number of words for each gap, and the words in gap order."""
+    wait_max = COUNTER_MAX + 3
+    waits, nops, full, rem, split = pad_counts(gaps)
+    counts = waits + nops
+    words = np.full(counts.sum(), insta(INOP, 0), dtype=np.uint32)
+    gi, k = step_ranges(waits)
+    wait_len = np.where(k < full[gi], wait_max, rem[gi])
+    wait_len = np.where(split[gi] & (k == full[gi] - 1), wait_max + rem[gi] - 3, wait_len)
+    wait_len = np.where(split[gi] & (k == full[gi]), 3, wait_len)
+    words[(np.cumsum(counts) - counts)[gi] + k] = insta_array(IWAIT, wait_len - 3)
+    return counts, words
+
+def optimise(program, head_words=MARGA_BUFS, profile=None):
+    """Reduce the number of instructions in a compiled program without
+    changing its outputs (opt_level 1). Buffer writes are issued as
+    early as their 8-bit delays allow, with at most opt_queue_depth
+    earlier writes to the same buffer still waiting to be output, so
+    that the idle time between them collects into fewer, longer
+    waits; 1- and 2-cycle gaps are then closed by issuing writes later
+    where there is slack. The order of the writes, their output times,
+    the first head_words instructions and the cycle of the final
+    IFINISH (so that events can still be appended) are unchanged.
+
+    Redundant writes are already removed by cl2ol() at every level.
+
+    Returns the optimised program; programs containing instructions
+    other than writes, waits and nops after the head are returned
+    unchanged. If profile is given, the words saved are counted as opt_saved."""
+
+    program = np.asarray(program, dtype=np.uint32)
+    instrs = disassemble(program)
+    issue, _ = issue_times(instrs)
+    body = instrs[head_words:issue.size - 1]
+    if issue.size != program.size or instrs['op'][-1] != IFINISH or not np.all(np.isin(body['op'], [INOP, IWAIT, IDATA])):
+        return program
+
+    # previous write, and the write opt_queue_depth + 1 back, to the same buffer as each write
+    idata, out = output_times(instrs, issue)
+    order = np.argsort(instrs['tgt'][idata], kind='stable')
+    tgt_sorted = instrs['tgt'][idata][order]
+    pos = np.arange(idata.size)
+    group_start = np.maximum.accumulate(np.where(np.concatenate([[True], tgt_sorted[1:] != tgt_sorted[:-1]]), pos, 0))
+    def earlier_output(k):
+        # output time of the write k before each one on the same buffer, or -inf
+        prev = np.full(idata.size, np.iinfo(np.int64).min // 2, dtype=np.int64)
+        has = pos - k >= group_start
+        prev[order[has]] = out[order[pos[has] - k]]
+        return prev
+    p1, pq = earlier_output(1), earlier_output(opt_queue_depth + 1)
+
+    w = idata >= head_words
+    t_out, r0, p1, pq = out[w], issue[idata[w]], p1[w], pq[w]
+    n = t_out.size
+    if n == 0:
+        return program
+    t_start, t_final = issue[head_words], issue[-1]
+
+    # Issue cycle windows: a write to a buffer that is busy until p1
+    # gets a delay of t_out - p1 - 1, otherwise t_out - r - 1; the
+    # original issue cycles r0 are always valid. In terms of u = r - j,
+    # which doesn't decrease, every write has an interval that u must
+    # lie in, and a run of writes issued back to back without waiting
+    # has the same u throughout.
+    j = np.arange(n)
+    lo = np.minimum( np.where(t_out - p1 > 256, t_out - 256, pq), r0 )
+    u_lo = np.maximum.accumulate( np.maximum(lo - j, t_start) )
+    u_hi = np.minimum.accumulate( np.minimum(t_out - 1 - j, t_final - n)[::-1] )[::-1]
+
+    # Fewest runs: each run takes the highest u allowed for its first
+    # write, and extends over all the following writes that allow it
+    run_end = np.searchsorted(u_lo, u_hi, side='right').tolist()
+    run_starts = []
+    k = 0
+    while k < n:
+        run_starts.append(k)
+        k = run_end[k]
+    run_starts = np.array(run_starts)
+    u = u_hi[run_starts]
+
+    # turn 2-nop gaps into 3-cycle waits where the run before has room
+    gaps = np.diff(u, prepend=t_start) # idle cycles before each run
+    run_min = u_lo[np.append(run_starts[1:], n) - 1]
+    lower = np.append(gaps[1:] == 2, False) & (gaps >= 4) & (u - 1 >= run_min)
+    u -= lower
+
+    r = np.repeat(u, np.diff(np.append(run_starts, n))) + j
+
+    delays = t_out - np.maximum(r, p1) - 1
+    assert np.all( (delays >= 0) & (delays <= 255) ), "Optimisation failed; please file a bug report"
+
+    gaps = np.append(np.diff(r, prepend=t_start - 1) - 1, t_final - r[-1] - 1)
+    counts, pad = pad_words(gaps)
+    seg_len = counts + np.append(np.ones(n, dtype=np.int64), 0)
+    seg_starts = head_words + np.cumsum(seg_len) - seg_len
+
+    opt = np.empty(head_words + seg_len.sum() + 1, dtype=np.uint32)
+    opt[:head_words] = program[:head_words]
+    gi, k = step_ranges(counts)
+    opt[seg_starts[gi] + k] = pad
+    opt[seg_starts[:n] + counts[:n]] = instb_array(instrs['tgt'][idata[w]], delays, instrs['data'][idata[w]])
+    opt[-1] = program[-1]
+
+    if opt.size >= program.size:
+        opt = program
+    if profile is not None:
+        profile.lap('optimise', opt_saved=program.size - opt.size)
+    return opt
+
+def split_program(program, max_words=MARGA_MEM_WORDS, min_gap=0, head_words=MARGA_BUFS):
+    """Split a compiled program that is too long for the sequencer
+    memory into programs of at most max_words instructions, to be run
+    one after another. Programs are split after waits of at least
+    min_gap cycles during which both RX channels are off, and by the end
+    of which all earlier buffer writes have been output, such as the
+    idle time between TRs; the latest such wait that fits is used each
+    time. Every program after the first starts with writes of the buffer
+    values at its split, so its outputs are the same as in the original
+    program apart from the time between the programs.
+
+    Returns a list of programs; the program itself if it already fits."""
+
+    program = np.asarray(program, dtype=np.uint32)
+    instrs = disassemble(program)
+    issue, _ = issue_times(instrs)
+    n = issue.size
+    if n <= max_words:
+        return [program[:n]]
+    assert max_words > MARGA_BUFS + 1, "max_words too small for the initial buffer writes"
+
+    idata, out = output_times(instrs, issue)
+    tgt, data = instrs['tgt'][idata], instrs['data'][idata]
+
+    # latest output of the writes before each instruction
+    last_out = np.full(n, -1, dtype=np.int64)
+    last_out[idata] = out
+    done = np.maximum.accumulate(np.concatenate([[-1], last_out[:-1]])) < issue
+
+    # RX enables (RX_CTRL bits 8 and 9) before each instruction
+    rxw = idata[tgt == RX_CTRL]
+    ri = np.searchsorted(rxw, np.arange(n)) - 1
+    rx_off = (ri < 0) | (instrs['data'][rxw[np.maximum(ri, 0)]] & 0x300 == 0) if rxw.size else np.ones(n, dtype=bool)
+
+    # split after the waits, so that each program finishes after the idle time
+    k = np.flatnonzero( (instrs['op'][:n - 1] == IWAIT) & (instrs['data'][:n - 1].astype(np.int64) + 3 >= min_gap) )
+    k = k[k >= head_words]
+    splits = k[done[k + 1] & rx_off[k]] + 1
+
+    bounds = [0]
+    while n - bounds[-1] + (MARGA_BUFS if len(bounds) > 1 else 0) > max_words:
+        room = max_words - 1 - (MARGA_BUFS if len(bounds) > 1 else 0)
+        si = np.searchsorted(splits, bounds[-1] + room, side='right') - 1
+        assert si >= 0 and splits[si] > bounds[-1], \
+            "Program can't be split into parts of {:d} instructions; it needs more idle times with the RX off".format(max_words)
+        bounds.append(splits[si])
+
+    # buffer values at each split, from the last write before it
+    bufs = np.zeros((len(bounds), MARGA_BUFS), dtype=np.uint16)
+    for b in range(MARGA_BUFS):
+        wb = np.flatnonzero(tgt == b)
+        wi = np.searchsorted(idata[wb], bounds) - 1
+        if wb.size:
+            bufs[:, b] = np.where(wi >= 0, data[wb[np.maximum(wi, 0)]], 0)
+
+    buf_range = np.arange(MARGA_BUFS)
+    programs = []
+    for p, (b0, b1) in enumerate(zip(bounds, bounds[1:] + [n])):
+        parts = []
+        if p > 0:
+            # no delays, so that every buffer has been output before the first instruction of the part
+            parts.append( instb_array(MARGA_BUFS - 1 - buf_range, 0, bufs[p, ::-1]) )
+        parts.append(program[b0:b1])
+        if b1 < n:
+            parts.append( np.array([insta(IFINISH, 0)], dtype=np.uint32) )
+        programs.append( np.concatenate(parts).astype(np.uint32) )
+    return programs
+
+def cl2bin(changelist, changelist_grad,
+           initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), state=None, profile=None, opt_level=0):
+
+    """Central compilation function; accept in two changelists,
+    changelist for all the direct-buffer outputs (TX, most configurable
+    parameters, etc) and the other, changelist_grad, for the outputs used
+    to control hardware with non-trivial internal timing behaviour
+    (currently only the gradient boards). Also accepts non-default initial
+    values to program the buffers to.
+
+    Changelists are arrays of change_dtype (or anything cl_array()
+    accepts); all the sorting, merging and state tracking is done with
+    array operations. Returns the machine code as a uint32 array.
+
+    state: optional CompileState, which will be filled in so that
+    later events can be added with cl2bin_append().
+
+    profile: optional CompileProfile to record the time taken and
+    items processed by each stage.
+
+    opt_level: 1 to reduce the number of instructions with optimise()."""
+
+    if profile is not None:
+        profile.start()
+
+    st = CompileState(initial_bufs)
+    st.opt_level = opt_level
+    bdata, st = cl2words(st, changelist, changelist_grad, MARGA_BUFS, profile)
+
     # Write out initial buffer values
-    bdata = []
-    addr = 0
-    states = initial_bufs
     # reversed order, so that grad board is enabled last of all (to avoid spurious initial transfer)
-    for k, ib in enumerate(reversed(initial_bufs)):
-        bdata.append(instb(MARGA_BUFS-1-k, k, ib))
-
-    last_buf_time_left = np.zeros(MARGA_BUFS, dtype=np.int32)
-    buf_time_left = np.zeros(MARGA_BUFS, dtype=np.int32)
-    # buf_empty_time = np.zeros(MARGA_BUFS, dtype=np.int32)
-    debug_print("changes:")
-    for k in changes:
-        debug_print(k)
-
-    for event in changes:
-        b_instrs = event[1].size
-        dtime = event[0]
-
-        # soak up any extra time which is in excess of what the instructions need to execute synchronously
-        excess_dtime = dtime - b_instrs
-        excess_dtime_tmp = excess_dtime
-        while excess_dtime_tmp > 2: # delay of 3 or more cycles needed
-            wait_time = min(excess_dtime_tmp, COUNTER_MAX + 3) # delay for the time instruction
-            bdata.append(insta(IWAIT, wait_time - 3))
-            excess_dtime_tmp -= wait_time
-            debug_print("i wait ", wait_time - 3)
-        if excess_dtime_tmp: # final delay of 1 or 2 cycles
-            for k in range(dtime - b_instrs):
-                debug_print("i nop")
-                bdata.append(insta(INOP, 0))
-
-        # time left after delays from nops or waits
-        # dtime_eff could be increased later with a more advanced
-        # compiler, to make the buffers bear more of the internal
-        # delays
-        # dtime_eff = b_instrs
-
-        # count down the times until each channel buffer will be empty
-        buf_time_left -= excess_dtime
-        buf_time_left[buf_time_left < 0] = 0
-        this_time_offset = event[3]
-        debug_print("--- dtime {:2d}, this_time_offset: {:2d}, b_instrs: {:2d}, lbtl: ".format(dtime, this_time_offset, b_instrs), last_buf_time_left[5:9])
-        for m, (ind, dat) in enumerate(zip(event[1], event[2])):
-            execution_delay = b_instrs - m - 1 #+ time - 2
-            btli = buf_time_left[ind]
-            buf_empty = btli <= m
-            if buf_empty: # buffer empty for this instruction; need an appropriate delay only for sync
-                # (check against m since with successive cycles, remaining buffers will empty out)
-                extra_delay = execution_delay + this_time_offset
-                buf_time_left[ind] = this_time_offset + b_instrs
-            else:
-                # buffer already not empty on this cycle
-                extra_delay = this_time_offset - btli + b_instrs - 1
-                buf_time_left[ind] += extra_delay + 1
-
-            debug_print("bti={:d} btli={:d} m={:d} empty={:d} edel={:d} instb i {:d} del {:d} dat {:d}".format(
-                buf_time_left[ind], btli, m, buf_empty, execution_delay, ind, extra_delay, dat))
-            bdata.append(instb(ind, extra_delay, dat))
-
-        buf_time_left -= b_instrs # take into account execution time of this timestep
+    buf_range = np.arange(MARGA_BUFS)
+    bdata[:MARGA_BUFS] = instb_array(MARGA_BUFS - 1 - buf_range, buf_range, st.initial_bufs[::-1])
 
     # Finish sequence
-    bdata.append(insta(IFINISH, 0))
+    bdata[-1] = insta(IFINISH, 0)
+    if profile is not None:
+        profile.add_counts({'words': bdata.size})
+
+    if state is not None:
+        state.__dict__.update(st.__dict__)
+        state.machine_code = bdata
+    if opt_level:
+        return optimise(bdata, profile=profile)
+    return bdata
+
+def cl2bin_append(state, changelist, changelist_grad, profile=None):
+    """Append changelists to the program compiled into a CompileState,
+    compiling only the new events; the result is the same as compiling
+    all the events at once with cl2bin(). Updates the machine code in
+    state, and returns it (optimised if state.opt_level is set).
+
+    All the changes must be later than the end of the existing program,
+    with enough time before them to issue their instructions, and state
+    must hold a compiled program; if not, returns None without altering
+    state, and the whole sequence needs to be recompiled."""
+
+    if state.machine_code is None or state.grad_board != grad_board:
+        return None
+
+    if profile is not None:
+        profile.start()
+
+    prev = state.machine_code
+    bdata, st = cl2words(state, changelist, changelist_grad, prev.size - 1, profile)
+    if bdata is None:
+        return None
+    if profile is not None:
+        profile.add_counts({'words': bdata.size - prev.size})
+
+    bdata[:prev.size - 1] = prev[:-1] # everything up to the old IFINISH
+    bdata[-1] = insta(IFINISH, 0)
+
+    state.__dict__.update(st.__dict__)
+    state.machine_code = bdata
+    if state.opt_level:
+        return optimise(bdata, profile=profile)
+    return bdata
+
+def quiet_points(changelist, segment_changes):
+    """Indices in a merged, time-sorted changelist at which it can be
+    split into segments that compile independently, roughly every
+    segment_changes changes. At these points, the following timesteps
+    have enough time to issue their instructions without moving any
+    earlier timesteps, even if none of their changes are removed."""
+
+    t = changelist['time']
+    starts = np.flatnonzero(np.concatenate([[True], t[1:] != t[:-1]]))
+    if starts.size < 2:
+        return np.zeros(0, dtype=np.intp)
+
+    # instructions per timestep are at most the number of changes
+    times = t[starts]
+    changes_cumsum = np.append(starts[1:], t.size)
+    suffix_slack = np.minimum.accumulate( (times - changes_cumsum)[::-1] )[::-1]
+    quiet = np.flatnonzero(suffix_slack[1:] + changes_cumsum[:-1] >= times[:-1]) + 1
+
+    # first quiet timestep after each multiple of segment_changes
+    targets = np.arange(segment_changes, t.size, segment_changes)
+    qi = np.searchsorted(starts[quiet], targets)
+    return np.unique(starts[quiet[qi[qi < quiet.size]]])
+
+def buffer_states(changelist, initial_bufs, positions):
+    """Buffer values after the changes before each of a set of positions
+    in a time-sorted changelist; returns a (positions, MARGA_BUFS) array."""
+
+    n = changelist.size
+    states = np.tile(np.asarray(initial_bufs, dtype=np.uint16), (positions.size, 1))
+
+    # changes grouped by buffer and then ordered by position, as sort keys
+    order = np.argsort(changelist['buf'], kind='stable')
+    keys = changelist['buf'][order].astype(np.int64) * (n + 1) + order
+    queries = np.arange(MARGA_BUFS)[np.newaxis, :] * (n + 1) + positions[:, np.newaxis]
+    mask, val = changelist['mask'][order], changelist['val'][order]
+
+    # last change to each buffer before each position, separately for
+    # each of the (usually few) distinct masks
+    masks = np.flatnonzero(np.bincount(mask, minlength=1 << 16)).astype(np.uint16)
+    last_pos = np.empty((masks.size,) + queries.shape, dtype=np.int64)
+    last_val = np.empty((masks.size,) + queries.shape, dtype=np.uint16)
+    for k, m in enumerate(masks):
+        sel = np.flatnonzero(mask == m)
+        last = np.searchsorted(keys[sel], queries) - 1
+        valid = (last >= 0) & (keys[sel][last] // (n + 1) == np.arange(MARGA_BUFS))
+        last_pos[k] = np.where(valid, order[sel][last], -1)
+        last_val[k] = val[sel][last]
+
+    for bit in range(16):
+        # latest of the changes covering each bit
+        bm = np.uint16(1 << bit)
+        covers = (masks & bm) != 0
+        if not covers.any():
+            continue
+        lp = np.where(covers[:, np.newaxis, np.newaxis], last_pos, -1)
+        latest = np.take_along_axis(last_val, lp.argmax(axis=0)[np.newaxis], 0)[0]
+        states = np.where(lp.max(axis=0) >= 0, (states & ~bm) | (latest & bm), states)
+
+    return states
+
+def compile_segment(state, changelist, counter_max, profile):
+    # Worker process function for cl2bin_parallel(); the module globals
+    # may not have been inherited from the parent process
+    global COUNTER_MAX
+    COUNTER_MAX = counter_max
+
+    if profile is not None:
+        profile.start()
+    bdata, new_state, removed = steps2words(state, changelist, 0, profile)
+    assert bdata is not None, "Segment boundary is not at a quiet point"
+    return bdata[:-1], new_state, removed, profile
+
+def cl2bin_parallel(changelist, changelist_grad,
+                    initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), state=None,
+                    processes=None, segment_changes=200000, profile=None, opt_level=0):
+    """Same as cl2bin(), but splits long changelists into segments of
+    about segment_changes changes at quiet points and compiles them in a
+    pool of processes (by default one per core). The starting buffer
+    state of each segment is computed up front, and the result is
+    identical to cl2bin().
+
+    In the profile, the stage times of the segments are summed over the
+    worker processes, and 'parallel' is the wall time of the pool."""
+
+    if profile is not None:
+        profile.start()
+
+    st = CompileState(initial_bufs)
+    st.opt_level = opt_level
+    changelist, grad_t_last = merge_changelists(st, changelist, changelist_grad, profile)
+
+    bounds = quiet_points(changelist, segment_changes)
+    seg_starts = np.concatenate([[0], bounds])
+    seg_ends = np.concatenate([bounds, [changelist.size]])
+    seg_bufs = buffer_states(changelist, st.initial_bufs, seg_starts)
+
+    seg_states = []
+    for k, (start, bufs) in enumerate(zip(seg_starts, seg_bufs)):
+        ss = copy.copy(st)
+        ss.current_bufs = bufs
+        if k:
+            ss.t_end = changelist['time'][start - 1]
+            ss.steps = 1 # only matters for checking the quiet point
+        seg_states.append(ss)
+
+    segments = [ changelist[start:end] for start, end in zip(seg_starts, seg_ends) ]
+    seg_profiles = [ None if profile is None else CompileProfile() for _ in segments ]
+    if profile is not None:
+        profile.lap('segment', segments=len(segments))
+
+    if len(segments) == 1:
+        results = [ compile_segment(seg_states[0], segments[0], COUNTER_MAX, seg_profiles[0]) ]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            results = list( pool.map(compile_segment, seg_states, segments, [COUNTER_MAX] * len(segments), seg_profiles) )
+    if profile is not None:
+        profile.lap('parallel')
+        for r in results:
+            profile.add(r[3])
+
+    removed = warn_removed(changelist, np.concatenate([r[2] for r in results]))
+
+    bdata = np.empty(MARGA_BUFS + sum(r[0].size for r in results) + 1, dtype=np.uint32)
+    buf_range = np.arange(MARGA_BUFS)
+    bdata[:MARGA_BUFS] = instb_array(MARGA_BUFS - 1 - buf_range, buf_range, st.initial_bufs[::-1])
+    addr = MARGA_BUFS
+    for words, *_ in results:
+        bdata[addr:addr + words.size] = words
+        addr += words.size
+    bdata[-1] = insta(IFINISH, 0)
+    if profile is not None:
+        profile.lap('warnings', words=bdata.size)
+
+    if state is not None:
+        end_state = results[-1][1]
+        state.__dict__.update(end_state.__dict__)
+        state.last_change = np.max([r[1].last_change for r in results], axis=0)
+        state.grad_t_last = grad_t_last
+        state.removed = removed
+        state.steps = sum(r[1].steps for r in results) - len(results) + 1
+        state.machine_code = bdata
+    if opt_level:
+        return optimise(bdata, profile=profile)
     return bdata
 
 CIC_SLOWEST_RATE_NEAREST_POW2 = 1 << np.ceil(np.log2(CIC_SLOWEST_RATE)).astype(int)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# Simulator-format CSV files (csv_version_0.2, as written by the marga
+# simulator and maremu.write_csv()), and columnar binary copies of
+# them that load much faster than parsing the text. A converted copy
+# is stored next to its CSV file with the extension .mcol, and load()
+# uses it whenever it is up to date, i.e. the CSV file has the same
+# size and modification time as when it was converted.
+#
+# Usage:
+# python marcsv.py /tmp/marga_sim.csv csvs/*.csv # convert CSV files
+# data = marcsv.load("/tmp/marga_sim.csv") # rows of the CSV, as int64
+
+import os, sys, json, itertools, tempfile
+import numpy as np
+
+csv_version = "csv_version_0.2"
+col_ext = ".mcol"
+magic = b"MARCOL\0\0"
+format_version = 1
+align = 64
+chunk_rows = 1 << 16 # rows parsed at a time
+
+def header_columns(line):
+    """ Column names from the first line of a CSV file, after checking its version """
+    cols = [c.strip() for c in line.lstrip('#').split(',')]
+    assert cols[-1] == csv_version, "Wrong CSV format"
+    return cols[:-1]
+
+def col_dtype(name):
+    """ Storage type of a column in the columnar files """
+    if name == 'clock cycles':
+        return np.dtype('<i8')
+    elif name.startswith('ocra1_'): # 18-bit DACs
+        return np.dtype('<u4')
+    elif name.endswith(('_valid', '_rst_n', '_en', '_gate', 'trig_out')): # single bits
+        return np.dtype('u1')
+    return np.dtype('<u2')
+
+def read_chunks(path, rows=chunk_rows):
+    """Parse a CSV file in chunks of rows, so that memory use doesn't
+    depend on its length. Returns the column names and a generator of
+    int64 arrays of shape (rows, columns)."""
+    f = open(path, 'r')
+    try:
+        cols = header_columns(f.readline())
+    except BaseException:
+        f.close()
+        raise
+
+    def chunks():
+        with f:
+            while True:
+                lines = list(itertools.islice(f, rows))
+                if not lines:
+                    return
+                lines = [ l for l in lines if l[:1] != '#' and l.strip() ] # loadtxt warns about chunks without data
+                if lines:
+                    yield np.loadtxt(lines, delimiter=',', comments='#', dtype=np.int64, ndmin=2)
+
+    return cols, chunks()
+
+def count_rows(path):
+    """ Number of data rows in a CSV file, i.e. lines that aren't blank or comments """
+    rows = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line[:1] != b'#' and line.strip():
+                rows += 1
+    return rows
+
+def col_path(path):
+    return path + col_ext
+
+def convert(path, out_path=None):
+    """Convert a CSV file into a columnar file (by default next to it),
+    reading it in chunks. Returns the path of the columnar file."""
+    if out_path is None:
+        out_path = col_path(path)
+
+    st = os.stat(path)
+    rows = count_rows(path)
+    cols, chunks = read_chunks(path)
+
+    dtypes = [col_dtype(c) for c in cols]
+    offsets = np.cumsum([0] + [-(-rows * dt.itemsize // align) * align for dt in dtypes])
+    header = json.dumps({'columns': cols, 'dtypes': [dt.str for dt in dtypes], 'rows': rows,
+                         'csv_size': st.st_size, 'csv_mtime_ns': st.st_mtime_ns}).encode()
+    data_start = -(-(len(magic) + 8 + len(header)) // align) * align
+
+    # write to a temporary file first, so that readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out_path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(magic + np.array([format_version, len(header)], dtype='<u4').tobytes() + header)
+            f.truncate(data_start + offsets[-1])
+        if offsets[-1]:
+            out = np.memmap(tmp_path, dtype=np.uint8, mode='r+', offset=data_start, shape=(int(offsets[-1]),))
+            r = 0
+            for data in chunks:
+                assert data.shape[1] == len(cols) and r + data.shape[0] <= rows, "Malformed CSV file"
+                for k, dt in enumerate(dtypes):
+                    col = data[:, k]
+                    assert np.all(col == col.astype(dt)), "Value out of range in column " + cols[k]
+                    out[offsets[k] + r * dt.itemsize:offsets[k] + (r + col.size) * dt.itemsize] = col.astype(dt).view(np.uint8)
+                r += data.shape[0]
+            assert r == rows, "Malformed CSV file"
+            out.flush()
+            del out
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return out_path
+
+def read_col_file(path, csv_stat=None):
+    """Columns of a columnar file, memory-mapped, as (names, arrays);
+    None if csv_stat is given and doesn't match the CSV file the
+    columnar file was converted from, or if it is from a later version."""
+    with open(path, 'rb') as f:
+        head = f.read(len(magic) + 8)
+        if len(head) < len(magic) + 8 or head[:len(magic)] != magic:
+            return None
+        version, header_len = np.frombuffer(head[len(magic):], dtype='<u4')
+        if version > format_version:
+            return None
+        header = json.loads(f.read(header_len).decode())
+    if csv_stat is not None and (header['csv_size'], header['csv_mtime_ns']) != (csv_stat.st_size, csv_stat.st_mtime_ns):
+        return None
+
+    data_start = -(-(len(magic) + 8 + int(header_len)) // align) * align
+    rows = header['rows']
+    arrays, offset = [], 0
+    for dt in header['dtypes']:
+        dt = np.dtype(dt)
+        arrays.append( np.memmap(path, dtype=dt, mode='r', offset=data_start + offset, shape=(rows,)) if rows else np.zeros(0, dtype=dt) )
+        offset += -(-rows * dt.itemsize // align) * align
+    return header['columns'], arrays
+
+def up_to_date_columns(path):
+    """ Columns of the columnar copy of a CSV file (see read_col_file()), or None if there isn't an up-to-date copy """
+    cp = col_path(path)
+    if not os.path.exists(cp):
+        return None
+    try:
+        return read_col_file(cp, os.stat(path))
+    except (OSError, ValueError, KeyError):
+        return None # being replaced by another process, or damaged
+
+def iter_chunks(path, rows=chunk_rows):
+    """ Same as read_chunks(), but reading from the columnar copy of the CSV file if it is up to date """
+    cols = up_to_date_columns(path)
+    if cols is None:
+        return read_chunks(path, rows)
+
+    names, arrays = cols
+    def chunks():
+        n = arrays[0].size if arrays else 0
+        for r in range(0, n, rows):
+            data = np.empty((min(rows, n - r), len(arrays)), dtype=np.int64)
+            for k, a in enumerate(arrays):
+                data[:, k] = a[r:r + rows]
+            yield data
+    return names, chunks()
+
+def load_columns(path):
+    """Column names and arrays of a CSV file: memory-mapped from its
+    columnar copy if that is up to date, otherwise parsed from the CSV
+    file as int64."""
+    cols = up_to_date_columns(path)
+    if cols is not None:
+        return cols
+
+    cols, chunks = read_chunks(path)
+    data = list(chunks)
+    data = np.concatenate(data) if data else np.zeros((0, len(cols)), dtype=np.int64)
+    return cols, [ data[:, k] for k in range(len(cols)) ]
+
+def load(path):
+    """ Rows of a CSV file as a 2D int64 array, like np.loadtxt(); see load_columns() """
+    cols, arrays = load_columns(path)
+    data = np.empty((arrays[0].size if arrays else 0, len(cols)), dtype=np.int64)
+    for k, a in enumerate(arrays):
+        data[:, k] = a
+    return data
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python {:s} <csv_file.csv> [<csv_file.csv> ...]".format(sys.argv[0]))
+        exit()
+    for p in sys.argv[1:]:
+        print(convert(p))
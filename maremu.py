@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+#
+# Emulator of the marga instruction FSM and output buffers, for
+# checking marcompile output without the Verilator model of the HDL,
+# and a decompiler/disassembler for inspecting compiled programs.
+#
+# Timing follows the model that marcompile assumes (see
+# marmachine.issue_times() and output_times()): every instruction takes
+# one cycle, apart from IWAIT which takes its data + 3 cycles. A buffer
+# write with delay d that is issued at cycle r is output at max(r, time
+# of the buffer's previous output) + d + 1, i.e. a busy buffer starts
+# counting the delay once it has output its previous value. The
+# gradient SPI interfaces aren't modelled: gradient outputs appear in
+# the CSV columns after the buffer latencies supplied, so updates that
+# are too frequent for the SPI bus aren't delayed like in the HDL.
+#
+# Example, checking a CSV file without the simulator:
+# prog = marcompile.csv2bin("csvs/test_single.csv", quick_start=False)
+# data = maremu.emulate_csv(prog) # rows as in the CSV file, with the initial offset added
+# sd, initial_bufs = maremu.decompile(prog) # dictionary for marcompile.dict2bin()
+# print(maremu.listing(prog, 0, 40))
+# print(maremu.analyse(prog)) # duration, memory use, RX samples and gradient update rate
+
+import numpy as np
+
+from marmachine import *
+import marcompile as mc
+
+import pdb
+st = pdb.set_trace
+
+# CSV columns, in the order written by the simulator and read by marcompile.csv2bin()
+csv_cols = mc.col_arr[:25]
+csv_header = ", ".join(csv_cols) + ", csv_version_0.2"
+
+# Column values before anything has been output
+csv_reset = np.zeros(len(csv_cols), dtype=np.int64)
+csv_reset[5:9] = 0x8000 # GPA-FHDO DACs at midscale
+
+def emulate(program, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), trig_times=None):
+    """Emulate a machine-code program, as produced by marcompile.
+
+    initial_bufs: buffer outputs before the program runs (all zero after a reset)
+
+    Returns a list of (times, values) array tuples, one per buffer,
+    with the cycles at which the buffer outputs change (or are
+    rewritten) and the values it outputs; the first entry of each is the
+    value in initial_bufs at time 0. Also returns the cycle at which the
+    program finishes."""
+
+    instrs = disassemble(program)
+    issue, end = issue_times(instrs, trig_times)
+    idata, out = output_times(instrs, issue)
+    tgt = instrs['tgt'][idata]
+    assert np.all(tgt < MARGA_BUFS), "Unknown target buffer"
+
+    timeline = []
+    for b in range(MARGA_BUFS):
+        sel = tgt == b
+        timeline.append( (np.concatenate([[0], out[sel]]),
+                          np.concatenate([[initial_bufs[b]], instrs['data'][idata[sel]]]).astype(np.uint16)) )
+
+    return timeline, end
+
+def merge_times(*times):
+    """ Sorted union of several arrays of times """
+    t = np.sort(np.concatenate(times), kind='stable')
+    return t[np.concatenate([[True], t[1:] != t[:-1]])] if t.size else t
+
+def is_in(times, sorted_times):
+    """ Which elements of times are in the sorted array sorted_times """
+    idx = np.searchsorted(sorted_times, times)
+    return sorted_times[np.minimum(idx, sorted_times.size - 1)] == times if sorted_times.size else np.zeros(times.size, dtype=bool)
+
+def buf_values(timeline, b, times):
+    """ Output of buffer b at a set of sorted times (after all the changes at each time) """
+    t, v = timeline[b]
+    return v[np.searchsorted(t, times, side='right') - 1]
+
+def grad_words(timeline):
+    """Gradient SPI words, from the GRAD_MSB and GRAD_LSB outputs.
+    Returns (times, words, LSB written, MSB written), with an entry for
+    every time that either buffer is written."""
+    t_lsb, t_msb = timeline[GRAD_LSB][0][1:], timeline[GRAD_MSB][0][1:]
+    times = merge_times(t_lsb, t_msb)
+    word = (buf_values(timeline, GRAD_MSB, times).astype(np.int64) << 16) | buf_values(timeline, GRAD_LSB, times)
+    return times, word, is_in(times, t_lsb), is_in(times, t_msb)
+
+def fhdo_channels(times, word):
+    """ GPA-FHDO DAC updates from SPI words, as a list of (times, values) per channel """
+    # channel in bits 17-16, DAC value in bits 15-0
+    channel, value = (word >> 16) & 0x3, word & 0xffff
+    return [ (times[channel == k], value[channel == k]) for k in range(4) ]
+
+def ocra1_channels(times, word):
+    """ OCRA1 DAC updates from SPI words, as a list of (times, values) per channel """
+    # updates without the broadcast bit are output by the next broadcast update
+    broadcast = (word & 0x01000000) != 0
+    next_bc = np.minimum.accumulate( np.where(broadcast, np.arange(word.size), word.size)[::-1] )[::-1]
+    output = next_bc < word.size
+    times, word = times[next_bc[output]], word[output]
+    # channel in bits 26-25, DAC value in bits 19-2
+    channel, value = (word >> 25) & 0x3, (word >> 2) & 0x3ffff
+    return [ (times[channel == k], value[channel == k]) for k in range(4) ]
+
+def grad_transfers(timeline):
+    """Gradient SPI transfers: buffer 0 selects the board (bits 1-0)
+    and which of GRAD_LSB and GRAD_MSB (bits 8 and 9) start a transfer
+    when written; see test_base.fhd_config. Returns (times, words,
+    GRAD_CTRL values) for each transfer."""
+    times, word, lsb, msb = grad_words(timeline)
+    ctrl = buf_values(timeline, 0, times)
+    strobe = ( lsb & (ctrl & 0x100 != 0) ) | ( msb & (ctrl & 0x200 != 0) )
+    return times[strobe], word[strobe], ctrl[strobe]
+
+def grad_columns(timeline, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Gradient DAC updates, as a list of (times, values) for the four
+    GPA-FHDO channels followed by the four OCRA1 channels."""
+
+    times, word, ctrl = grad_transfers(timeline)
+    times = times + latencies[GRAD_MSB]
+
+    fhdo, oc1 = ctrl & 0x3 == 2, ctrl & 0x3 == 1
+    return fhdo_channels(times[fhdo], word[fhdo]) + ocra1_channels(times[oc1], word[oc1])
+
+def word_values(timeline, desc):
+    """ Output values of a COL_WORD column at every write to its buffer, including the initial value """
+    t, v = timeline[desc['buf'][0]]
+    return t, (v & desc['mask'][0]) >> desc['shift'][0]
+
+def csv_data(timeline, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Convert an emulated timeline into the rows of a simulator-format
+    CSV file (see csv_cols): the values at time 0, followed by a row
+    for every time at which any column changes."""
+
+    ct = mc.col_table(mc.grad_board) # only COL_WORD columns are used, which don't depend on the board
+    cols = []
+    for ci in range(1, len(csv_cols)):
+        desc = ct[ci]
+        if desc['kind'] == mc.COL_WORD:
+            t, v = word_values(timeline, desc)
+            cols.append( (t[1:] + latencies[desc['buf'][0]], v[1:]) )
+        else:
+            cols.append(None)
+    cols[4:12] = grad_columns(timeline, latencies)
+
+    times = merge_times([0], *[t for t, v in cols])
+    data = np.empty((times.size, len(csv_cols)), dtype=np.int64)
+    data[:, 0] = times
+    for ci, (t, v) in enumerate(cols):
+        # stable sort, so that the last of several changes at the same time takes effect
+        order = np.argsort(t, kind='stable')
+        vals = np.concatenate([[csv_reset[ci + 1]], np.asarray(v)[order]])
+        data[:, ci + 1] = vals[np.searchsorted(t[order], times, side='right')]
+
+    # only keep rows where something changes
+    changed = np.concatenate([[True], np.any(data[1:, 1:] != data[:-1, 1:], axis=1)])
+    return data[changed]
+
+def write_csv(path, data):
+    np.savetxt(path, data, fmt='%d', delimiter=',', header=csv_header)
+
+def emulate_csv(program, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16),
+                latencies=np.zeros(MARGA_BUFS, dtype=np.int32), trig_times=None):
+    """ Emulate a program and return its CSV rows; see emulate() and csv_data() """
+    timeline, _ = emulate(program, initial_bufs, trig_times)
+    return csv_data(timeline, latencies)
+
+def decompile(program, board=None, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Rebuild a sequence dictionary in the dict2bin() input format from
+    a program compiled by marcompile, for inspecting or checking
+    programs without their source.
+
+    If the program starts with the initial buffer writes added by
+    cl2bin(), times are relative to the compiler's time 0 and the
+    initial buffer values are returned; otherwise times are emulator
+    cycles and the buffers start from zero. Events are only included
+    when a column's value changes (except for the gradients, which
+    appear for every SPI transfer). Simultaneous gradient updates on
+    several GPA-FHDO channels appear at the staggered times they were
+    compiled to.
+
+    board: gradient board to decode GRAD_MSB/GRAD_LSB words for; the
+    selected marcompile.grad_board by default
+
+    Returns (dictionary, initial_bufs)."""
+
+    if board is None:
+        board = mc.grad_board
+
+    program = np.asarray(program, dtype=np.uint32)
+    head = disassemble(program[:MARGA_BUFS])
+    k = np.arange(MARGA_BUFS)
+    has_head = head.size == MARGA_BUFS and np.all(head['op'] == IDATA) \
+        and np.all(head['tgt'] == MARGA_BUFS - 1 - k) and np.all(head['delay'] == k)
+
+    timeline, _ = emulate(program)
+    if has_head:
+        initial_bufs = head['data'][::-1].astype(np.uint16)
+        # drop the initial writes, which are the first write to each buffer
+        timeline = [ (np.concatenate([[0], t[2:] - MARGA_BUFS]), np.concatenate([[initial_bufs[b]], v[2:]]))
+                     for b, (t, v) in enumerate(timeline) ]
+    else:
+        initial_bufs = np.zeros(MARGA_BUFS, dtype=np.uint16)
+
+    ct = mc.col_table(board)
+    sd = {}
+    for ci, name in enumerate(mc.col_arr[1:], 1):
+        desc = ct[ci]
+        lat = latencies[desc['buf'][0]]
+        if desc['kind'] == mc.COL_WORD:
+            t, v = word_values(timeline, desc)
+        elif desc['kind'] == mc.COL_SPLIT:
+            lsb, msb = desc['buf']
+            t = merge_times([0], timeline[lsb][0], timeline[msb][0])
+            v = buf_values(timeline, lsb, t).astype(np.int64) | (buf_values(timeline, msb, t).astype(np.int64) & 0x7fff) << 16
+        else:
+            continue
+        changed = np.flatnonzero(v[1:] != v[:-1]) + 1
+        if changed.size:
+            sd[name] = (t[changed] + lat, v[changed].astype(np.int64))
+
+    times, word, _, _ = grad_words(timeline)
+    times = times + latencies[GRAD_MSB]
+    if board == "gpa-fhdo":
+        names, cols = mc.col_arr[5:9], fhdo_channels(times, word)
+    elif board == "ocra1":
+        names, cols = mc.col_arr[9:13], ocra1_channels(times, word)
+    else:
+        raise ValueError("Unknown grad board")
+    for name, (t, v) in zip(names, cols):
+        if t.size:
+            sd[name] = (t, v)
+
+    # same key order as the columns
+    sd = { name: sd[name] for name in mc.col_arr if name in sd }
+    return sd, initial_bufs
+
+spi_cycles_per_tx = 30 # gradient SPI clock cycles per transfer, including some overhead; as in grad_board
+
+def rx_windows(timeline, end, channel):
+    """RX windows of a channel, from its rx*_en column; a window that is
+    still open when the program finishes is closed at the end cycle.
+    Returns (start cycles, end cycles, decimation rates), with the rate
+    last written to rx*_rate before each window opened (0 if none)."""
+    ct = mc.col_table(mc.grad_board) # RX columns don't depend on the board
+    t, en = word_values(timeline, ct[mc.col_arr.index('rx{:d}_en'.format(channel))])
+    t = np.concatenate([t, [max(end, t[-1])]])
+    edges = np.diff(np.concatenate([[0], en.astype(np.int8), [0]]))
+    starts, ends = t[edges == 1], t[edges == -1]
+
+    # rate words have a 2-bit address above the 12-bit data; address 0 sets the decimation rate
+    rt, rv = word_values(timeline, ct[mc.col_arr.index('rx{:d}_rate'.format(channel))])
+    sel = (rv >> CIC_RATE_DATAWIDTH) == 0
+    rt, rv = rt[sel], rv[sel] & ((1 << CIC_RATE_DATAWIDTH) - 1)
+    ri = np.searchsorted(rt, starts, side='right') - 1
+    rates = np.where(ri >= 0, rv[np.maximum(ri, 0)] if rv.size else 0, 0).astype(np.int64)
+    return starts, ends, rates
+
+def analyse(program, clk_MHz=122.88, mem_words=MARGA_MEM_WORDS):
+    """Static analysis of a program before it is run, for rejecting
+    sequences that are too long or too fast for the hardware. The
+    buffers start from zero, as after a reset, so the gradient control
+    settings come from the program's initial buffer writes. ITRIG
+    instructions are assumed to be triggered immediately.
+
+    Returns a dictionary with:
+    duration, duration_us: time until the program finishes
+    words, mem_words, mem_fraction: instructions, compared to the sequencer memory
+    rx0_windows, rx0_cycles, rx0_samples (and rx1_*): number and total
+    length of the RX windows, and the samples expected from them at the
+    decimation rates that were set
+    grad_updates, grad_max_rate: gradient SPI transfers, and the highest
+    update rate (MSPS) between any two of them; on OCRA1, only the
+    broadcast words count, since they output the channel words written
+    before them in a single update
+    grad_overruns: transfers that start before the previous one has
+    finished, at the SPI clock divider set in GRAD_CTRL (bits 7-2)
+    """
+
+    program = np.asarray(program, dtype=np.uint32)
+    timeline, end = emulate(program)
+    res = {'duration': int(end), 'duration_us': end / clk_MHz,
+           'words': program.size, 'mem_words': mem_words, 'mem_fraction': program.size / mem_words}
+
+    for k in range(2):
+        starts, ends, rates = rx_windows(timeline, end, k)
+        lengths = ends - starts
+        rx = 'rx{:d}_'.format(k)
+        res[rx + 'windows'] = starts.size
+        res[rx + 'cycles'] = int(lengths.sum())
+        res[rx + 'samples'] = int( (lengths // np.maximum(rates, 1))[rates > 0].sum() )
+
+    times, word, ctrl = grad_transfers(timeline)
+    update = (ctrl & 0x3 != 1) | (word & 0x01000000 != 0) # see ocra1_channels()
+    times, ctrl = times[update], ctrl[update]
+    dt = np.diff(times)
+    res['grad_updates'] = times.size
+    res['grad_max_rate'] = clk_MHz / dt.min() if dt.size else 0
+    res['grad_overruns'] = int(np.count_nonzero( dt < spi_cycles_per_tx * (((ctrl[:-1] >> 2) & 0x3f) + 1) ))
+    return res
+
+instr_names = {INOP: "NOP", IFINISH: "FINISH", IWAIT: "WAIT", ITRIG: "TRIG", ITRIGFOREVER: "TRIGFOREVER", IDATA: "DATA"}
+buf_names = ["GRAD_CTRL", "GRAD_LSB", "GRAD_MSB", "RX0_RATE", "RX1_RATE", "TX0_I", "TX0_Q", "TX1_I", "TX1_Q",
+             "DDS0_PHASE_LSB", "DDS0_PHASE_MSB", "DDS1_PHASE_LSB", "DDS1_PHASE_MSB", "DDS2_PHASE_LSB", "DDS2_PHASE_MSB",
+             "GATES_LEDS", "RX_CTRL"]
+
+def listing(program, start=0, count=None):
+    """ Human-readable disassembly of part of a program, one instruction per line with its address and issue cycle """
+    instrs = disassemble(program)
+    issue, _ = issue_times(instrs)
+    stop = instrs.size if count is None else min(start + count, instrs.size)
+    lines = []
+    for addr in range(start, stop):
+        ins = instrs[addr]
+        cycle = "{:12d}".format(issue[addr]) if addr < issue.size else " " * 12
+        name = instr_names.get(int(ins['op']), "0x{:02x}".format(int(ins['op'])))
+        if ins['op'] == IDATA:
+            tgt = buf_names[ins['tgt']] if ins['tgt'] < MARGA_BUFS else str(ins['tgt'])
+            lines.append("{:8d} {:s}  {:6s} {:15s} delay {:3d}  0x{:04x}".format(addr, cycle, name, tgt, ins['delay'], ins['data']))
+        else:
+            lines.append("{:8d} {:s}  {:6s} {:d}".format(addr, cycle, name, ins['data']))
+    return "\n".join(lines)
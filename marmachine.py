@@ -57,6 +57,8 @@ STATE_HALT = 8
 
 COUNTER_MAX = 0xffffff
 
+MARGA_MEM_WORDS = 0x10000 # instructions held in the sequencer memory (256 KiB BRAM)
+
 CIC_STAGES = 6 # N: number of CIC stages in the RX CICs
 # diff_delay = 1 # M: differential delay in comb section of CICs
 CIC_RATE_DATAWIDTH = 12 # 12-bit rate/data bus, 2-bit address
@@ -74,3 +76,81 @@ def instb(tgt: np.uint8, delay: np.uint8, data: np.uint16):
     assert 0 <= delay <= 255, "Delay out of range"
     assert (np.uint32(data) & 0xffff) == (np.uint32(data) & 0xffffffff), "Data out of range"
     return (IDATA << 24) | ( (tgt & 0x7f) << 24 ) | (delay << 16) | np.uint32(data)
+
+def insta_array(instr, data):
+    """ Instruction A for arrays of instructions and data; returns a uint32 array """
+    instr, data = np.broadcast_arrays(np.asarray(instr, dtype=np.int64), np.asarray(data, dtype=np.int64))
+    assert np.all(np.isin(instr, [INOP, IFINISH, IWAIT, ITRIG, ITRIGFOREVER])), "Unknown instruction"
+    assert np.all((data & COUNTER_MAX) == (data & 0xffffffff)), "Data out of range"
+    return ( (instr << 24) | (data & 0xffffff) ).astype(np.uint32)
+
+def instb_array(tgt, delay, data):
+    """ Instruction B for arrays of targets, delays and data; returns a uint32 array """
+    tgt, delay, data = np.broadcast_arrays(np.asarray(tgt, dtype=np.int64), np.asarray(delay, dtype=np.int64),
+                                           np.asarray(data, dtype=np.int64))
+    assert np.all(tgt <= 24), "Unknown target buffer"
+    assert np.all((0 <= delay) & (delay <= 255)), "Delay out of range"
+    assert np.all((data & 0xffff) == (data & 0xffffffff)), "Data out of range"
+    return ( (IDATA << 24) | ( (tgt & 0x7f) << 24 ) | (delay << 16) | (data & 0xffffffff) ).astype(np.uint32)
+
+# Decoded instruction: opcode (IDATA for instruction B), target buffer, delay and data
+instr_dtype = np.dtype([('op', np.uint8), ('tgt', np.uint8), ('delay', np.uint8), ('data', np.uint32)])
+
+def disassemble(program):
+    """ Decode an array of instructions; returns an instr_dtype array. Target and delay are 0 for instruction A. """
+    program = np.asarray(program, dtype=np.uint32)
+    b = (program >> 31) != 0
+    d = np.empty(program.size, dtype=instr_dtype)
+    d['op'] = np.where(b, IDATA, program >> 24)
+    d['tgt'] = np.where(b, (program >> 24) & 0x7f, 0)
+    d['delay'] = np.where(b, (program >> 16) & 0xff, 0)
+    d['data'] = np.where(b, program & 0xffff, program & 0xffffff)
+    return d
+
+def issue_times(instrs, trig_times=None):
+    """Cycle at which each instruction of a disassembled program is
+    issued, up to and including the first IFINISH (or ITRIGFOREVER).
+    Every instruction takes one cycle, apart from IWAIT which takes its
+    data + 3 cycles. trig_times: sorted cycles of external triggers that
+    ITRIG instructions wait for; without them, triggers are assumed to
+    arrive immediately.
+
+    Returns (issue cycles, end cycle), for the truncated program."""
+
+    op = instrs['op']
+    stops = np.flatnonzero( (op == IFINISH) | (op == ITRIGFOREVER) )
+    end = stops[0] + 1 if stops.size else op.size
+    op = op[:end]
+
+    durations = np.where(op == IWAIT, instrs['data'][:end].astype(np.int64) + 3, 1)
+    issue = np.concatenate([[0], np.cumsum(durations)])
+
+    if trig_times is not None:
+        # each ITRIG holds up the remainder of the program until the next trigger
+        trig_times = np.asarray(trig_times, dtype=np.int64)
+        for k in np.flatnonzero(op == ITRIG):
+            # issue[k] already includes the stalls of earlier ITRIGs
+            ti = np.searchsorted(trig_times, issue[k])
+            if ti < trig_times.size:
+                issue[k + 1:] += trig_times[ti] - issue[k]
+
+    return issue[:-1], issue[-1]
+
+def output_times(instrs, issue):
+    """Output cycle of each buffer write (IDATA instruction) of a
+    disassembled program, given the issue cycles from issue_times(). A
+    write with delay d issued at cycle r is output at max(r, output
+    cycle of the previous write to the same buffer) + d + 1.
+
+    Returns (indices of the writes in the program, output cycles)."""
+
+    idata = np.flatnonzero(instrs['op'][:issue.size] == IDATA)
+    tgt, r = instrs['tgt'][idata], issue[idata]
+    d1 = instrs['delay'][idata].astype(np.int64) + 1
+    out = np.empty(idata.size, dtype=np.int64)
+    for b in np.unique(tgt):
+        sel = np.flatnonzero(tgt == b)
+        # with D_k = sum(d_0..k + 1), out_k - D_k = max(r_k - D_(k-1), out_(k-1) - D_(k-1))
+        dsum = np.cumsum(d1[sel])
+        out[sel] = np.maximum.accumulate(r[sel] - (dsum - d1[sel])) + dsum
+    return idata, out
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Binary sequence files: an integer sequence dictionary (as used by
+# marcompile.dict2bin()) stored as raw per-key arrays, optionally with
+# its compiled program and the settings it was compiled with. Loading
+# memory-maps the arrays, so large sequences are neither parsed nor
+# copied until they're used.
+#
+# File layout: magic, format version and header length (uint32 each),
+# a JSON header describing each array and the metadata, then the raw
+# little-endian arrays, each starting on an align-byte boundary.
+#
+# Example:
+# marseq.save("scan.mseq", sd, machine_code=prog, initial_bufs=ib, latencies=lat, board="ocra1")
+# f = marseq.load("scan.mseq")
+# prog = f['machine_code'] # None if the file has no program
+# sd = f['seq'] # dictionary of memory-mapped (times, values) arrays
+
+import os, json, tempfile
+import numpy as np
+
+import marcompile as mc
+
+magic = b"MARSEQ\0\0"
+format_version = 1 # increment when the layout changes; older files are still read
+align = 64
+
+def save(path, sd, machine_code=None, initial_bufs=None, latencies=None, board=None, settings={}):
+    """Write an integer sequence dictionary, and optionally its compiled
+    program, the initial_bufs and latencies it was compiled with, the
+    gradient board (the selected marcompile.grad_board by default) and
+    a JSON-serialisable dictionary of other settings, such as the LO
+    frequencies and RX rates, to a sequence file. Times are stored as
+    int64, values as int64 unless they already have an integer type."""
+
+    if board is None:
+        board = mc.grad_board
+
+    arrays = []
+    for name, (times, vals) in sd.items():
+        vals = np.asarray(vals)
+        if vals.dtype.kind not in 'iu':
+            vals = vals.astype(np.int64)
+        arrays += [ ('seq/{:s}/t'.format(name), np.asarray(times, dtype=np.int64)), ('seq/{:s}/v'.format(name), vals) ]
+    for name, a, dtype in [ ('machine_code', machine_code, np.uint32), ('initial_bufs', initial_bufs, np.uint16),
+                            ('latencies', latencies, np.int32) ]:
+        if a is not None:
+            arrays.append( (name, np.asarray(a, dtype=dtype)) )
+
+    arrays = [ (name, np.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<'))) for name, a in arrays ]
+    table, offset = [], 0
+    for name, a in arrays:
+        table.append( {'name': name, 'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset} )
+        offset += -(-a.nbytes // align) * align
+
+    header = json.dumps({'keys': list(sd), 'grad_board': board, 'settings': settings, 'arrays': table}).encode()
+    data_start = -(-(len(magic) + 8 + len(header)) // align) * align
+
+    # write to a temporary file first, so that a failed save doesn't leave a partial file behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(magic + np.array([format_version, len(header)], dtype='<u4').tobytes() + header)
+            for entry, (_, a) in zip(table, arrays):
+                f.seek(data_start + entry['offset'])
+                a.tofile(f)
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def load(path, mmap=True):
+    """Read a sequence file written by save(). With mmap, the arrays
+    are read-only views of the memory-mapped file; otherwise they're
+    read into memory.
+
+    Returns a dictionary with the sequence dictionary ('seq'), the
+    'machine_code', 'initial_bufs' and 'latencies' (None if they weren't
+    saved), 'grad_board', 'settings' and the file's 'version'."""
+
+    with open(path, 'rb') as f:
+        head = f.read(len(magic) + 8)
+        assert head[:len(magic)] == magic, "Not a marga sequence file"
+        version, header_len = np.frombuffer(head[len(magic):], dtype='<u4')
+        assert version <= format_version, \
+            "Sequence file version {:d} is newer than the latest supported ({:d})".format(version, format_version)
+        header = json.loads(f.read(header_len).decode())
+        data_start = -(-(len(magic) + 8 + int(header_len)) // align) * align
+        if not mmap:
+            f.seek(data_start)
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+
+    if mmap:
+        size = os.path.getsize(path) - data_start
+        buf = np.memmap(path, dtype=np.uint8, mode='r', offset=data_start, shape=(size,)) if size else np.zeros(0, dtype=np.uint8)
+
+    arrays = {}
+    for entry in header['arrays']:
+        dtype = np.dtype(entry['dtype'])
+        n = int(np.prod(entry['shape'], dtype=np.int64))
+        arrays[entry['name']] = buf[entry['offset']:entry['offset'] + n * dtype.itemsize].view(dtype).reshape(entry['shape'])
+
+    return {'seq': { name: (arrays['seq/{:s}/t'.format(name)], arrays['seq/{:s}/v'.format(name)]) for name in header['keys'] },
+            'machine_code': arrays.get('machine_code'), 'initial_bufs': arrays.get('initial_bufs'),
+            'latencies': arrays.get('latencies'), 'grad_board': header['grad_board'],
+            'settings': header['settings'], 'version': int(version)}
@@ -5,6 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import sys, pdb
 from local_config import fpga_clk_freq_MHz
+import marcsv
 st = pdb.set_trace
 
 if __name__ == "__main__":
@@ -21,7 +22,11 @@ if __name__ == "__main__":
     #                      usecols=(0,1),
     #                      names=True)
 
-    data = np.loadtxt(sys.argv[1], skiprows=2, delimiter=',')
+    # uses the columnar copy of the CSV file if there is one; skips the
+    # same rows as np.loadtxt(..., skiprows=2) did for simulator CSV files,
+    # whose second line is a comment, and keeps the first row of files
+    # written by maremu.write_csv(), which have no second comment line
+    data = marcsv.load(sys.argv[1])
     data[1:, 0] = data[1:, 0] - data[1, 0] + 1 # remove dead time in the beginning taken up by simulated memory writes
 
     time_us = data[:,0]/fpga_clk_freq_MHz
@@ -74,6 +74,35 @@ def send_packet(packet, socket):
 def command(server_dict, socket, print_infos=False, assert_errors=False):
     packet = construct_packet(server_dict)
     reply = send_packet(packet, socket)
+    return reply, check_status(reply, print_infos, assert_errors)
+
+class Pipeline:
+    """Commands sent to the server ahead of the replies to earlier
+    ones, which are read back in the same order; one thread can send
+    while another one reads the replies"""
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.unpacker = msgpack.Unpacker()
+
+    def send(self, server_dict):
+        self.socket.sendall(msgpack.packb(construct_packet(server_dict)))
+
+    def reply(self, print_infos=False, assert_errors=False):
+        """ Wait for the reply to the earliest command sent that hasn't had one yet; returns the same as command() """
+        while True:
+            try:
+                reply = next(self.unpacker)
+                break
+            except StopIteration:
+                buf = self.socket.recv(65536)
+                if not buf:
+                    raise ConnectionError("Server closed the connection")
+                self.unpacker.feed(buf)
+        return reply, check_status(reply, print_infos, assert_errors)
+
+def check_status(reply, print_infos=False, assert_errors=False):
+    """ Show the infos, warnings and errors in a server reply; returns its status """
     return_status = reply[5]
 
     if print_infos and 'infos' in return_status:
@@ -92,4 +121,4 @@ def command(server_dict, socket, print_infos=False, assert_errors=False):
             for k in return_status['errors']:
                 warnings.warn("SERVER ERROR: " + k, RuntimeWarning)
 
-    return reply, return_status
+    return return_status
@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 import server_comms as sc
 
 import marcompile as mc
+import marcsv
 import experiment as exp
 
 import pdb
@@ -99,8 +100,8 @@ def compare_csv(fname, sock, proc,
 
     # compare resultant CSV with the reference
     if self_ref:
-        rdata = np.loadtxt(source_csv, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
-        sdata = np.loadtxt(marga_sim_csv, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
+        rdata = marcsv.load(source_csv).astype(np.uint32)
+        sdata = marcsv.load(marga_sim_csv).astype(np.uint32)
 
         rdata[1:,0] -= rdata[1,0] # subtract off initial offset time
         sdata[1:,0] -= sdata[1,0] # subtract off initial offset time
@@ -140,8 +141,8 @@ def compare_dict(source_dict, ref_fname, sock, proc,
 
     ref_csv = os.path.join("csvs", ref_fname + ".csv")
     if ignore_start_delay:
-        rdata = np.loadtxt(ref_csv, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
-        sdata = np.loadtxt(marga_sim_csv, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
+        rdata = marcsv.load(ref_csv).astype(np.uint32)
+        sdata = marcsv.load(marga_sim_csv).astype(np.uint32)
 
         rdata[1:,0] -= rdata[1,0] # subtract off initial offset time
         sdata[1:,0] -= sdata[1,0] # subtract off initial offset time
@@ -192,8 +193,8 @@ def compare_expt_dict(source_dict, ref_fname, sock, proc,
 
     ref_csv = os.path.join("csvs", ref_fname + ".csv")
     if ignore_start_delay:
-        rdata = np.loadtxt(ref_csv, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
-        sdata = np.loadtxt(marga_sim_csv, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
+        rdata = marcsv.load(ref_csv).astype(np.uint32)
+        sdata = marcsv.load(marga_sim_csv).astype(np.uint32)
 
         rdata[1:,0] -= rdata[1,0] # subtract off initial offset time
         sdata[1:,0] -= sdata[1,0] # subtract off initial offset time
@@ -0,0 +1,1085 @@
+#!/usr/bin/env python3
+#
+# Standalone tests of the marcompile compiler -- these do not need
+# the MaRCoS server or the Verilator simulation.
+#
+# To run a single test, use e.g.:
+# python -m unittest test_marcompile.CompileTest.test_cl2bin_matches_ref
+
+import os, time, socket, threading, unittest, warnings, tempfile
+import numpy as np
+
+import marcompile as mc
+import marcache
+import maremu
+import marseq
+import marcsv
+try:
+    import experiment, msgpack # needs local_config.py and the server libraries
+except ModuleNotFoundError:
+    experiment = None
+
+import pdb
+st = pdb.set_trace
+
+def fake_server(delay=0):
+    """Socket connected to a thread that replies to server commands:
+    run_seq returns the number of words and a checksum of the program
+    as rx0_i and rx0_q, after a delay (s). Returns the socket and a
+    list of the commands received."""
+    s, conn = socket.socketpair()
+    log = []
+    def serve():
+        unp = msgpack.Unpacker()
+        with conn:
+            while True:
+                buf = conn.recv(65536)
+                if not buf:
+                    return
+                unp.feed(buf)
+                for pkt in unp:
+                    cmd = pkt[4]
+                    log.append(cmd)
+                    reply = { k: 0 for k in cmd }
+                    if 'run_seq' in cmd:
+                        time.sleep(delay)
+                        words = np.frombuffer(cmd['run_seq'], dtype=np.uint32)
+                        reply['run_seq'] = {'rx0_i': [words.size], 'rx0_q': [int(words.sum() % 100003)]}
+                    conn.sendall(msgpack.packb([128, pkt[1], 0, pkt[3], reply, {}]))
+    threading.Thread(target=serve, daemon=True).start()
+    return s, log
+
+def ignore_warnings(test, *categories):
+    """ Ignore warnings of these categories until the end of the test """
+    catcher = warnings.catch_warnings()
+    catcher.__enter__()
+    test.addCleanup(catcher.__exit__, None, None, None)
+    for c in categories:
+        warnings.simplefilter("ignore", c)
+
+def random_changelists(rng, n_changes=60, n_grad=10):
+    """ Random tuple changelists, including partial masks, redundant writes and simultaneous gradient events """
+    masks = [0xffff, 0x00ff, 0xff00, 0x1, 0x8000, 0x7fff, 0x3, 0xc]
+    cl = [ (np.int64(rng.integers(0, 80)), int(rng.choice([0, 3, 5, 9, 10, 15, 16])),
+            np.uint16(rng.integers(0, 4) * rng.choice([1, 0x101, 0x8001])), np.uint16(rng.choice(masks)))
+           for _ in range(rng.integers(1, n_changes)) ]
+    clg = []
+    for _ in range(rng.integers(0, n_grad)):
+        t = np.int64(rng.integers(0, 500))
+        clg += [ (t, 2, np.uint16(rng.integers(0, 0x400)), np.uint16(0xffff)),
+                 (t, 1, np.uint16(rng.integers(0, 3)), np.uint16(0xffff)) ]
+    return cl, clg
+
+def cl2bin_ref(changelist, changelist_grad,
+               initial_bufs=np.zeros(mc.MARGA_BUFS, dtype=np.uint16)):
+
+    """Original tuple-based version of marcompile.cl2bin(), kept as a
+    reference for verifying the array-based compiler.
+
+    Central compilation function; accept in two changelists,
+    changelist for all the direct-buffer outputs (TX, most configurable
+    parameters, etc) and the other, changelist_grad, for the outputs used
+    to control hardware with non-trivial internal timing behaviour
+    (currently only the gradient boards). Also accepts non-default initial
+    values to program the buffers to."""
+
+    # Process the grad changelist, depending on what GPA is being used etc
+    # Sort in pairs of changes, because otherwise channels can get mixed up
+    changelist_grad_paired = [ [k, m] for k, m in zip(changelist_grad[::2], changelist_grad[1::2]) ]
+    sortfn = lambda change: change[0]
+    # changelist_grad.sort(key=sortfn) # sort by time
+    sortfn_paired = lambda change: change[0][0]
+    changelist_grad_paired.sort(key=sortfn_paired) # sort by time
+    changelist_grad = [k for sl in changelist_grad_paired for k in sl] # https://stackabuse.com/python-how-to-flatten-list-of-lists/
+
+    t_last = [0, 0] # no updates have previously happened; [LSB, MSB]
+    spi_div = (initial_bufs[0] & 0xfc) >> 2
+    changelist_grad_shifted = []
+    num_chgs = [0, 0] # [LSB, MSB]
+    grad_vals = [initial_bufs[1], initial_bufs[2]] # [LSB, MSB] current output data
+    grad_vals_old = [0, 0] # [LSB, MSB] previous output data
+
+    for c in changelist_grad:
+        t = c[0]
+        idx = c[1] - 1 # 0 for LSB, 1 for MSB
+        msb = idx == 1
+        data = c[2]
+        # if data == grad_vals[idx]: # no actual change to buffer output
+        #     continue # skip this change
+        # else:
+        #     grad_vals_old[idx] = grad_vals[idx]
+        #     grad_vals[idx] = data # update the last known buffer value
+
+        if t == t_last[idx]:
+            num_chgs[idx] += 1
+            # assume the changes in changelist_grad are paired with LSBs/MSBs matching each other's grad channels stored sequentially,
+            # and that for each event, the MSB update is first
+            if mc.grad_board == "ocra1": # simultaneous with another grad update
+                if msb:
+                    if num_chgs[1]: # MSB buffer and not the first grad event on this timestep
+                        # turn broadcast off if this isn't the first grad event on this timestep
+                        data = data & ~np.uint16(0x0100)
+                        # return LSB back to old values, since this one is now done in the past
+                        grad_vals[:] = grad_vals_old # revert the last known buffer values
+                # else:
+                #     if data == grad_vals[idx]: # no actual change to buffer output compared to earlier LSB at this timestep
+                #         continue # skip this change
+
+                # move non-broadcast events back in time, so that synchronisation will be done in ocra1_iface core
+                changelist_grad_shifted.append( (c[0]-num_chgs[idx], c[1], data, c[3]) )
+                num_chgs[idx] += 1
+            elif mc.grad_board == "gpa-fhdo":
+                # don't do anything; currently will cause an error
+                # later since multiple events can't happen at the same
+                # time for GPA-FHDO
+                changelist_grad_shifted.append(c)
+        else:
+            if t - t_last[idx] < 24 * (1 + spi_div) + 2: #
+                warnings.warn("Gradient updates are too frequent for selected SPI divider. Missed samples are likely!", mc.MarGradWarning)
+
+            # if data == grad_vals[idx]: # no actual change to buffer output
+            #     continue # skip this change
+
+            t_last[idx] = t
+            grad_vals[idx] = data # update the last known buffer value
+            changelist_grad_shifted.append(c)
+            num_chgs = [0, 0]
+
+    changelist += changelist_grad_shifted
+    changelist.sort(key=sortfn) # sort by time
+
+    # Track removed instruction events, but only warn when the number exceeds a minimum
+    removed_instruction_warnings = []
+
+    # Process and combine the change list into discrete sets of operations at each time, i.e. an output list
+    def cl2ol(changelist):
+        current_bufs = initial_bufs.copy()
+        current_time = changelist[0][0]
+        unique_times = []
+        unique_changes = []
+        change_masks = np.zeros(mc.MARGA_BUFS, dtype=np.uint16)
+        changed = np.zeros(mc.MARGA_BUFS, dtype=bool)
+
+        def close_timestep(time):
+            ch_idces = np.where(changed)[0]
+            # buf_time_offsets = np.zeros(mc.MARGA_BUFS, dtype=int32)
+            buf_time_offsets = 0
+            unique_changes.append( [time, ch_idces, current_bufs[ch_idces], buf_time_offsets] )
+            change_masks[:] = np.zeros(mc.MARGA_BUFS, dtype=np.uint16)
+            changed[:] = np.zeros(mc.MARGA_BUFS, dtype=bool)
+
+        for time, buf, val, mask in changelist:
+            if time != current_time:
+                close_timestep(current_time)
+                current_time = time
+            buf_diff = (current_bufs[buf] ^ val) & mask
+            assert buf_diff & change_masks[buf] == 0, "Tried to set a buffer to two values at once"
+            if buf_diff == 0:
+                if buf not in (1, 2):
+                    # gradient buffers will have unneeded instructions
+                    # all the time, so not worth warning the user for
+                    # those
+                    removed_instruction_warnings.append( "Instruction at tick {:d}, buffer {:d}, value 0x{:04x}, mask 0x{:04x} will have no effect. Skipping...".format(time, buf, val, mask) )
+                continue
+            val_masked = val & mask
+            old_val_unmasked = current_bufs[buf] & ~mask
+            new_val = old_val_unmasked | val_masked
+            change_masks[buf] |= mask
+            current_bufs[buf] = new_val
+            changed[buf] = True
+
+        close_timestep(current_time)
+
+        return unique_changes
+
+    changes = cl2ol(changelist)
+
+    # warn about all the removed instructions if there are more than a maximum number
+    if len(removed_instruction_warnings) > mc.max_removed_instructions:
+        for riw in removed_instruction_warnings:
+            warnings.warn(riw, mc.MarRemovedInstructionWarning)
+        warnings.warn("NOTE: Fewer than {:d} removed-instruction warnings will not be printed -- keep this in mind when searching for the root cause.".format(mc.max_removed_instructions))
+
+    # Process time offsets
+    for ch, ch_prev in zip( reversed(changes[1:]), reversed(changes[:-1]) ):
+        # does the current timestep need to output more data than can
+        # fit into the time gap since the previous timestep?
+        timestep = np.int32(ch[0] - ch_prev[0])
+        timediff = np.int32(ch[1].size - timestep)
+        # if timestep < ch[1].size: # not enough time
+
+        if timediff > 0:
+            ch_prev[0] -= timediff # move prev. event into the past
+            ch_prev[3] = timediff # make prev. event's buffers output in its future
+
+    # convert to differential timesteps
+    last_time = 0
+    for ch in changes:
+        ch0 = ch[0]
+        ch[0] = ch0 - last_time
+        last_time = ch0
+
+    # Interpretation of each element of changes list:
+    # [time when all instructions for this change will have completed,
+    #  buffers that need to be changed,
+    #  values to set the buffers to,
+    #  the delay until the buffers will output their values]
+
+    ### Write out instructions
+
+    # Write out initial buffer values
+    bdata = []
+    addr = 0
+    states = initial_bufs
+    # reversed order, so that grad board is enabled last of all (to avoid spurious initial transfer)
+    for k, ib in enumerate(reversed(initial_bufs)):
+        bdata.append(mc.instb(mc.MARGA_BUFS-1-k, k, ib))
+
+    last_buf_time_left = np.zeros(mc.MARGA_BUFS, dtype=np.int32)
+    buf_time_left = np.zeros(mc.MARGA_BUFS, dtype=np.int32)
+    # buf_empty_time = np.zeros(mc.MARGA_BUFS, dtype=np.int32)
+    for event in changes:
+        b_instrs = event[1].size
+        dtime = event[0]
+
+        # soak up any extra time which is in excess of what the instructions need to execute synchronously
+        excess_dtime = dtime - b_instrs
+        excess_dtime_tmp = excess_dtime
+        while excess_dtime_tmp > 2: # delay of 3 or more cycles needed
+            wait_time = min(excess_dtime_tmp, mc.COUNTER_MAX + 3) # delay for the time instruction
+            bdata.append(mc.insta(mc.IWAIT, wait_time - 3))
+            excess_dtime_tmp -= wait_time
+        if excess_dtime_tmp: # final delay of 1 or 2 cycles
+            for k in range(dtime - b_instrs):
+                bdata.append(mc.insta(mc.INOP, 0))
+
+        # time left after delays from nops or waits
+        # dtime_eff could be increased later with a more advanced
+        # compiler, to make the buffers bear more of the internal
+        # delays
+        # dtime_eff = b_instrs
+
+        # count down the times until each channel buffer will be empty
+        buf_time_left -= excess_dtime
+        buf_time_left[buf_time_left < 0] = 0
+        this_time_offset = event[3]
+        for m, (ind, dat) in enumerate(zip(event[1], event[2])):
+            execution_delay = b_instrs - m - 1 #+ time - 2
+            btli = buf_time_left[ind]
+            buf_empty = btli <= m
+            if buf_empty: # buffer empty for this instruction; need an appropriate delay only for sync
+                # (check against m since with successive cycles, remaining buffers will empty out)
+                extra_delay = execution_delay + this_time_offset
+                buf_time_left[ind] = this_time_offset + b_instrs
+            else:
+                # buffer already not empty on this cycle
+                extra_delay = this_time_offset - btli + b_instrs - 1
+                buf_time_left[ind] += extra_delay + 1
+
+            bdata.append(mc.instb(ind, extra_delay, dat))
+
+        buf_time_left -= b_instrs # take into account execution time of this timestep
+
+    # Finish sequence
+    bdata.append(mc.insta(mc.IFINISH, 0))
+    return bdata
+
+class CompileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gb_orig = mc.grad_board
+        ignore_warnings(self, mc.MarUserWarning)
+
+    def tearDown(self):
+        mc.grad_board = self.gb_orig
+
+    def compile_both(self, cl, clg, initial_bufs):
+        """ Returns machine code from the array compiler and the reference compiler, or None where they raised an error """
+        res = []
+        for f in (mc.cl2bin, cl2bin_ref):
+            try:
+                res.append( np.array(f(list(cl), list(clg), initial_bufs), dtype=np.uint32) )
+            except AssertionError:
+                res.append(None)
+        return res
+
+    def test_cl2bin_matches_ref(self):
+        """ Array compiler produces exactly the same machine code as the tuple-based one """
+        rng = np.random.default_rng(0)
+        for k in range(400):
+            mc.grad_board = ("gpa-fhdo", "ocra1")[k % 2]
+            cl, clg = random_changelists(rng)
+            initial_bufs = rng.integers(0, 0x400, mc.MARGA_BUFS).astype(np.uint16)
+            new, ref = self.compile_both(cl, clg, initial_bufs)
+            if ref is None:
+                self.assertIsNone(new)
+            else:
+                np.testing.assert_array_equal(new, ref)
+
+    def test_cl2bin_conflict(self):
+        """ Two different values for the same buffer bits at the same time """
+        cl = [ (100, 5, 1, 0xffff), (100, 5, 2, 0xffff) ]
+        with self.assertRaises(AssertionError):
+            mc.cl2bin(cl, [])
+
+    def test_cl2bin_masked(self):
+        """ Writes to separate bit fields of one buffer at the same time are merged into one instruction """
+        cl = [ (100, 15, 0x1, 0x1), (100, 15, 0x200, 0xff00) ]
+        words = mc.cl2bin(cl, [])
+        self.assertEqual(words[-2], mc.instb(15, 0, 0x201))
+
+    def test_append_matches_full(self):
+        """ Appending later events to a compiled program gives the same machine code as compiling them all at once """
+        rng = np.random.default_rng(1)
+        for k in range(100):
+            mc.grad_board = ("gpa-fhdo", "ocra1")[k % 2]
+            initial_bufs = rng.integers(0, 0x400, mc.MARGA_BUFS).astype(np.uint16)
+            parts = []
+            for p in range(3):
+                cl, clg = random_changelists(rng)
+                parts.append( (mc.cl_array(cl), mc.cl_array(clg)) )
+                for c in parts[-1]:
+                    c['time'] += 1000 * p
+            try:
+                ref = mc.cl2bin(np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]), initial_bufs)
+            except AssertionError:
+                continue
+
+            state = mc.CompileState()
+            mc.cl2bin(*parts[0], initial_bufs, state=state)
+            for p in parts[1:]:
+                self.assertIsNotNone( mc.cl2bin_append(state, *p) )
+            np.testing.assert_array_equal(state.machine_code, ref)
+
+    def test_append_overlapping(self):
+        """ Events that aren't later than the compiled program can't be appended """
+        state = mc.CompileState()
+        prog = mc.cl2bin([ (100, 5, 1, 0xffff), (200, 5, 2, 0xffff) ], [], state=state)
+        self.assertIsNone( mc.cl2bin_append(state, [ (200, 6, 1, 0xffff) ], []) )
+        self.assertIsNone( mc.cl2bin_append(state, [ (201, 6, 1, 0xffff), (201, 7, 1, 0xffff) ], []) ) # no time to issue 2 instructions
+        np.testing.assert_array_equal(state.machine_code, prog)
+        self.assertIsNone( mc.cl2bin_append(mc.CompileState(), [ (300, 6, 1, 0xffff) ], []) ) # nothing compiled yet
+
+    def test_parallel_matches_serial(self):
+        """ Compiling segments in parallel gives the same machine code and final state as compiling serially """
+        mc.grad_board = "ocra1"
+        t = np.arange(300, dtype=np.int64) * 400 + 1000
+        sd = {'tx0_i': (t, np.arange(t.size) % 7), 'tx_gate': (t + 10, np.arange(t.size) % 2),
+              'ocra1_vx': (t + 100, np.arange(t.size) * 5), 'ocra1_vy': (t + 100, np.arange(t.size) * 3),
+              'leds': (t[::3], np.arange(t[::3].size) % 256) }
+        cl, clg = mc.dict2cl(sd)
+        self.assertGreater(mc.quiet_points(mc.merge_changelists(mc.CompileState(), cl, clg)[0], 50).size, 10)
+
+        st_ser, st_par = mc.CompileState(), mc.CompileState()
+        ref = mc.cl2bin(cl, clg, state=st_ser)
+        np.testing.assert_array_equal(mc.cl2bin_parallel(cl, clg, state=st_par, processes=2, segment_changes=50), ref)
+        for a in ('current_bufs', 'last_change', 'grad_t_last'):
+            np.testing.assert_array_equal(getattr(st_par, a), getattr(st_ser, a))
+        self.assertEqual((st_par.t_end, st_par.steps), (st_ser.t_end, st_ser.steps))
+
+    def test_profile(self):
+        """ Profile counts add up to the machine code produced """
+        mc.grad_board = "gpa-fhdo"
+        t = np.arange(50, dtype=np.int64) * 400 + 1000
+        sd = {'tx0_i': (t, np.arange(t.size) % 7), 'fhdo_vx': (t + 100, np.arange(t.size) * 5) }
+        for processes in (None, 1):
+            prof = mc.CompileProfile()
+            words = mc.dict2bin(sd, profile=prof, processes=processes)
+            c = prof.counts
+            self.assertEqual(c['words'], words.size)
+            self.assertEqual(c['instructions'] + c['waits'] + c['nops'] + mc.MARGA_BUFS + 1, words.size)
+            self.assertEqual(c['events'], 3 * t.size)
+            self.assertEqual(c['timesteps'], 2 * t.size)
+            for stage in ('dict2cl', 'grad_shift', 'cl2ol', 'offsets', 'emit'):
+                self.assertGreaterEqual(prof.times[stage], 0)
+
+    def test_pad_words(self):
+        """ Padding instructions take up exactly the gap, with no waits shorter than 3 cycles """
+        cm_orig = mc.COUNTER_MAX
+        try:
+            mc.COUNTER_MAX = 20
+            gaps = np.arange(1, 200)
+            counts, words = mc.pad_words(gaps)
+            ops = words >> 24
+            cycles = np.where(ops == mc.IWAIT, (words & 0xffffff) + 3, 1)
+            self.assertTrue( np.all((words & 0xffffff)[ops == mc.IWAIT] <= mc.COUNTER_MAX) )
+            ends = np.cumsum(counts)
+            np.testing.assert_array_equal(np.add.reduceat(cycles, ends - counts), gaps)
+        finally:
+            mc.COUNTER_MAX = cm_orig
+
+    def test_optimise(self):
+        """ Optimised programs produce the same outputs at the same times with fewer instructions """
+        rng = np.random.default_rng(2)
+        t = 10 + np.arange(500) * 6
+        for board in ("gpa-fhdo", "ocra1"):
+            mc.grad_board = board
+            gk = 'fhdo_vx' if board == "gpa-fhdo" else 'ocra1_vx'
+            sd = {'tx0_i': (t, rng.integers(0, 0x10000, t.size)), 'tx0_q': (t, rng.integers(0, 0x10000, t.size)),
+                  gk: (t[::10] + 3, rng.integers(0, 0x8000, t[::10].size)), 'leds': (t[::7], np.arange(t[::7].size) % 256)}
+            ref = mc.dict2bin(sd)
+            prof = mc.CompileProfile()
+            opt = mc.dict2bin(sd, opt_level=1, profile=prof)
+            self.assertLess(opt.size, ref.size)
+            self.assertEqual(prof.counts['opt_saved'], ref.size - opt.size)
+            (tl_ref, end_ref), (tl_opt, end_opt) = maremu.emulate(ref), maremu.emulate(opt)
+            self.assertEqual(end_opt, end_ref)
+            for (tr, vr), (to, vo) in zip(tl_ref, tl_opt):
+                np.testing.assert_array_equal(to, tr)
+                np.testing.assert_array_equal(vo, vr)
+
+            # incremental and parallel compilation give the same optimised program
+            state = mc.CompileState()
+            mc.dict2bin({k: (tk[tk < 1500], vk[tk < 1500]) for k, (tk, vk) in sd.items()}, state=state, opt_level=1)
+            app = mc.dict2bin_append(state, {k: (tk[tk >= 1500], vk[tk >= 1500]) for k, (tk, vk) in sd.items()})
+            np.testing.assert_array_equal(app, opt)
+            np.testing.assert_array_equal(mc.dict2bin(sd, opt_level=1, processes=2), opt)
+
+    def test_patch(self):
+        """ Sequences that differ from a template only in their values are patched into its program """
+        rng = np.random.default_rng(3)
+        t = 100 + np.arange(300) * 9
+        for board, opt_level in (("gpa-fhdo", 0), ("ocra1", 1)):
+            mc.grad_board = board
+            gk = ('fhdo_vx', 'fhdo_vy') if board == "gpa-fhdo" else ('ocra1_vx', 'ocra1_vy')
+            tg = t[::10] + 3
+            def seq(seed):
+                r = np.random.default_rng(seed)
+                return {'tx0_i': (t, r.integers(1, 0x10000, t.size)), 'rx0_en': (t[::5], np.arange(t[::5].size) % 2),
+                        'tx_gate': (t[::3], np.arange(t[::3].size) % 2), 'lo0_freq': (np.array([50]), r.integers(1, 1 << 31, 1)),
+                        gk[0]: (tg, r.integers(1, 0x8000, tg.size)), gk[1]: (tg + (0 if board == "ocra1" else 200), r.integers(1, 0x8000, tg.size))}
+            sd = seq(0)
+            tpl = mc.PatchTemplate(sd, mc.dict2bin(sd, opt_level=opt_level))
+            for seed in (1, 2):
+                sd = seq(seed)
+                np.testing.assert_array_equal(mc.dict2bin_patch(tpl, sd), mc.dict2bin(sd, opt_level=opt_level))
+
+            # a value that no longer changes its buffer, different times or keys, or different latencies
+            sd['tx0_i'][1][5] = sd['tx0_i'][1][4]
+            self.assertIsNone(mc.dict2bin_patch(tpl, sd))
+            self.assertIsNone(mc.dict2bin_patch(tpl, dict(seq(1), tx0_i=(t + 1, t))))
+            self.assertIsNone(mc.dict2bin_patch(tpl, dict(seq(1), tx0_q=(t, t))))
+            self.assertIsNone(mc.dict2bin_patch(tpl, seq(1), latencies=np.ones(mc.MARGA_BUFS, dtype=np.int32)))
+
+    def test_patch_cols(self):
+        """ Rewriting the LO frequency words gives the same program as compiling with the new frequencies """
+        t = 100 + np.arange(50) * 30
+        def seq(lo0, lo1):
+            return {'lo0_freq': (np.array([50]), np.array([lo0])), 'lo1_freq': (np.array([50]), np.array([lo1])),
+                    'lo0_rst': (np.array([50, 51]), np.array([1, 0])), 'tx0_i': (t, np.arange(t.size) + 1)}
+        for opt_level in (0, 1):
+            prog = mc.dict2bin(seq(0x12345678, 0x12341234), opt_level=opt_level)
+            for lo0, lo1 in [(0x7fff0001, 0x10001), (0x40010001, 0x20002)]:
+                np.testing.assert_array_equal(mc.patch_cols(prog, {'lo0_freq': lo0, 'lo1_freq': lo1}),
+                                              mc.dict2bin(seq(lo0, lo1), opt_level=opt_level))
+            # LSB or MSB bits the same as the initial buffer values: writes would be left out
+            self.assertIsNone(mc.patch_cols(prog, {'lo1_freq': 0x10000}))
+            self.assertIsNone(mc.patch_cols(mc.dict2bin(seq(0x12345678, 0x5678)), {'lo1_freq': 0x10001}))
+
+    def test_split_program(self):
+        """ Programs split between TRs produce the same outputs, apart from the time between them """
+        mc.grad_board = "gpa-fhdo"
+        t0 = 1000 + np.arange(20) * 20000
+        sd = {'tx0_i': (np.sort(np.concatenate([t0 + k * 7 for k in range(50)])), np.arange(1000) % 997),
+              'rx0_en': (np.sort(np.concatenate([t0 + 2000, t0 + 6000])), np.tile([1, 0], 20)),
+              'fhdo_vx': (t0 + 8000, np.arange(20) * 100) }
+        prog = mc.dict2bin(sd)
+        self.assertEqual(len(mc.split_program(prog)), 1)
+        with self.assertRaises(AssertionError):
+            mc.split_program(prog, 400, min_gap=20000) # no idle time long enough
+
+        parts = mc.split_program(prog, 400, min_gap=1000)
+        self.assertGreater(len(parts), 1)
+        issue, _ = mc.issue_times(mc.disassemble(prog))
+        (tl_ref, _), start = maremu.emulate(prog), 0
+        for k, part in enumerate(parts):
+            self.assertLessEqual(part.size, 400)
+            head = mc.MARGA_BUFS if k else 0
+            end = start + part.size - head - (k < len(parts) - 1)
+            shift = issue[start] - head
+            t_end = issue[end] if end < issue.size else np.inf
+            tl, _ = maremu.emulate(part)
+            for b, ((t, v), (tr, vr)) in enumerate(zip(tl, tl_ref)):
+                if k: # the initial writes restore the buffer values at the split
+                    self.assertEqual(maremu.buf_values(tl, b, [head])[0], maremu.buf_values(tl_ref, b, [issue[start]])[0])
+                sel, sel_ref = t > head, (tr >= max(issue[start], 1)) & (tr < t_end)
+                np.testing.assert_array_equal(t[sel] + shift, tr[sel_ref])
+                np.testing.assert_array_equal(v[sel], vr[sel_ref])
+            start = end
+        self.assertEqual(start, issue.size)
+
+    def test_removed_table(self):
+        """ Changes with no effect are listed in the compile state, and only warned about above a threshold """
+        cl = [ (100, 5, 1, 0xffff), (200, 5, 1, 0xffff), (300, 15, 0x2, 0x3), (400, 15, 0x6, 0x7) ]
+        state = mc.CompileState()
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            mc.cl2bin(cl, [], state=state)
+            self.assertEqual(len(w), 0)
+        np.testing.assert_array_equal(state.removed, mc.cl_array([ (200, 5, 1, 0xffff) ]))
+
+        mr_orig = mc.max_removed_instructions
+        mc.max_removed_instructions = 0
+        try:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                mc.cl2bin(cl, [])
+            self.assertEqual(len(w), 2)
+            self.assertIn("tick 200, buffer 5", str(w[0].message))
+        finally:
+            mc.max_removed_instructions = mr_orig
+
+    def test_col_encode(self):
+        """ Column descriptor table encodes whole columns, including the two-word ones """
+        words, bufs, vals, masks = mc.col_encode(25, np.array([0x80012345, 0x10]), "gpa-fhdo") # lo0_freq
+        np.testing.assert_array_equal(words, [2, 2])
+        np.testing.assert_array_equal(bufs[:, 0], [mc.DDS0_PHASE_LSB, mc.DDS0_PHASE_MSB])
+        np.testing.assert_array_equal(vals, [[0x2345, 0x10], [0x8001, 0]])
+        np.testing.assert_array_equal(masks[:, 0], [0xffff, 0x7fff])
+
+        words, bufs, vals, masks = mc.col_encode(np.array([10, 24]), np.array([0x3ffff, 0x12]), "ocra1") # ocra1_vy, leds
+        np.testing.assert_array_equal(words, [2, 1])
+        np.testing.assert_array_equal(bufs[0], [mc.GRAD_MSB, mc.GATES_LEDS])
+        full = (0x3ffff << 2) | 0x00100000 | (1 << 25) | 0x01000000
+        np.testing.assert_array_equal(vals[:, 0], [full >> 16, full & 0xffff])
+        self.assertEqual(vals[0, 1], 0x1200)
+        self.assertEqual(masks[0, 1], 0xff00)
+
+    def test_col_encode_wrong_board(self):
+        with self.assertRaises(RuntimeError):
+            mc.col_encode(9, 0, "gpa-fhdo")
+        with self.assertRaises(RuntimeError):
+            mc.col_encode(5, 0, "ocra1")
+        with self.assertRaises(ValueError):
+            mc.col_encode(5, 0, "unknown")
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gb_orig = mc.grad_board
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sd = {'tx0_i': ( np.array([100, 110, 300]), np.array([1, 200, 0]) ),
+                   'fhdo_vx': ( np.array([500, 1000]), np.array([0x8000, 0x9000]) ) }
+
+    def tearDown(self):
+        mc.grad_board = self.gb_orig
+        self.tmpdir.cleanup()
+
+    def test_hit_miss(self):
+        mc.grad_board = "gpa-fhdo"
+        cache = marcache.CompileCache(self.tmpdir.name)
+        ref = mc.dict2bin(self.sd)
+        np.testing.assert_array_equal(mc.dict2bin(self.sd, cache=cache), ref)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 1, 'evictions': 0})
+
+        # a separate cache object (e.g. in another process) sees the same entry
+        cache2 = marcache.CompileCache(self.tmpdir.name)
+        np.testing.assert_array_equal(mc.dict2bin(self.sd, cache=cache2), ref)
+        self.assertEqual((cache2.hits, cache2.misses), (1, 0))
+        meta = cache2.lookup(cache2.key(self.sd, np.zeros(mc.MARGA_BUFS), np.zeros(mc.MARGA_BUFS)))[1]
+        self.assertEqual(meta['words'], ref.size)
+        self.assertEqual(meta['grad_board'], "gpa-fhdo")
+
+    def test_key(self):
+        cache = marcache.CompileCache(self.tmpdir.name)
+        ib, lat = np.zeros(mc.MARGA_BUFS, dtype=np.uint16), np.zeros(mc.MARGA_BUFS, dtype=np.int32)
+        k = cache.key(self.sd, ib, lat, "gpa-fhdo")
+        self.assertEqual(k, cache.key(dict(self.sd), ib.copy(), lat.copy(), "gpa-fhdo"))
+        self.assertNotEqual(k, cache.key(self.sd, ib, lat, "ocra1"))
+        ib[3] = 1
+        self.assertNotEqual(k, cache.key(self.sd, ib, lat, "gpa-fhdo"))
+        sd2 = dict(self.sd, tx0_i=(np.array([100, 110, 301]), np.array([1, 200, 0])))
+        self.assertNotEqual(k, cache.key(sd2, np.zeros_like(ib), lat, "gpa-fhdo"))
+
+    def test_eviction(self):
+        cache = marcache.CompileCache(self.tmpdir.name, max_bytes=1)
+        mc.dict2bin(self.sd, cache=cache)
+        self.assertEqual(cache.evictions, 1)
+        mc.dict2bin(self.sd, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+class SeqFileTest(unittest.TestCase):
+
+    def test_save_load(self):
+        """ Sequence dictionaries and programs are read back unchanged, with or without memory mapping """
+        sd = {'tx0_i': ( np.array([100, 110, 300]), np.array([1, 200, 0]) ),
+              'leds': ( np.array([50]), np.array([7], dtype=np.uint8) ),
+              'rx0_en': ( np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64) ) }
+        prog = mc.dict2bin(sd)
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, "seq.mseq")
+            marseq.save(path, sd, prog, np.arange(mc.MARGA_BUFS), board="ocra1", settings={'rx_divs': [400, 400]})
+            for mmap in (True, False):
+                f = marseq.load(path, mmap=mmap)
+                self.assertEqual(list(f['seq']), list(sd))
+                for name, (t, v) in sd.items():
+                    np.testing.assert_array_equal(f['seq'][name][0], t)
+                    np.testing.assert_array_equal(f['seq'][name][1], v)
+                self.assertEqual(f['seq']['leds'][1].dtype, np.uint8)
+                np.testing.assert_array_equal(f['machine_code'], prog)
+                np.testing.assert_array_equal(f['initial_bufs'], np.arange(mc.MARGA_BUFS))
+                self.assertIsNone(f['latencies'])
+                self.assertEqual((f['grad_board'], f['settings'], f['version']), ("ocra1", {'rx_divs': [400, 400]}, marseq.format_version))
+            self.assertIsInstance(marseq.load(path)['seq']['tx0_i'][0], np.memmap)
+
+            with open(path, 'r+b') as fh: # file from a later version
+                fh.seek(len(marseq.magic))
+                fh.write(np.array([marseq.format_version + 1], dtype='<u4').tobytes())
+            with self.assertRaises(AssertionError):
+                marseq.load(path)
+
+class CsvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gb_orig = mc.grad_board
+        ignore_warnings(self, mc.MarGradWarning)
+
+    def tearDown(self):
+        mc.grad_board = self.gb_orig
+
+    def test_columnar(self):
+        """ Columnar copies of CSV files load the same data, and are only used while they are up to date """
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, "test.csv")
+            with open(os.path.join("csvs", "test_fhd_many.csv")) as src, open(path, "w") as dst:
+                dst.write(src.read())
+            ref = np.loadtxt(path, skiprows=1, delimiter=',', comments='#').astype(np.int64)
+            np.testing.assert_array_equal(marcsv.load(path), ref)
+            np.testing.assert_array_equal(np.concatenate(list(marcsv.read_chunks(path, 7)[1])), ref)
+            with warnings.catch_warnings():
+                warnings.simplefilter("error") # chunks of only comments mustn't be parsed
+                np.testing.assert_array_equal(np.concatenate(list(marcsv.read_chunks(path, 1)[1])), ref)
+
+            self.assertEqual(marcsv.convert(path), path + ".mcol")
+            cols, arrays = marcsv.load_columns(path)
+            self.assertEqual(cols, maremu.csv_cols)
+            self.assertIsInstance(arrays[0], np.memmap)
+            np.testing.assert_array_equal(marcsv.load(path), ref)
+
+            # modified CSV file: the columnar copy is out of date
+            with open(path, "a") as f:
+                f.write("\n99999999, " + ", ".join(["0"] * (len(cols) - 1)))
+            self.assertNotIsInstance(marcsv.load_columns(path)[1][0], np.memmap)
+            self.assertEqual(marcsv.load(path).shape, (ref.shape[0] + 1, ref.shape[1]))
+
+            with open(path, "w") as f:
+                f.write("# clock cycles, tx0_i, csv_version_0.1\n0, 0\n")
+            with self.assertRaises(AssertionError):
+                marcsv.load(path)
+
+    def test_load_csvs(self):
+        """ The simulator CSV files load the same rows as np.loadtxt(..., skiprows=2), which plot_csv.py used before """
+        csvs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "csvs")
+        for fname in sorted(os.listdir(csvs)):
+            if fname.endswith(".csv"):
+                path = os.path.join(csvs, fname)
+                ref = np.loadtxt(path, skiprows=2, delimiter=',', ndmin=2).astype(np.int64)
+                np.testing.assert_array_equal(marcsv.load(path), ref, err_msg=fname)
+
+    def test_csv2bin_chunks(self):
+        """ Streaming csv2bin() in blocks of rows gives the same program as loading the whole CSV file """
+        with tempfile.TemporaryDirectory() as td:
+            for fname, board, lat in [ ("test_many_quick", "gpa-fhdo", 0), ("test_fhd_series", "gpa-fhdo", 276),
+                                       ("test_oc1_four", "ocra1", 268) ]:
+                mc.grad_board = board
+                path = os.path.join(td, fname + ".csv")
+                with open(os.path.join("csvs", fname + ".csv")) as src, open(path, "w") as dst:
+                    dst.write(src.read())
+                latencies = np.zeros(mc.MARGA_BUFS, dtype=np.int32)
+                latencies[1:3] = lat
+                for quick_start in [False, True] if lat == 0 else [False]: # quick start leaves no room for latencies
+                    ref = mc.csv2bin(path, quick_start=quick_start, latencies=latencies)
+                    for chunk_rows in [1, 2, 7, 1 << 16]:
+                        np.testing.assert_array_equal(mc.csv2bin(path, quick_start=quick_start, latencies=latencies,
+                                                                 chunk_rows=chunk_rows), ref, err_msg=fname)
+                marcsv.convert(path)
+                np.testing.assert_array_equal(mc.csv2bin(path, latencies=latencies, chunk_rows=5),
+                                              mc.csv2bin(path, latencies=latencies), err_msg=fname)
+
+class MachineTest(unittest.TestCase):
+
+    def test_array_encoders(self):
+        """ Array instruction encoders match the single-word ones """
+        data = np.array([0, 1, 0x1234, mc.COUNTER_MAX])
+        np.testing.assert_array_equal( mc.insta_array(mc.IWAIT, data), [mc.insta(mc.IWAIT, d) for d in data] )
+        tgts, delays, vals = np.array([0, 5, 16]), np.array([0, 17, 255]), np.array([0xffff, 0, 0x8000], dtype=np.uint16)
+        np.testing.assert_array_equal( mc.instb_array(tgts, delays, vals),
+                                       [mc.instb(t, d, v) for t, d, v in zip(tgts, delays, vals)] )
+
+    def test_disassemble(self):
+        prog = [mc.insta(mc.IWAIT, 0x123456), mc.instb(16, 255, 0xffff), mc.insta(mc.IFINISH, 0), mc.instb(5, 3, 0x1234)]
+        d = mc.disassemble(prog)
+        np.testing.assert_array_equal(d['op'], [mc.IWAIT, mc.IDATA, mc.IFINISH, mc.IDATA])
+        np.testing.assert_array_equal(d['tgt'], [0, 16, 0, 5])
+        np.testing.assert_array_equal(d['delay'], [0, 255, 0, 3])
+        np.testing.assert_array_equal(d['data'], [0x123456, 0xffff, 0, 0x1234])
+
+    def test_array_encoder_ranges(self):
+        with self.assertRaises(AssertionError):
+            mc.instb_array([5, 5], [10, 256], [0, 0])
+        with self.assertRaises(AssertionError):
+            mc.insta_array(mc.IWAIT, [mc.COUNTER_MAX + 1])
+        with self.assertRaises(AssertionError):
+            mc.insta_array(0x7, [0])
+
+class EmulatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gb_orig = mc.grad_board
+        ignore_warnings(self, mc.MarUserWarning)
+
+    def tearDown(self):
+        mc.grad_board = self.gb_orig
+
+    def test_timing(self):
+        """ Waits, delays, a busy buffer and a trigger """
+        prog = [ mc.instb(5, 0, 1), # issued at 0, output at 1
+                 mc.instb(5, 3, 2), # issued at 1, buffer busy until 1, output at 5
+                 mc.insta(mc.IWAIT, 10), # cycles 2 to 14
+                 mc.instb(5, 0, 3), # issued at 15
+                 mc.insta(mc.ITRIG, 0), # issued at 16, waits until 30
+                 mc.instb(6, 2, 4), # issued at 31
+                 mc.insta(mc.IFINISH, 0),
+                 mc.instb(6, 0, 5) ] # never issued
+        timeline, end = maremu.emulate(prog, trig_times=[10, 30])
+        np.testing.assert_array_equal(timeline[5][0], [0, 1, 5, 16])
+        np.testing.assert_array_equal(timeline[5][1], [0, 1, 2, 3])
+        np.testing.assert_array_equal(timeline[6][0], [0, 34])
+        np.testing.assert_array_equal(timeline[6][1], [0, 4])
+        self.assertEqual(end, 33)
+        self.assertEqual(maremu.emulate(prog)[1], 19)
+
+    def test_timing_triggers(self):
+        """ Each ITRIG waits for the next trigger after it is issued """
+        prog = [ mc.insta(mc.ITRIG, 0), # issued at 0, waits until 10
+                 mc.insta(mc.ITRIG, 0), # issued at 11, waits until 20
+                 mc.instb(5, 0, 1), # issued at 21
+                 mc.insta(mc.ITRIG, 0), # issued at 22, no later trigger: continues straight away
+                 mc.insta(mc.IFINISH, 0) ]
+        issue, end = mc.issue_times(mc.disassemble(prog), trig_times=[10, 20])
+        np.testing.assert_array_equal(issue, [0, 11, 21, 22, 23])
+        self.assertEqual(end, 24)
+        timeline, end = maremu.emulate(prog, trig_times=[10, 20])
+        np.testing.assert_array_equal(timeline[5][0], [0, 22])
+
+    def test_decompile(self):
+        """ Decompiled programs contain the value changes of their source dictionary """
+        mc.grad_board = "gpa-fhdo"
+        sd = {'tx0_i': (np.array([100, 110, 120, 130]), np.array([5, 5, 7, 3])), # repeated value
+              'fhdo_vx': (np.array([200, 300]), np.array([100, 0x8000])),
+              'fhdo_vy': (np.array([250]), np.array([1000])),
+              'tx_gate': (np.array([105, 125]), np.array([1, 0])),
+              'leds': (np.array([115]), np.array([0x42])),
+              'lo0_freq': (np.array([140]), np.array([0x12345678]))}
+        initial_bufs = np.zeros(mc.MARGA_BUFS, dtype=np.uint16)
+        initial_bufs[mc.TX0_I] = 3
+        latencies = np.zeros(mc.MARGA_BUFS, dtype=np.int32)
+        latencies[[mc.GRAD_LSB, mc.GRAD_MSB]] = 20
+        latencies[mc.TX0_I] = 4
+
+        dsd, dib = maremu.decompile(mc.dict2bin(sd, initial_bufs, latencies), latencies=latencies)
+        np.testing.assert_array_equal(dib, initial_bufs)
+        self.assertEqual(list(dsd), ['tx0_i', 'fhdo_vx', 'fhdo_vy', 'tx_gate', 'leds', 'lo0_freq'])
+        np.testing.assert_array_equal(dsd['tx0_i'][0], [100, 120, 130])
+        np.testing.assert_array_equal(dsd['tx0_i'][1], [5, 7, 3])
+        for key in ['fhdo_vx', 'fhdo_vy', 'tx_gate', 'leds', 'lo0_freq']:
+            np.testing.assert_array_equal(dsd[key][0], sd[key][0], err_msg=key)
+            np.testing.assert_array_equal(dsd[key][1], sd[key][1], err_msg=key)
+
+    def test_analyse(self):
+        """ Duration, RX windows and samples, and gradient update rate of a compiled program """
+        mc.grad_board = "gpa-fhdo"
+        initial_bufs = np.zeros(mc.MARGA_BUFS, dtype=np.uint16)
+        initial_bufs[0] = (1 << 9) | (1 << 8) | (10 << 2) | 2 # strobe on LSB and MSB writes, SPI div 10, GPA-FHDO
+        sd = {'rx0_rate': (np.array([100]), np.array([50])),
+              'rx0_en': (np.array([1000, 2000, 3000, 4010]), np.array([1, 0, 1, 0])),
+              'rx1_en': (np.array([500]), np.array([1])), # open until the end, without a rate set
+              'fhdo_vx': (np.array([1000, 2000, 2100]), np.array([1, 2, 3])) }
+        prog = mc.dict2bin(sd, initial_bufs)
+        sa = maremu.analyse(prog, clk_MHz=100)
+        self.assertEqual(sa['words'], prog.size)
+        self.assertEqual(sa['duration'], maremu.emulate(prog)[1])
+        self.assertAlmostEqual(sa['duration_us'], sa['duration'] / 100)
+        self.assertEqual((sa['rx0_windows'], sa['rx0_cycles'], sa['rx0_samples']), (2, 2010, 20 + 20))
+        self.assertEqual((sa['rx1_windows'], sa['rx1_samples']), (1, 0))
+        self.assertEqual(sa['grad_updates'], 3)
+        self.assertAlmostEqual(sa['grad_max_rate'], 1)
+        self.assertEqual(sa['grad_overruns'], 1) # 330 cycles needed for each transfer
+
+    def test_analyse_ocra1(self):
+        """ OCRA1 channels updated together are output by a single broadcast transfer """
+        mc.grad_board = "ocra1"
+        initial_bufs = np.zeros(mc.MARGA_BUFS, dtype=np.uint16)
+        initial_bufs[0] = (1 << 9) | (1 << 8) | (19 << 2) | 1 # strobe on LSB and MSB writes, SPI div 19, OCRA1
+        t = 1000 + np.arange(19) * 1000
+        sd = {'ocra1_vx': (t, np.arange(19) * 5 + 1), 'ocra1_vy': (t, np.arange(19) * 3 + 1), 'ocra1_vz': (t[::2], np.arange(10) + 1)}
+        sa = maremu.analyse(mc.dict2bin(sd, initial_bufs), clk_MHz=100)
+        self.assertEqual(sa['grad_updates'], 19)
+        self.assertAlmostEqual(sa['grad_max_rate'], 0.1)
+        self.assertEqual(sa['grad_overruns'], 0)
+
+    def test_csvs(self):
+        """ Compiled reference CSVs reproduce their source files, apart from the start time """
+        csvs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "csvs")
+        for fname, board, ctrl, lat in [ ("test_single_delays", "gpa-fhdo", 0, 0),
+                                         ("test_many_quick", "gpa-fhdo", 0, 0),
+                                         ("test_fhd_series", "gpa-fhdo", (1 << 9) | (1 << 8) | (10 << 2) | 2, 276),
+                                         ("test_oc1_four", "ocra1", (1 << 9) | (1 << 8) | (10 << 2) | 1, 268) ]:
+            mc.grad_board = board
+            initial_bufs = np.zeros(mc.MARGA_BUFS, dtype=np.uint16)
+            initial_bufs[0] = ctrl
+            latencies = np.zeros(mc.MARGA_BUFS, dtype=np.uint16)
+            latencies[1:3] = lat
+            source_csv = os.path.join(csvs, fname + ".csv")
+            prog = mc.csv2bin(source_csv, quick_start=False, initial_bufs=initial_bufs, latencies=latencies)
+            rdata = np.loadtxt(source_csv, skiprows=1, delimiter=',', comments='#').astype(np.int64)
+            edata = maremu.emulate_csv(prog, latencies=latencies.astype(np.int64))
+            rdata[1:, 0] -= rdata[1, 0]
+            edata[1:, 0] -= edata[1, 0]
+            np.testing.assert_array_equal(rdata, edata, err_msg=fname)
+
+@unittest.skipIf(experiment is None, "experiment.py can't be imported")
+class ExperimentTest(unittest.TestCase):
+    """ Experiment features that don't need the server; the socket is never connected """
+
+    def setUp(self):
+        self.gb_orig = mc.grad_board
+        mc.grad_board = experiment.grad_board
+        ignore_warnings(self, mc.MarUserWarning, mc.MarGradWarning)
+
+    def tearDown(self):
+        mc.grad_board = self.gb_orig
+
+    def expt(self, s=None, **kwargs):
+        return experiment.Experiment(prev_socket=socket.socket() if s is None else s, auto_leds=False, print_infos=False, **kwargs)
+
+    def tr(self, amp, t0=0):
+        return {'tx0': (t0 + np.array([10, 60]), np.array([amp, 0])),
+                'grad_vx': (t0 + np.array([5, 50, 100]), np.array([0.1, amp, 0])),
+                'rx0_en': (t0 + np.array([70, 300]), np.array([1, 0]))}
+
+    def test_retune_lo(self):
+        """ Changing the LO frequencies of a compiled sequence gives the same program as compiling it with them """
+        e = self.expt(lo_freq=2)
+        e.add_flodict(self.tr(0.5))
+        e.compile()
+        for lo_freq, patched in [ (2.5, True), ((3.1, 1.3, 0.7), True),
+                                  (3.75, False) ]: # phase step 1000 << 16: the LSB write is left out, so the program changes
+            e.set_lo_freq(lo_freq)
+            self.assertEqual(e._seq_compiled, patched)
+            e.compile()
+            ref = self.expt(lo_freq=lo_freq)
+            ref.add_flodict(self.tr(0.5))
+            ref.compile()
+            np.testing.assert_array_equal(e._machine_code, ref._machine_code)
+
+    def test_patch_then_append(self):
+        """ Appending to an incrementally-compiled sequence after a patched compile gives the full program """
+        e = self.expt(incremental_compile=True, patch_compile=True)
+        e.add_flodict(self.tr(0.5))
+        e.compile()
+        e.add_flodict(self.tr(0.3), append=False) # same times: patched
+        e.compile()
+        e.add_flodict(self.tr(0.2, 1000))
+        e.compile()
+        ref = self.expt()
+        ref.add_flodict(self.tr(0.3))
+        ref.add_flodict(self.tr(0.2, 1000))
+        ref.compile()
+        np.testing.assert_array_equal(e._machine_code, ref._machine_code)
+
+    def assert_same_seq(self, e, ref):
+        """ Same sequence dictionaries and machine code """
+        self.assertEqual(set(e._seq), set(ref._seq))
+        for k, (t, v) in ref._seq.items():
+            np.testing.assert_array_equal(e._seq[k][0], t, err_msg=k)
+            np.testing.assert_array_equal(e._seq[k][1], v, err_msg=k)
+        e.compile()
+        ref.compile()
+        np.testing.assert_array_equal(e._machine_code, ref._machine_code)
+
+    def test_seq_chunks(self):
+        """ Appended chunks of the sequence dictionary join up the same as appending to its arrays each time """
+        rng = np.random.default_rng(5)
+        e = self.expt()
+        ref = {}
+        for k in range(300):
+            intd = { key: (rng.integers(0, 1000, n), rng.integers(0, 100, n))
+                     for key, n in zip(rng.choice(['tx0_i', 'rx0_en', 'leds', 'tx_gate'], rng.integers(1, 4), replace=False), rng.integers(0, 5, 3)) }
+            append = rng.random() > 0.1
+            e.add_intdict(intd, append)
+            for key, (t, v) in intd.items():
+                if key in ref and append:
+                    ref[key] = ( np.append(ref[key][0], t), np.append(ref[key][1], v) )
+                else:
+                    ref[key] = (t, v)
+            if rng.random() < 0.1 or k == 299: # read part-way through, and at the end
+                self.assertEqual(set(e._seq), set(ref))
+                for key, (t, v) in ref.items():
+                    np.testing.assert_array_equal(e._seq[key][0], t)
+                    np.testing.assert_array_equal(e._seq[key][1], v)
+
+        # replacing the whole dictionary discards any chunks not yet joined
+        e.add_intdict({'tx0_i': (np.array([1]), np.array([2]))})
+        e._seq = {'rx0_en': (np.array([3]), np.array([1]))}
+        self.assertEqual(list(e._seq), ['rx0_en'])
+        e.add_intdict({'rx0_en': (np.array([4]), np.array([0]))})
+        np.testing.assert_array_equal(e._seq['rx0_en'][0], [3, 4])
+
+    def test_add_flodicts(self):
+        """ Adding many TRs at once matches adding them one at a time, including TRs starting with the last value of the one before """
+        trs = []
+        for k in range(6):
+            t0, n = k * 400, 2 + k % 3 # different numbers of events, so the TR starts aren't evenly spaced
+            trs.append({'tx0': (t0 + 10 + 10 * np.arange(n + 1), np.concatenate([[0], np.full(n - 1, 0.1 * (k + 1)), [0]])),
+                        'grad_vx': (t0 + np.array([5, 150]), np.array([0.1 * k, 0])),
+                        'rx0_en': (t0 + np.array([70, 300]), np.array([1, 0]))})
+        ref = self.expt()
+        for tr in trs:
+            ref.add_flodict(tr)
+        e = self.expt()
+        e.add_flodicts(trs)
+        self.assert_same_seq(e, ref)
+        self.assertEqual(e._seq['tx0_i'][0].size, 3 * len(trs)) # repeats within each TR removed, but not the zero starting each TR
+
+        # stacked arrays, with a single row of times shared by all the TRs
+        tr_starts = np.arange(5) * 300.0
+        amps = np.linspace(0, 0.4, 5)[:, np.newaxis]
+        ref = self.expt()
+        for t0, a in zip(tr_starts, amps):
+            ref.add_flodict({'tx0': (t0 + np.array([10, 20, 30]), np.array([0, 0.5, 0])),
+                             'grad_vx': (t0 + np.array([5, 150]), np.array([a[0], 0]))})
+        e = self.expt()
+        e.add_flodicts({'tx0': (np.array([10, 20, 30]), np.array([0, 0.5, 0])),
+                        'grad_vx': (np.array([5, 150]), np.hstack([amps, np.zeros_like(amps)]))}, tr_starts)
+        self.assert_same_seq(e, ref)
+
+    def test_add_trs(self):
+        """ A scan built from a TR template matches adding its TRs one at a time """
+        t = np.array([5, 20, 40, 60])
+        tpl = experiment.TRTemplate({'tx0': (np.array([10, 30]), np.array([0.5, 0])),
+                                     'grad_vy': (t, np.array([0, 0.5, 0.5, 0])),
+                                     'grad_vx': (t + 100, np.array([0, 0.2, 0.2, 0])),
+                                     'rx0_en': (np.array([70, 200]), np.array([1, 0]))},
+                                    {'amp': ('grad_vy', slice(1, 3)), 'phase': ('tx0', 0),
+                                     'read': [('grad_vx', [1, 2]), ('grad_vy', np.array([False, True, True, False]))]})
+        amp, phase, read = np.linspace(-1, 1, 9), np.exp(1j * np.arange(9)), np.linspace(0.5, 1, 9)
+        tr_starts = np.arange(9) * 300.0
+        e = self.expt()
+        e.add_trs(tpl, tr_starts, amp=amp, phase=phase, read=read)
+        ref = self.expt()
+        for k, t0 in enumerate(tr_starts):
+            ref.add_flodict({'tx0': (t0 + np.array([10, 30]), np.array([0.5 * phase[k], 0])),
+                             'grad_vy': (t0 + t, np.array([0, 0.5 * amp[k] * read[k], 0.5 * amp[k] * read[k], 0])),
+                             'grad_vx': (t0 + t + 100, np.array([0, 0.2 * read[k], 0.2 * read[k], 0])),
+                             'rx0_en': (t0 + np.array([70, 200]), np.array([1, 0]))})
+        self.assert_same_seq(e, ref)
+
+        # bad bindings
+        with self.assertRaises(AssertionError):
+            experiment.TRTemplate(tpl.flodict, {'amp': ('grad_vy', [1, 4])})
+        with self.assertRaises(AssertionError):
+            experiment.TRTemplate(tpl.flodict, {'amp': ('grad_vy', np.array([True, False]))})
+        with self.assertRaises(AssertionError):
+            experiment.TRTemplate(tpl.flodict, {'amp': ('grad_vz', 0)})
+
+    def test_run_async(self):
+        """ Runs started on one connection finish in the order they were started, with the same results as run() """
+        s, log = fake_server(0.02)
+        es = []
+        for k in range(5):
+            e = self.expt(s)
+            for j in range(k + 1): # different lengths
+                e.add_flodict(self.tr(0.1 * (k + 1), 1000 * j))
+            es.append(e)
+        ref = [ e.run() for e in es ]
+        done = []
+        futs = [ e.run_async() for e in es ]
+        for k, f in enumerate(futs):
+            f.add_done_callback(lambda f, k=k: done.append(k))
+        res = [ f.result() for f in futs ]
+        self.assertEqual(done, list(range(5)))
+        for (rxd, msgs), (ref_rxd, ref_msgs), e in zip(res, ref, es):
+            np.testing.assert_array_equal(rxd['rx0'], ref_rxd['rx0'])
+            self.assertEqual(msgs, ref_msgs)
+            np.testing.assert_allclose(rxd['rx0'].real * (1 << 24) / e._rx0_cic_factor, [e._machine_code.size])
+        self.assertEqual(len(log), 10)
+        s.close()
+
+    def test_run_queue(self):
+        """ Experiments and programs run back to back give the same results, in order, as running them one at a time """
+        s, log = fake_server()
+        es = []
+        for k in range(4):
+            e = self.expt(s, flush_old_rx=k == 2)
+            for j in range(k + 1):
+                e.add_flodict(self.tr(0.1 * (k + 1), 1000 * j))
+            es.append(e)
+        ref = [ e.run() for e in es ]
+        progs = [ e._machine_code[:-1] for e in es[:2] ] # not valid programs, but the fake server doesn't mind
+        log.clear()
+
+        rq = experiment.RunQueue(s)
+        res = list(rq.run([es[0], progs[0], es[1], es[2], progs[1], es[3]]))
+        self.assertEqual(len(res), 6)
+        for (rxd, msgs), (ref_rxd, ref_msgs) in zip(res[0:1] + res[2:4] + res[5:], ref):
+            np.testing.assert_array_equal(rxd['rx0'], ref_rxd['rx0'])
+            self.assertEqual(msgs, ref_msgs)
+        for (rxd, msgs), prog in zip(res[1:2] + res[4:5], progs):
+            self.assertEqual(rxd['rx0_i'], [prog.size])
+        self.assertEqual(log[3], {'read_rx': 0}) # flushed before es[2]
+
+    def test_run_queue_depth(self):
+        """ No more than depth sequences are sent ahead of the results that have been read """
+        s, log = fake_server()
+        prog = np.array([1, 2, 3], dtype=np.uint32)
+        for depth in (1, 3):
+            rq = experiment.RunQueue(s, depth=depth)
+            log.clear()
+            g = rq.run([prog] * 8)
+            next(g)
+            time.sleep(0.2)
+            self.assertEqual(len(log), depth + 1) # the first sequence's slot is free again once its result is read
+            self.assertEqual(len(list(g)), 7)
+            self.assertEqual(len(log), 8)
+
+    def test_run_queue_close(self):
+        """ Stopping early reads back the replies still outstanding, and the connection can be used again """
+        s, log = fake_server(0.02)
+        rq = experiment.RunQueue(s, depth=3)
+        g = rq.run( np.array([1, k], dtype=np.uint32) for k in range(10) )
+        self.assertEqual(next(g)[0]['rx0_q'], [1])
+        g.close()
+        self.assertLess(len(log), 10)
+        e = self.expt(s)
+        e.add_flodict(self.tr(0.5))
+        rxd, msgs = e.run()
+        np.testing.assert_allclose(rxd['rx0'].real * (1 << 24) / e._rx0_cic_factor, [e._machine_code.size])
+        self.assertEqual(next(rq.run([np.array([7, 8], dtype=np.uint32)]))[0]['rx0_q'], [15])
+
+    def test_run_queue_error(self):
+        """ Errors from compiling or producing the items are raised by run(), after the results before them """
+        s, log = fake_server()
+        def items():
+            yield np.array([1, 2], dtype=np.uint32)
+            raise ValueError("bad item")
+        g = experiment.RunQueue(s).run(items())
+        self.assertEqual(next(g)[0]['rx0_q'], [3])
+        with self.assertRaises(ValueError):
+            next(g)
+
+        e = self.expt(s, check_seq=True, max_seq_words=10)
+        e.add_flodict(self.tr(0.5))
+        with self.assertRaises(AssertionError):
+            list(experiment.RunQueue(s).run([e]))
+
+    def test_pipeline_closed(self):
+        """ Waiting for a reply from a closed connection raises an error """
+        a, b = socket.socketpair()
+        b.close()
+        with self.assertRaises(ConnectionError):
+            experiment.sc.Pipeline(a).reply()
+        a.close()
+
+if __name__ == "__main__":
+    unittest.main()
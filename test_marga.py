@@ -94,8 +94,7 @@ def leds():
 def marcompile_test():
 
     lc = fc.csv2bin("/tmp/mar_test1.csv")
-    lc.append(insta(IFINISH, 0))
-    raw_data = np.array(lc, dtype=np.uint32)
+    raw_data = np.append(lc, insta(IFINISH, 0)).astype(np.uint32)
     print(raw_data.size)
     return raw_data
 